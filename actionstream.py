@@ -0,0 +1,86 @@
+"""
+Incremental parser for the JSON array of edit actions the LLM writes.
+
+Text is fed in as it streams in; every element object is returned as soon as its
+closing brace arrives, so edits can be applied before the response is finished and
+the complete ones survive a response cut off by the output token limit. Like the old
+first-'[' to last-']' extraction, anything before the array (prose, a code fence)
+and after it is ignored, and brackets inside strings don't count.
+"""
+import re
+import json
+
+# Outside strings only these characters matter; inside, only the closing quote and escapes
+_TOKENS = re.compile(r'[\[\]{}"]')
+_STRING_TOKENS = re.compile(r'["\\]')
+
+class ActionStreamParser:
+    def __init__(self):
+        self.started = False  # the array's '[' was seen
+        self.complete = False # ... and its closing ']'
+        self.errors = []      # element texts that weren't valid JSON
+        self._buf = ""
+        self._pos = 0
+        self._depth = 0       # nesting inside the array; 0 between elements
+        self._start = None    # offset of the current element object in _buf
+        self._in_string = False
+
+    @property
+    def truncated(self):
+        """The array was opened but the text so far hasn't closed it."""
+        return self.started and not self.complete
+
+    def feed(self, text):
+        """Adds the next piece of text; returns the element objects it completed."""
+        buf = self._buf + text
+        pos = self._pos
+        done = []
+        while not self.complete:
+            if self._in_string:
+                m = _STRING_TOKENS.search(buf, pos)
+                if m is None:
+                    pos = len(buf)
+                    break
+                if m.group() == '\\':
+                    if m.end() == len(buf):
+                        pos = m.start() # the escaped character is in the next piece
+                        break
+                    pos = m.end() + 1
+                    continue
+                self._in_string = False
+                pos = m.end()
+                continue
+
+            m = _TOKENS.search(buf, pos)
+            if m is None:
+                pos = len(buf)
+                break
+            c = m.group()
+            pos = m.end()
+            if not self.started:
+                self.started = c == '['
+            elif c == '"':
+                self._in_string = True
+            elif c in '[{':
+                if self._depth == 0 and c == '{':
+                    self._start = m.start()
+                self._depth += 1
+            elif self._depth == 0:
+                self.complete = c == ']'
+            else:
+                self._depth -= 1
+                if self._depth == 0 and self._start is not None:
+                    element = buf[self._start:pos]
+                    self._start = None
+                    try:
+                        done.append(json.loads(element))
+                    except ValueError:
+                        self.errors.append(element)
+
+        # Only the unfinished element has to be kept
+        keep = self._start if self._start is not None else pos
+        self._buf = buf[keep:]
+        self._pos = pos - keep
+        if self._start is not None:
+            self._start = 0
+        return done
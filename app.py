@@ -34,6 +34,20 @@ def create_app():
     def health():
         return jsonify({"status": "ok"})
 
+    @app.route('/health/llm')
+    def llm_health():
+        # Per worker process: each gunicorn worker has its own pool and histograms
+        from doc_editor import llm, llm_client
+        return jsonify({"pid": os.getpid(), "client": llm_client.stats(), "cache": llm.response_cache_stats()})
+
+    @app.route('/health/cache')
+    def cache_health():
+        # Per worker process, like /health/llm: the JSON file cache, the upload parse cache
+        # and the parsed DOCX template cache
+        from doc_editor import storage, jsoncache, template_cache
+        return jsonify({"pid": os.getpid(), "json": jsoncache.stats(), "parse": storage.parse_cache_stats(),
+                        "template": template_cache.stats()})
+
     return app
 
 app = create_app()
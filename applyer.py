@@ -1,10 +1,39 @@
-import copy
+from doc_editor.docmodel import DocumentModel
+from doc_editor import textreplace
+
+def _batch_global_replacements(actions):
+    """
+    Folds each run of consecutive replace_text_globally actions into one
+    "replace_text_batch" pseudo-action so the whole run is applied in a single pass.
+    """
+    batched = []
+    for action in actions:
+        if action.get("action") == "replace_text_globally":
+            if batched and batched[-1].get("action") == "replace_text_batch":
+                batched[-1]["rules"].append(action)
+            else:
+                batched.append({"action": "replace_text_batch", "rules": [action]})
+        else:
+            batched.append(action)
+    return batched
 
 def apply_actions(structure, actions):
-    new_structure = copy.deepcopy(structure)
-    changes = []
+    # Paragraph actions go through an id-indexed, copy-on-write model: each one is O(1),
+    # `structure` itself is never modified and untouched paragraphs are shared with the result.
+    doc = DocumentModel(structure)
+    changes = apply_to_model(doc, actions)
+    return doc.to_structure(), changes
+
+def apply_to_model(doc, actions, changes=None):
+    """
+    Applies `actions` to a DocumentModel in place, appending to and returning `changes`.
+    Streamed edits call this once per action (or run of global replacements) on the
+    same model and changes list.
+    """
+    if changes is None:
+        changes = []
     
-    for action in actions:
+    for action in _batch_global_replacements(actions):
         act_type = action.get("action")
         
         if act_type == "noop":
@@ -15,54 +44,43 @@ def apply_actions(structure, actions):
             changes.append(f"Question: {action.get('question')}")
             continue
             
-        if act_type == "replace_text_globally":
-            old = action["old_text"]
-            new = action["new_text"]
-            count = 0
-            for sec in new_structure["sections"]:
-                for p in sec["paragraphs"]:
-                    if old in p["text"]:
-                        p["text"] = p["text"].replace(old, new)
-                        count += 1
-            changes.append(f"Replaced {count} occurrences of '{old}' with '{new}'")
+        if act_type == "replace_text_batch":
+            # All global replacements of the run in one pass over paragraphs and table cells
+            rules = action["rules"]
+            counts = [0] * len(rules)
+            matcher = textreplace.compile_replacements(rules)
+            if matcher:
+                def replace_paragraph_text(p):
+                    new_text = textreplace.replace_all(matcher, p["text"], counts)
+                    return {"text": new_text} if new_text != p["text"] else None
+                doc.update_each(replace_paragraph_text)
+                doc.update_table_cells(lambda cell: textreplace.replace_all(matcher, cell, counts))
+            for rule, count in zip(rules, counts):
+                changes.append(f"Replaced {count} occurrences of '{rule['old_text']}' with '{rule['new_text']}'")
             
         if act_type == "replace_paragraph":
             pid = action["paragraph_id"]
             new_text = action["new_text"]
             new_style = action.get("style_type")
-            found = False
-            for sec in new_structure["sections"]:
-                for p in sec["paragraphs"]:
-                    if p["id"] == pid:
-                        p["text"] = new_text
-                        if new_style:
-                            p["type"] = new_style
-                        found = True
-                        changes.append(f"Updated paragraph {pid}")
-                        break
-            if not found:
+            fields = {"text": new_text}
+            if new_style:
+                fields["type"] = new_style
+            if doc.update(pid, **fields):
+                changes.append(f"Updated paragraph {pid}")
+            else:
                 changes.append(f"Failed to find paragraph {pid}")
                 
         if act_type == "delete_paragraph":
             pid = action["paragraph_id"]
-            for sec in new_structure["sections"]:
-                initial_len = len(sec["paragraphs"])
-                sec["paragraphs"] = [p for p in sec["paragraphs"] if p["id"] != pid]
-                if len(sec["paragraphs"]) < initial_len:
-                    changes.append(f"Deleted paragraph {pid}")
+            if doc.delete(pid):
+                changes.append(f"Deleted paragraph {pid}")
                     
         if act_type == "update_paragraph_style":
             pid = action["paragraph_id"]
             new_type = action["style_type"]
-            found = False
-            for sec in new_structure["sections"]:
-                for p in sec["paragraphs"]:
-                    if p["id"] == pid:
-                        p["type"] = new_type
-                        found = True
-                        changes.append(f"Changed paragraph {pid} style to {new_type}")
-                        break
-            if not found:
+            if doc.update(pid, type=new_type):
+                changes.append(f"Changed paragraph {pid} style to {new_type}")
+            else:
                 changes.append(f"Failed to find paragraph {pid} for style update")
 
         if act_type == "insert_paragraph":
@@ -77,35 +95,18 @@ def apply_actions(structure, actions):
             
             new_p = {"id": new_pid, "text": new_text, "type": "text"}
             
-            # Find section
-            target_sec = None
-            for sec in new_structure["sections"]:
-                if sec["id"] == sec_id:
-                    target_sec = sec
-                    break
-            
-            if target_sec:
-                if after_pid:
-                    try:
-                        idx = next(i for i, p in enumerate(target_sec["paragraphs"]) if p["id"] == after_pid)
-                        target_sec["paragraphs"].insert(idx + 1, new_p)
-                        changes.append(f"Inserted paragraph after {after_pid}")
-                    except StopIteration:
-                        # Fallback append
-                        target_sec["paragraphs"].append(new_p)
-                        changes.append(f"Inserted paragraph (fallback append) in {sec_id}")
-                elif before_pid:
-                    try:
-                        idx = next(i for i, p in enumerate(target_sec["paragraphs"]) if p["id"] == before_pid)
-                        target_sec["paragraphs"].insert(idx, new_p)
-                        changes.append(f"Inserted paragraph before {before_pid}")
-                    except StopIteration:
-                        target_sec["paragraphs"].insert(0, new_p)
-                        changes.append(f"Inserted paragraph (fallback prepend) in {sec_id}")
-                else:
-                    # Append
-                    target_sec["paragraphs"].append(new_p)
-                    changes.append(f"Inserted paragraph in {sec_id}")
+            placed = doc.insert(sec_id, new_p, after_pid=after_pid, before_pid=before_pid)
+            if placed == "after":
+                changes.append(f"Inserted paragraph after {after_pid}")
+            elif placed == "before":
+                changes.append(f"Inserted paragraph before {before_pid}")
+            elif placed == "append" and after_pid:
+                # Fallback append
+                changes.append(f"Inserted paragraph (fallback append) in {sec_id}")
+            elif placed == "prepend":
+                changes.append(f"Inserted paragraph (fallback prepend) in {sec_id}")
+            elif placed == "append":
+                changes.append(f"Inserted paragraph in {sec_id}")
             else:
                 changes.append(f"Failed to find section {sec_id} for insertion")
              
@@ -113,17 +114,13 @@ def apply_actions(structure, actions):
             style_name = action["style_name"]
             size = action["size_pt"]
             
-            # We need to store this in structure so parser can pick it up.
-            # Let's add a 'styles' dict to meta if not exists.
-            if "styles" not in new_structure["meta"]:
-                new_structure["meta"]["styles"] = {}
-                
-            new_structure["meta"]["styles"][style_name] = {
+            # We need to store this in structure so parser can pick it up (meta.styles).
+            doc.set_style_definition(style_name, {
                 "size_pt": size,
                 "bold": action.get("bold"),
                 "italic": action.get("italic"),
                 "justification": action.get("justification")
-            }
+            })
             changes.append(f"Updated style '{style_name}' to {size}pt")
 
-    return new_structure, changes
+    return changes
@@ -0,0 +1,83 @@
+"""
+Compares the structure codecs (see serialization) on real or generated documents:
+encode and decode time and stored size, section by section as storage keeps them.
+
+    python -m doc_editor.bench_codecs big.docx other.docx
+    python -m doc_editor.bench_codecs --paragraphs 50000
+"""
+import sys
+import time
+import random
+import argparse
+from doc_editor import parsers, serialization
+
+def synthetic_structure(paragraph_count, seed=0):
+    """A structure shaped like the parser's output: headings every ~40 paragraphs, some tables."""
+    rng = random.Random(seed)
+    words = ("the contract party shall agreement notice term payment section clause "
+             "within days written provided each other any such date").split()
+    sections = []
+    section = None
+    for i in range(paragraph_count):
+        if section is None or rng.random() < 1 / 40:
+            n = len(sections) + 1
+            section = {"id": f"s{n}", "title": f"Heading {n}", "paragraphs": [], "tables": []}
+            sections.append(section)
+            p_type = "h1"
+        else:
+            p_type = rng.choice(("p", "p", "p", "p", "li", "li", "h3"))
+        pid = f"{section['id']}_p{len(section['paragraphs']) + 1}"
+        text = " ".join(rng.choice(words) for _ in range(rng.randint(3, 60)))
+        section["paragraphs"].append({"id": pid, "text": text.capitalize() + ".", "type": p_type})
+        if rng.random() < 1 / 200:
+            rows = [[rng.choice(words) for _ in range(4)] for _ in range(6)]
+            section["tables"].append({"id": f"{section['id']}_t{len(section['tables']) + 1}",
+                                      "after_paragraph": pid, "rows": rows})
+    return {"meta": {"paragraph_count": paragraph_count, "created_at": None}, "sections": sections}
+
+def _best(fn, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def bench(structure, repeat=5):
+    """{codec name: (encode seconds, decode seconds, bytes)} over the structure's sections."""
+    sections = structure["sections"]
+    results = {}
+    for name, codec in serialization.CODECS.items():
+        encoded = [codec.encode(sec) for sec in sections]
+        assert [codec.decode(data) for data in encoded] == sections, name
+        encode_time = _best(lambda: [codec.encode(sec) for sec in sections], repeat)
+        decode_time = _best(lambda: [codec.decode(data) for data in encoded], repeat)
+        results[name] = (encode_time, decode_time, sum(len(data) for data in encoded))
+    return results
+
+def report(label, structure, repeat):
+    paragraphs = sum(len(sec.get("paragraphs", [])) for sec in structure["sections"])
+    print(f"{label}: {len(structure['sections'])} sections, {paragraphs} paragraphs")
+    results = bench(structure, repeat)
+    base_size = results["json"][2]
+    print(f"  {'codec':<8} {'encode ms':>10} {'decode ms':>10} {'bytes':>11} {'vs json':>8}")
+    for name, (encode_time, decode_time, size) in results.items():
+        print(f"  {name:<8} {encode_time * 1000:>10.1f} {decode_time * 1000:>10.1f} {size:>11,} {size / base_size:>8.0%}")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the structure codecs.")
+    parser.add_argument('docx', nargs='*', help="documents to parse and benchmark")
+    parser.add_argument('--paragraphs', type=int, default=20000,
+                        help="size of the generated document used when no DOCX is given")
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args(argv)
+
+    if args.docx:
+        for path in args.docx:
+            report(path, parsers.parse_docx_to_structure(path), args.repeat)
+    else:
+        report("generated", synthetic_structure(args.paragraphs), args.repeat)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
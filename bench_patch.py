@@ -0,0 +1,52 @@
+"""
+Times the full patcher (parsers.patch_docx_from_structure) generating a document of
+N new paragraphs on an empty template, the "generate a report" case where every
+paragraph has to be created and placed.
+
+    python -m doc_editor.bench_patch
+    python -m doc_editor.bench_patch --paragraphs 5000 10000 20000 --template template.docx
+"""
+import io
+import os
+import sys
+import time
+import argparse
+import tempfile
+import contextlib
+import docx
+from doc_editor import parsers, template_cache
+
+def generated_structure(paragraph_count):
+    """New paragraphs only (ids the template doesn't have), a heading every 50, some markdown bold."""
+    paragraphs = [{"id": f"g{i}", "text": f"Generated paragraph {i} with **bold** words",
+                   "type": "h1" if i % 50 == 0 else "text"} for i in range(paragraph_count)]
+    return {"meta": {}, "sections": [{"id": "s1", "title": "Document Start", "paragraphs": paragraphs, "tables": []}]}
+
+def bench(template_path, paragraph_count):
+    structure = generated_structure(paragraph_count)
+    with tempfile.TemporaryDirectory() as tmp:
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            parsers.patch_docx_from_structure(template_path, structure, os.path.join(tmp, "out.docx"))
+        return time.perf_counter() - start
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the full patcher on generated paragraphs.")
+    parser.add_argument('--paragraphs', type=int, nargs='+', default=[5000, 10000, 20000])
+    parser.add_argument('--template', help="template DOCX (default: an empty document)")
+    args = parser.parse_args(argv)
+
+    # Measure the patcher, not the package cache
+    template_cache.TEMPLATE_CACHE_MAX_ENTRIES = 0
+    with tempfile.TemporaryDirectory() as tmp:
+        template = args.template
+        if template is None:
+            template = os.path.join(tmp, "empty.docx")
+            docx.Document().save(template)
+        for n in args.paragraphs:
+            seconds = bench(template, n)
+            print(f"{n:>7} paragraphs: {seconds:6.2f}s ({seconds / n * 1e6:.0f}us per paragraph)")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
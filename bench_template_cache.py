@@ -0,0 +1,97 @@
+"""
+Times revision saves with and without the template cache (see template_cache): a
+series of one-paragraph edits on one document, each saved through storage like /edit.
+
+    python -m doc_editor.bench_template_cache big.docx
+    python -m doc_editor.bench_template_cache --paragraphs 7000 --edits 6
+"""
+import io
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import contextlib
+import docx
+from werkzeug.datastructures import FileStorage
+from doc_editor import storage, parsers, applyer, template_cache
+
+def synthetic_docx(path, paragraph_count):
+    """A DOCX with a Heading 1 every 40 paragraphs and body text in between."""
+    doc = docx.Document()
+    for i in range(paragraph_count):
+        if i % 40 == 0:
+            doc.add_heading(f"Heading {i // 40 + 1}", level=1)
+        else:
+            doc.add_paragraph(f"Paragraph {i} of the generated document, with a few words of body text.")
+    doc.save(path)
+
+def run_edits(docx_path, edits, cached):
+    """(save seconds, patch seconds) per edit, on a fresh data directory."""
+    base = tempfile.mkdtemp()
+    saved = (storage.BASE_DIR, storage.BLOB_DIR, storage.PARSE_CACHE_DIR, template_cache.TEMPLATE_CACHE_MAX_ENTRIES)
+    storage.BASE_DIR, storage.BLOB_DIR, storage.PARSE_CACHE_DIR = base, f"{base}/_blobs", f"{base}/_parse_cache"
+    template_cache.TEMPLATE_CACHE_MAX_ENTRIES = saved[3] if cached else 0
+    template_cache.clear()
+
+    patch_times = []
+    incremental = parsers.patch_docx_incremental
+    def timed_patch(*args):
+        start = time.perf_counter()
+        try:
+            return incremental(*args)
+        finally:
+            patch_times.append(time.perf_counter() - start)
+    parsers.patch_docx_incremental = timed_patch
+
+    save_times = []
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            with open(docx_path, 'rb') as f:
+                doc_id = storage.create_document(FileStorage(stream=f, filename="bench.docx"))
+            for n in range(edits):
+                structure = storage.get_structure(doc_id)
+                paragraphs = list(parsers.iter_structure_paragraphs(structure))
+                target = paragraphs[(len(paragraphs) // 2 + n) % len(paragraphs)]
+                section = next(sec["id"] for sec in structure["sections"] if target in sec["paragraphs"])
+                new_structure, changes = applyer.apply_actions(structure, [{
+                    "action": "replace_paragraph", "section_id": section,
+                    "paragraph_id": target["id"], "new_text": f"Edit {n}"}])
+                start = time.perf_counter()
+                storage.save_revision(doc_id, new_structure, changes, f"edit {n}")
+                save_times.append(time.perf_counter() - start)
+                time.sleep(0.01) # distinct mtimes, as between real requests
+    finally:
+        parsers.patch_docx_incremental = incremental
+        storage.BASE_DIR, storage.BLOB_DIR, storage.PARSE_CACHE_DIR, template_cache.TEMPLATE_CACHE_MAX_ENTRIES = saved
+        template_cache.clear()
+        shutil.rmtree(base, ignore_errors=True)
+    return save_times, patch_times
+
+def report(label, docx_path, edits):
+    print(f"{label}: {edits} one-paragraph edits")
+    for cached in (False, True):
+        save_times, patch_times = run_edits(docx_path, edits, cached)
+        ms = lambda times: f"{min(times) * 1000:.0f}-{max(times) * 1000:.0f}ms"
+        print(f"  {'cache' if cached else 'no cache':<9} save {ms(save_times):>12}   patch {ms(patch_times):>12}")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark revision saves with and without the template cache.")
+    parser.add_argument('docx', nargs='*', help="documents to edit")
+    parser.add_argument('--paragraphs', type=int, default=7000,
+                        help="size of the generated document used when no DOCX is given")
+    parser.add_argument('--edits', type=int, default=6)
+    args = parser.parse_args(argv)
+
+    if args.docx:
+        for path in args.docx:
+            report(path, path, args.edits)
+    else:
+        with tempfile.TemporaryDirectory() as tmp:
+            path = f"{tmp}/generated.docx"
+            synthetic_docx(path, args.paragraphs)
+            report(f"generated ({args.paragraphs} paragraphs)", path, args.edits)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,215 @@
+"""
+Indexed in-memory document model used by applyer.apply_actions.
+
+Each section keeps its paragraphs in a doubly linked list and the model keeps a
+paragraph id -> node index, so lookups, inserts and deletes are O(1) no matter
+how long the document is. `to_structure()` turns it back into the JSON structure
+the rest of the app uses.
+
+The model is copy-on-write over the structure it was built from: the input is
+never mutated, a paragraph dict is copied only when it is first changed, and
+sections that weren't touched are handed back as the very same objects. So the
+old and new structures share everything an edit didn't touch, and rolling back
+is just dropping the model.
+"""
+
+class _Node:
+    __slots__ = ("p", "prev", "next", "section", "owned")
+
+    def __init__(self, p, section, owned=False):
+        self.p = p
+        self.prev = None
+        self.next = None
+        self.section = section
+        self.owned = owned # True once `p` is our own copy
+
+
+class _Section:
+    def __init__(self, sec):
+        self.original = sec
+        self.id = sec.get("id")
+        self.tables = None # replacement tables list, once a cell has changed
+        self.dirty = False
+        # Sentinels so insert/unlink never special-case the ends
+        self.head = _Node(None, self)
+        self.tail = _Node(None, self)
+        self.head.next = self.tail
+        self.tail.prev = self.head
+
+    def link_after(self, anchor, node):
+        self.dirty = True
+        node.prev = anchor
+        node.next = anchor.next
+        anchor.next.prev = node
+        anchor.next = node
+
+    def unlink(self, node):
+        self.dirty = True
+        node.prev.next = node.next
+        node.next.prev = node.prev
+        node.prev = node.next = None
+
+    def __iter__(self):
+        node = self.head.next
+        while node is not self.tail:
+            yield node
+            node = node.next
+
+
+class DocumentModel:
+    def __init__(self, structure):
+        self.meta = structure.get("meta", {})
+        self.extra = {k: v for k, v in structure.items() if k not in ("sections", "meta")}
+        self.sections = []
+        self.sections_by_id = {}
+        self.index = {}
+
+        for sec in structure.get("sections", []):
+            section = _Section(sec)
+            self.sections.append(section)
+            self.sections_by_id.setdefault(section.id, section)
+            for p in sec.get("paragraphs", []):
+                node = _Node(p, section)
+                section.link_after(section.tail.prev, node)
+                # First occurrence wins, same as the old linear scans
+                self.index.setdefault(p["id"], node)
+            section.dirty = False
+        self.meta_owned = False
+
+    def get(self, pid):
+        """Paragraph dict for `pid`, or None."""
+        node = self.index.get(pid)
+        return node.p if node else None
+
+    def section_of(self, pid):
+        node = self.index.get(pid)
+        return node.section.id if node else None
+
+    def has_section(self, sec_id):
+        return sec_id in self.sections_by_id
+
+    def update(self, pid, **fields):
+        """Sets fields on paragraph `pid`. Returns False if it doesn't exist."""
+        node = self.index.get(pid)
+        if node is None:
+            return False
+        self._write(node, fields)
+        return True
+
+    def update_each(self, fn):
+        """
+        Calls fn(paragraph) for every paragraph in order; when it returns a dict of fields,
+        they're written to that paragraph. Returns how many paragraphs were updated.
+        """
+        count = 0
+        for section in self.sections:
+            for node in section:
+                fields = fn(node.p)
+                if fields:
+                    self._write(node, fields)
+                    count += 1
+        return count
+
+    def update_table_cells(self, fn):
+        """
+        Calls fn(text) for every table cell; a different return value becomes the new cell text.
+        Cells are the parser's grid, so a merged cell is seen once per grid position it covers.
+        Only the tables, rows and lists that actually change are copied.
+        """
+        for section in self.sections:
+            tables = section.tables if section.tables is not None else section.original.get("tables", [])
+            new_tables = None
+            for t_idx, table in enumerate(tables):
+                new_rows = None
+                for r_idx, row in enumerate(table.get("rows", [])):
+                    new_row = None
+                    for c_idx, cell in enumerate(row):
+                        new_cell = fn(cell)
+                        if new_cell != cell:
+                            if new_row is None:
+                                new_row = list(row)
+                            new_row[c_idx] = new_cell
+                    if new_row is not None:
+                        if new_rows is None:
+                            new_rows = list(table["rows"])
+                        new_rows[r_idx] = new_row
+                if new_rows is not None:
+                    if new_tables is None:
+                        new_tables = list(tables)
+                    new_tables[t_idx] = dict(table, rows=new_rows)
+            if new_tables is not None:
+                section.tables = new_tables
+                section.dirty = True
+
+    def _write(self, node, fields):
+        if not node.owned:
+            node.p = dict(node.p)
+            node.owned = True
+            node.section.dirty = True
+        node.p.update(fields)
+
+    def set_style_definition(self, style_name, props):
+        # meta and meta.styles are shared with the input until the first style change
+        if not self.meta_owned:
+            self.meta = dict(self.meta)
+            self.meta["styles"] = dict(self.meta.get("styles", {}))
+            self.meta_owned = True
+        self.meta["styles"][style_name] = props
+
+    def delete(self, pid):
+        node = self.index.pop(pid, None)
+        if node is None:
+            return False
+        node.section.unlink(node)
+        return True
+
+    def insert(self, sec_id, p, after_pid=None, before_pid=None):
+        """
+        Inserts paragraph dict `p` into section `sec_id`.
+        Returns "after" / "before" / "append" / "prepend" (the last two when the anchor
+        isn't in that section), or None if the section doesn't exist.
+        """
+        section = self.sections_by_id.get(sec_id)
+        if section is None:
+            return None
+
+        if after_pid:
+            anchor = self.index.get(after_pid)
+            placed = "after"
+            if anchor is None or anchor.section is not section:
+                anchor, placed = section.tail.prev, "append"
+        elif before_pid:
+            anchor = self.index.get(before_pid)
+            placed = "before"
+            if anchor is None or anchor.section is not section:
+                anchor, placed = section.head, "prepend"
+            else:
+                anchor = anchor.prev
+        else:
+            anchor, placed = section.tail.prev, "append"
+
+        node = _Node(p, section, owned=True)
+        section.link_after(anchor, node)
+        self.index.setdefault(p["id"], node)
+        return placed
+
+    def iter_paragraphs(self):
+        """Yields paragraph dicts, read-only - change them through update()."""
+        for section in self.sections:
+            for node in section:
+                yield node.p
+
+    def to_structure(self):
+        sections = []
+        for section in self.sections:
+            if not section.dirty:
+                sections.append(section.original)
+                continue
+            sec = dict(section.original)
+            sec["paragraphs"] = [node.p for node in section]
+            if section.tables is not None:
+                sec["tables"] = section.tables
+            sections.append(sec)
+        structure = {"sections": sections, "meta": self.meta}
+        structure.update(self.extra)
+        return structure
@@ -0,0 +1,68 @@
+"""
+Document ids and where their directories live under the data directory.
+
+Ids are ULIDs: a 48-bit millisecond timestamp followed by 80 random bits, in Crockford
+base32 (26 characters). They sort by creation time and two uploads in the same
+millisecond, in any process, don't collide.
+
+Document directories are sharded by the hash of the id, data/ab/cd/<doc_id>, so no
+directory holds more than a few thousand entries even with millions of documents.
+Hashing (rather than using the id's own prefix) spreads time-ordered ids evenly.
+Documents created before sharding live flat in data/<doc_id>/ until migrate_layout
+moves them; get_doc_dir finds them in either place.
+"""
+import os
+import time
+import hashlib
+import secrets
+
+_CROCKFORD = "0123456789ABCDEFGHJKMNPQRSTVWXYZ"
+
+def new_doc_id():
+    value = (int(time.time() * 1000) << 80) | secrets.randbits(80)
+    chars = []
+    for _ in range(26):
+        chars.append(_CROCKFORD[value & 31])
+        value >>= 5
+    return "".join(reversed(chars))
+
+def shard_dir(base_dir, doc_id):
+    """Sharded location of document `doc_id`: <base_dir>/ab/cd/<doc_id>."""
+    digest = hashlib.sha256(doc_id.encode('utf-8')).hexdigest()
+    return os.path.join(base_dir, digest[:2], digest[2:4], doc_id)
+
+def flat_dir(base_dir, doc_id):
+    return os.path.join(base_dir, doc_id)
+
+def get_doc_dir(base_dir, doc_id):
+    """
+    Directory of document `doc_id`: the sharded one, or the flat one for a document that
+    hasn't been migrated yet. Unknown documents get the sharded path (which doesn't exist).
+    """
+    path = shard_dir(base_dir, doc_id)
+    if os.path.isdir(path):
+        return path
+    legacy = flat_dir(base_dir, doc_id)
+    if os.path.isdir(legacy):
+        return legacy
+    return path
+
+def _is_shard_name(name):
+    return len(name) == 2 and all(c in "0123456789abcdef" for c in name)
+
+def iter_doc_dirs(base_dir):
+    """Yields (doc_id, directory, sharded) for every document directory under `base_dir`."""
+    if not os.path.isdir(base_dir):
+        return
+    for top in os.scandir(base_dir):
+        if not top.is_dir() or top.name.startswith('_'):
+            continue # blob store, parse cache
+        if not _is_shard_name(top.name):
+            yield top.name, top.path, False
+            continue
+        for mid in os.scandir(top.path):
+            if not mid.is_dir():
+                continue
+            for doc in os.scandir(mid.path):
+                if doc.is_dir():
+                    yield doc.name, doc.path, True
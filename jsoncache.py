@@ -0,0 +1,123 @@
+"""
+Per-process cache of small JSON/text files (structure manifests, sections, history, HEAD).
+read_decoded caches files in other formats (binary sections, see serialization) the same way.
+
+A request typically reads the same document files several times (/edit reads the
+structure, the head revision and the history, then save_revision reads them again).
+Reads are served from memory as long as the file is unchanged, which is checked with a
+single stat: entries are keyed by path and validated against (inode, mtime, size).
+Writers go through write_json/write_text, which write to a temp file and rename it
+into place, so a reader never sees half-written JSON and every update gets a new inode.
+
+Cached values are shared between callers: treat them as read-only and copy before
+modifying.
+"""
+import os
+import json
+import tempfile
+import threading
+from collections import OrderedDict
+
+JSON_CACHE_MAX_ENTRIES = int(os.environ.get("JSON_CACHE_MAX_ENTRIES", "4096"))
+JSON_CACHE_MAX_BYTES = int(os.environ.get("JSON_CACHE_MAX_MB", "64")) * 1024 * 1024
+
+_entries = OrderedDict() # path -> (validator, size, value)
+_total_bytes = 0
+_lock = threading.Lock()
+_stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+def _validator(st):
+    return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+def _read(path, parse, mode='r'):
+    # Raises FileNotFoundError like open() would
+    st = os.stat(path)
+    validator = _validator(st)
+    with _lock:
+        entry = _entries.get(path)
+        if entry is not None and entry[0] == validator:
+            _entries.move_to_end(path)
+            _stats["hits"] += 1
+            return entry[2]
+        _stats["misses"] += 1
+
+    with open(path, mode) as f:
+        value = parse(f)
+    _put(path, validator, st.st_size, value)
+    return value
+
+def _put(path, validator, size, value):
+    global _total_bytes
+    with _lock:
+        old = _entries.pop(path, None)
+        if old is not None:
+            _total_bytes -= old[1]
+        if size > JSON_CACHE_MAX_BYTES:
+            return
+        _entries[path] = (validator, size, value)
+        _total_bytes += size
+        while len(_entries) > JSON_CACHE_MAX_ENTRIES or _total_bytes > JSON_CACHE_MAX_BYTES:
+            _, (_, evicted_size, _) = _entries.popitem(last=False)
+            _total_bytes -= evicted_size
+            _stats["evictions"] += 1
+
+def read_json(path, cache=True):
+    # cache=False for files read once in a while (parse cache entries): no memory held
+    if not cache:
+        with open(path, 'r') as f:
+            return json.load(f)
+    return _read(path, json.load)
+
+def read_text(path):
+    return _read(path, lambda f: f.read())
+
+def read_decoded(path, decode):
+    # `decode` gets the file's bytes
+    return _read(path, lambda f: decode(f.read()), 'rb')
+
+def _write_atomic(path, text, value):
+    directory = os.path.dirname(path)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.part')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(text)
+        os.replace(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    if value is not None:
+        # What we just wrote is what the next reader would parse
+        _put(path, _validator(os.stat(path)), len(text), value)
+
+def write_json(path, data, cache=True):
+    """
+    Atomically replaces `path` with `data` as JSON. With cache=True, `data` is cached as
+    the file's content, so the caller must not modify it afterwards.
+    """
+    _write_atomic(path, json.dumps(data), data if cache else None)
+
+def write_text(path, text):
+    _write_atomic(path, text, text)
+
+def invalidate(path):
+    global _total_bytes
+    with _lock:
+        old = _entries.pop(path, None)
+        if old is not None:
+            _total_bytes -= old[1]
+
+def clear():
+    global _total_bytes
+    with _lock:
+        _entries.clear()
+        _total_bytes = 0
+
+def stats():
+    with _lock:
+        s = dict(_stats)
+        s["entries"] = len(_entries)
+        s["bytes"] = _total_bytes
+    lookups = s["hits"] + s["misses"]
+    s["hit_rate"] = s["hits"] / lookups if lookups else 0.0
+    return s
@@ -1,25 +1,163 @@
 import os
-import requests
+import re
+import copy
+import time
+import hashlib
+import tempfile
+import threading
 import json
+from collections import OrderedDict
 from jsonschema import validate, ValidationError
 from doc_editor.models import EDIT_SCHEMA
+from doc_editor import llm_context, llm_client, actionstream
 
 GEMINI_API_KEY = "gemini_api_key"
-API_URL = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-2.0-flash:generateContent?key={GEMINI_API_KEY}"
+GEMINI_MODEL = "gemini-2.0-flash"
+API_URL = llm_client.model_url(GEMINI_MODEL)
+STREAM_URL = llm_client.model_url(GEMINI_MODEL, "streamGenerateContent")
 
-def get_edit_actions(instruction, full_structure, context_pid=None):
-    # Context trimming logic
-    # If context_pid is provided, find it and grab neighbors.
-    # Else send simplified structure.
-    
-    doc_context = full_structure # Start with full
-    if context_pid:
-        # TODO: Implement context windowing
-        pass
+GENERATION_CONFIG = {
+    "temperature": 0.4, # Slightly higher for creativity/length
+    "maxOutputTokens": 8192,
+}
+
+# --- Response cache ---
+#
+# Validated action lists, keyed by the normalized instruction, the exact prompt context and
+# the model parameters: resubmitting an instruction against an unchanged document (retries,
+# double clicks, identical templates) skips the Gemini round trip. A bounded in-memory tier
+# sits in front of an on-disk one shared by all workers; entries expire after LLM_CACHE_TTL.
+LLM_CACHE_ENABLED = os.environ.get("LLM_CACHE", "1") != "0"
+LLM_CACHE_TTL = int(os.environ.get("LLM_CACHE_TTL", str(24 * 3600)))
+LLM_CACHE_MAX_ENTRIES = int(os.environ.get("LLM_CACHE_MAX_ENTRIES", "256"))
+LLM_CACHE_DISK_MAX_ENTRIES = int(os.environ.get("LLM_CACHE_DISK_MAX_ENTRIES", "10000"))
+LLM_CACHE_DIR = os.environ.get("LLM_CACHE_DIR", os.path.join(os.getcwd(), 'data', '_llm_cache'))
+
+_cache = OrderedDict() # key -> (created, actions)
+_cache_lock = threading.Lock()
+_cache_stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "stores": 0}
+
+def normalize_instruction(instruction):
+    # Whitespace only: case and punctuation can change what an instruction asks for
+    return re.sub(r'\s+', ' ', instruction).strip()
+
+def response_cache_key(instruction, system_prompt, prompt_context):
+    key = json.dumps([normalize_instruction(instruction), GEMINI_MODEL, GENERATION_CONFIG,
+                      hashlib.sha256(system_prompt.encode('utf-8')).hexdigest(),
+                      hashlib.sha256(prompt_context.encode('utf-8')).hexdigest()], sort_keys=True)
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+def _cache_path(key):
+    return os.path.join(LLM_CACHE_DIR, key[:2], f'{key}.json')
+
+def _cache_get(key):
+    now = time.time()
+    with _cache_lock:
+        entry = _cache.get(key)
+        if entry is not None:
+            if now - entry[0] < LLM_CACHE_TTL:
+                _cache.move_to_end(key)
+                _cache_stats["memory_hits"] += 1
+                return copy.deepcopy(entry[1])
+            del _cache[key]
+
+    path = _cache_path(key)
+    try:
+        with open(path, 'r') as f:
+            entry = json.load(f)
+    except (OSError, ValueError):
+        entry = None
+    if entry is not None and now - entry["created"] >= LLM_CACHE_TTL:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        entry = None
+    if entry is None:
+        with _cache_lock:
+            _cache_stats["misses"] += 1
+        return None
+    _cache_put_memory(key, entry["created"], entry["actions"])
+    with _cache_lock:
+        _cache_stats["disk_hits"] += 1
+    return copy.deepcopy(entry["actions"])
+
+def _cache_put_memory(key, created, actions):
+    with _cache_lock:
+        _cache[key] = (created, actions)
+        _cache.move_to_end(key)
+        while len(_cache) > LLM_CACHE_MAX_ENTRIES:
+            _cache.popitem(last=False)
+
+def _cache_put(key, actions):
+    created = time.time()
+    actions = copy.deepcopy(actions) # the caller keeps its list
+    _cache_put_memory(key, created, actions)
+    with _cache_lock:
+        _cache_stats["stores"] += 1
+        prune = _cache_stats["stores"] % 100 == 0
+    # The answer is already paid for: a full or read-only disk only costs the disk tier
+    try:
+        path = _cache_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.part')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump({"created": created, "actions": actions}, f)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        if prune:
+            _prune_disk_cache()
+    except OSError as e:
+        print(f"DEBUG: LLM response cache write failed: {e}")
+
+def _prune_disk_cache():
+    # Expired entries first, then the oldest ones past LLM_CACHE_DISK_MAX_ENTRIES
+    # Other workers prune too: entries may vanish at any point
+    entries = [] # (mtime, path)
+    for bucket in os.scandir(LLM_CACHE_DIR):
+        if not bucket.is_dir():
+            continue
+        for e in os.scandir(bucket.path):
+            if e.name.endswith('.json'):
+                try:
+                    entries.append((e.stat().st_mtime, e.path))
+                except FileNotFoundError:
+                    pass
+    now = time.time()
+    entries.sort()
+    excess = len(entries) - LLM_CACHE_DISK_MAX_ENTRIES
+    for i, (mtime, path) in enumerate(entries):
+        if i >= excess and now - mtime < LLM_CACHE_TTL:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+def clear_response_cache():
+    with _cache_lock:
+        _cache.clear()
+
+def response_cache_stats():
+    with _cache_lock:
+        stats = dict(_cache_stats)
+        stats["entries"] = len(_cache)
+    lookups = stats["memory_hits"] + stats["disk_hits"] + stats["misses"]
+    stats["hit_rate"] = (stats["memory_hits"] + stats["disk_hits"]) / lookups if lookups else 0.0
+    return stats
+
+def _build_prompt(instruction, full_structure, context_pid):
+    """(system prompt, document extract, user prompt) for an edit instruction."""
+    # Compact line-per-paragraph extract: the whole document if it fits LLM_CONTEXT_TOKENS,
+    # otherwise a window around context_pid (or the start) plus the outline and excerpts of the rest
+    doc_context, window = llm_context.build_context(full_structure, context_pid)
         
     system_prompt = (
         "System: You are DocEdit Assistant. You will receive (1) a short user instruction, and "
-        "(2) a JSON document_extract with document structure. "
+        "(2) a document_extract with document structure, in the format described after it. "
         "Return ONLY a JSON array of edit action objects sticking to EDIT_SCHEMA. "
         "Supported actions: replace_paragraph, insert_paragraph, delete_paragraph, update_table_cell, "
         "replace_text_globally, rewrite_section, update_paragraph_style, update_style_font, clarify, noop. "
@@ -65,36 +203,113 @@ def get_edit_actions(instruction, full_structure, context_pid=None):
         "- 'section_id' required for paragraph actions.\n"
         "-For 'clarify', use 'question' (NOT 'prompt').\n"
         "- For 'update_paragraph_style', use 'style_type' (NOT 'new_type'). Enum: h1, h2, h3, list_item.\n"
+        "- For 'replace_text_globally', set 'case_sensitive' (default true) and 'whole_word' (default false) explicitly. Emit all replacements together.\n"
         "- Do not return markdown code fences. JSON only.\n"
     )
     
-    prompt = f"User Instruction: {instruction}\n\nDocument Extract: {json.dumps(doc_context)}"
-    
+    extract = f"{doc_context}\n\n{llm_context.FORMAT_NOTE}"
+    if window["windowed"]:
+        extract += f"\n{llm_context.WINDOW_NOTE}"
+    prompt = f"User Instruction: {instruction}\n\nDocument Extract:\n{extract}"
+    print(f"DEBUG: Prompt ~{llm_context.estimate_tokens(system_prompt + prompt)} tokens, document extract "
+          f"~{window['tokens']} (whole document as JSON ~{window['json_tokens']}, "
+          f"{1 - window['tokens'] / max(window['json_tokens'], 1):.0%} saved)"
+          + (f", windowed: {len(window['paragraphs'])} paragraphs in full" if window["windowed"] else ""))
+    return system_prompt, extract, prompt
+
+def _mock_actions(instruction):
     # Mock response if no API Key (for testing/safety)
-    if not GEMINI_API_KEY or GEMINI_API_KEY == "your_api_key_here":
-         # Fallback mock for testing
-         if "Acme" in instruction:
-             return [{"action":"replace_text_globally","old_text":"Acme","new_text":"AcmeCorp","case_sensitive":False}]
-         return [{"action": "noop", "reason": "API Key missing"}]
-
-    headers = {"Content-Type": "application/json"}
-    data = {
+    if GEMINI_API_KEY and GEMINI_API_KEY != "your_api_key_here":
+        return None
+    if "Acme" in instruction:
+        return [{"action":"replace_text_globally","old_text":"Acme","new_text":"AcmeCorp","case_sensitive":False}]
+    return [{"action": "noop", "reason": "API Key missing"}]
+
+def _request_data(system_prompt, prompt):
+    return {
         "contents": [{
             "parts": [{"text": system_prompt + "\n\n" + prompt}]
         }],
-        "generationConfig": {
-            "temperature": 0.4, # Slightly higher for creativity/length
-            "maxOutputTokens": 8192,
-        }
+        "generationConfig": GENERATION_CONFIG
     }
+
+def _log_usage(usage):
+    if usage:
+        print(f"DEBUG: Gemini tokens: prompt {usage.get('promptTokenCount')}, response {usage.get('candidatesTokenCount')}")
+
+def _fix_action(action):
+    # ROBUSTNESS FIX: Auto-correct common LLM schema errors
+    if not isinstance(action, dict):
+        return action
+    # Fix commonly hallucinated 'op' key
+    if 'op' in action and 'action' not in action:
+        print("DEBUG: Auto-correcting 'op' to 'action'")
+        action['action'] = action.pop('op')
+
+    if action.get('action') == 'clarify' and 'prompt' in action and 'question' not in action:
+        print("DEBUG: Auto-correcting 'prompt' to 'question' in clarify action")
+        action['question'] = action.pop('prompt')
+
+    # Fix type codes echoed from the compact extract ("li" for list_item)
+    if 'style_type' in action and action['style_type'] != llm_context.type_name(action['style_type']):
+        print(f"DEBUG: Auto-correcting style_type '{action['style_type']}'")
+        action['style_type'] = llm_context.type_name(action['style_type'])
+
+    # Fix justification enum
+    if action.get('action') == 'update_style_font' and action.get('justification') == 'justify':
+        action['justification'] = 'justified'
+    return action
+
+TRUNCATED_REASON = ("The AI response was too long and got cut off. Please try generating the report "
+                    "section-by-section (e.g., 'Generate Introduction', then 'Generate Objective') to avoid size limits.")
+
+def _salvage_actions(text):
+    # The complete, valid actions of a cut-off response
+    actions = []
+    for action in actionstream.ActionStreamParser().feed(text):
+        action = _fix_action(action)
+        try:
+            validate(instance=[action], schema=EDIT_SCHEMA)
+        except ValidationError:
+            continue
+        actions.append(action)
+    return actions
+
+def _cache_lookup(instruction, system_prompt, extract, full_structure, use_cache):
+    # (cache key or None, cached actions or None); use_cache=False skips the lookup but the
+    # fresh answer is still stored under the key
+    cache_key = response_cache_key(instruction, system_prompt, extract) if LLM_CACHE_ENABLED else None
+    if not (cache_key and use_cache):
+        return cache_key, None
+    cached = _cache_get(cache_key)
+    if cached is None:
+        return cache_key, None
+    print(f"DEBUG: LLM response cache hit {cache_key[:12]}")
+    # Ids are re-checked: the document may differ outside the extract the key covers
+    return cache_key, llm_context.check_action_ids(cached, full_structure)
+
+def get_edit_actions(instruction, full_structure, context_pid=None, use_cache=True):
+    system_prompt, extract, prompt = _build_prompt(instruction, full_structure, context_pid)
+    mock = _mock_actions(instruction)
+    if mock is not None:
+        return mock
+
+    cache_key, cached = _cache_lookup(instruction, system_prompt, extract, full_structure, use_cache)
+    if cached is not None:
+        return cached
+
+    headers = {"Content-Type": "application/json", "x-goog-api-key": GEMINI_API_KEY}
+    data = _request_data(system_prompt, prompt)
     
-    response = requests.post(API_URL, headers=headers, json=data)
+    response = llm_client.post(API_URL, headers=headers, json=data)
     if response.status_code != 200:
         raise Exception(f"Gemini API Error: {response.text}")
         
     result = response.json()
+    _log_usage(result.get("usageMetadata"))
+    raw = ""
     try:
-        text = result['candidates'][0]['content']['parts'][0]['text']
+        text = raw = result['candidates'][0]['content']['parts'][0]['text']
         print(f"DEBUG: RAW LLM RESPONSE: \n{text}\n-------------------")
         
         # Smart Extraction: Find the outer brackets of the JSON list
@@ -108,33 +323,88 @@ def get_edit_actions(instruction, full_structure, context_pid=None):
             # Fallback if no brackets found (rare)
             pass
             
-        actions = json.loads(text)
-        
-        # ROBUSTNESS FIX: Auto-correct common LLM schema errors
-        for action in actions:
-            # Fix commonly hallucinated 'op' key
-            if 'op' in action and 'action' not in action:
-                print("DEBUG: Auto-correcting 'op' to 'action'")
-                action['action'] = action.pop('op')
-
-            if action.get('action') == 'clarify' and 'prompt' in action and 'question' not in action:
-                print("DEBUG: Auto-correcting 'prompt' to 'question' in clarify action")
-                action['question'] = action.pop('prompt')
-
-            # Fix justification enum
-            if action.get('action') == 'update_style_font' and action.get('justification') == 'justify':
-                action['justification'] = 'justified'
+        actions = [_fix_action(action) for action in json.loads(text)]
         
         # Validate
         validate(instance=actions, schema=EDIT_SCHEMA)
         
+        # The model may have seen only a window: check its ids against the whole document
+        actions = llm_context.check_action_ids(actions, full_structure)
+        if cache_key:
+            _cache_put(cache_key, actions)
         return actions
     except (json.JSONDecodeError) as e:
-        # Handle truncation or malformed JSON gracefully
-        return [{
+        # Handle truncation or malformed JSON gracefully: the actions completed before the cut are kept
+        partial = _salvage_actions(raw)
+        if partial:
+            print(f"DEBUG: Kept {len(partial)} complete actions of a cut-off response")
+            partial = llm_context.check_action_ids(partial, full_structure)
+        return partial + [{
             "action": "noop", 
-            "reason": "The AI response was too long and got cut off. Please try generating the report section-by-section (e.g., 'Generate Introduction', then 'Generate Objective') to avoid size limits."
+            "reason": TRUNCATED_REASON
         }]
     except (KeyError, IndexError, ValidationError) as e:
         # Fallback to verify if it returned a clarify naturally?
         raise Exception(f"Invalid LLM Response: {e}")
+
+def stream_edit_actions(instruction, full_structure, context_pid=None, use_cache=True):
+    """
+    Streaming get_edit_actions: asks Gemini for a streamed response and yields
+    (event, data) pairs as the action array is written:
+
+      ("action", action)                      a complete action, validated and id-checked
+      ("invalid", {"action", "error"})        a complete action that failed validation, skipped
+      ("truncated", {"reason", "finish_reason"})  the response stopped before the array closed
+
+    The actions yielded before a truncation are as good as a full response's. Only
+    complete responses without invalid actions are cached.
+    """
+    system_prompt, extract, prompt = _build_prompt(instruction, full_structure, context_pid)
+    mock = _mock_actions(instruction)
+    if mock is not None:
+        for action in mock:
+            yield "action", action
+        return
+
+    cache_key, cached = _cache_lookup(instruction, system_prompt, extract, full_structure, use_cache)
+    if cached is not None:
+        for action in cached:
+            yield "action", action
+        return
+
+    headers = {"Content-Type": "application/json", "x-goog-api-key": GEMINI_API_KEY}
+    known = llm_context.known_ids(full_structure)
+    parser = actionstream.ActionStreamParser()
+    actions = []
+    clean = True
+    finish_reason = usage = None
+    with llm_client.stream(STREAM_URL, headers=headers, params={"alt": "sse"},
+                           json=_request_data(system_prompt, prompt)) as response:
+        if response.status_code != 200:
+            raise Exception(f"Gemini API Error: {response.text}")
+        for chunk in llm_client.iter_events(response):
+            usage = chunk.get("usageMetadata") or usage
+            candidate = (chunk.get("candidates") or [{}])[0]
+            finish_reason = candidate.get("finishReason") or finish_reason
+            for part in candidate.get("content", {}).get("parts", []):
+                for action in parser.feed(part.get("text", "")):
+                    action = _fix_action(action)
+                    try:
+                        validate(instance=[action], schema=EDIT_SCHEMA)
+                    except ValidationError as e:
+                        print(f"DEBUG: Skipping invalid streamed action: {e.message}")
+                        clean = False
+                        yield "invalid", {"action": action, "error": e.message}
+                        continue
+                    for action in llm_context.check_action_ids([action], full_structure, known):
+                        actions.append(action)
+                        yield "action", action
+    _log_usage(usage)
+
+    if not parser.started:
+        raise Exception(f"Invalid LLM Response: no JSON array (finish reason {finish_reason})")
+    if parser.truncated:
+        print(f"DEBUG: Streamed response cut off after {len(actions)} actions (finish reason {finish_reason})")
+        yield "truncated", {"reason": TRUNCATED_REASON, "finish_reason": finish_reason}
+    elif clean and not parser.errors and cache_key:
+        _cache_put(cache_key, actions)
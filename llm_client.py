@@ -0,0 +1,209 @@
+"""
+Shared HTTP client for the Gemini API.
+
+One pooled requests.Session per process keeps TLS connections alive between edits.
+Every call has connect and read timeouts, and 429/5xx answers and connection failures
+are retried with jittered exponential backoff (honouring Retry-After). At most
+LLM_MAX_IN_FLIGHT calls run at once per process; the rest wait up to LLM_QUEUE_TIMEOUT
+seconds and then fail with LLMBusy instead of piling up on the workers.
+
+Latencies are recorded in histograms (see stats()), served at /health/llm.
+GEMINI_API_BASE points the client at another server, e.g. a local stub:
+
+    GEMINI_API_BASE=http://127.0.0.1:8089 flask run
+"""
+import os
+import time
+import random
+import bisect
+import threading
+import json
+import requests
+from contextlib import contextmanager
+from requests.adapters import HTTPAdapter
+
+GEMINI_API_BASE = os.environ.get("GEMINI_API_BASE", "https://generativelanguage.googleapis.com").rstrip('/')
+
+LLM_CONNECT_TIMEOUT = float(os.environ.get("LLM_CONNECT_TIMEOUT", "5"))
+LLM_READ_TIMEOUT = float(os.environ.get("LLM_READ_TIMEOUT", "120"))
+LLM_MAX_RETRIES = int(os.environ.get("LLM_MAX_RETRIES", "3"))
+LLM_BACKOFF_BASE = float(os.environ.get("LLM_BACKOFF_BASE", "0.5"))
+LLM_BACKOFF_MAX = float(os.environ.get("LLM_BACKOFF_MAX", "20"))
+LLM_MAX_IN_FLIGHT = int(os.environ.get("LLM_MAX_IN_FLIGHT", "4"))
+LLM_QUEUE_TIMEOUT = float(os.environ.get("LLM_QUEUE_TIMEOUT", "30"))
+
+RETRY_STATUSES = frozenset((429, 500, 502, 503, 504))
+
+# Upper bounds in ms; the last bucket counts everything slower
+LATENCY_BUCKETS_MS = (50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000, 60000)
+
+class LLMBusy(Exception):
+    """Too many LLM calls are in flight in this process; try again later."""
+
+    def __init__(self, waited):
+        super().__init__(f"LLM service busy: no slot free after {waited:.0f}s")
+        self.retry_after = max(1, int(LLM_BACKOFF_MAX))
+
+class Histogram:
+    def __init__(self, bounds=LATENCY_BUCKETS_MS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, ms):
+        self.counts[bisect.bisect_left(self.bounds, ms)] += 1
+        self.total += ms
+        self.count += 1
+
+    def snapshot(self):
+        labels = [f"le_{b}" for b in self.bounds] + ["inf"]
+        return {
+            "count": self.count,
+            "avg_ms": round(self.total / self.count, 1) if self.count else 0.0,
+            "buckets": dict(zip(labels, self.counts)),
+        }
+
+_local_pid = None
+_session = None
+_slots = threading.BoundedSemaphore(LLM_MAX_IN_FLIGHT)
+_stats_lock = threading.Lock()
+_histograms = {}
+_counters = {"calls": 0, "attempts": 0, "retries": 0, "failures": 0, "rejected": 0, "in_flight": 0}
+
+def get_session():
+    """The process's pooled session, made anew after a fork (gunicorn --preload)."""
+    global _session, _local_pid
+    if _session is None or _local_pid != os.getpid():
+        with _stats_lock:
+            if _session is None or _local_pid != os.getpid():
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=2, pool_maxsize=max(LLM_MAX_IN_FLIGHT, 1))
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                _session, _local_pid = session, os.getpid()
+    return _session
+
+def _observe(name, ms):
+    with _stats_lock:
+        histogram = _histograms.get(name)
+        if histogram is None:
+            histogram = _histograms[name] = Histogram()
+        histogram.observe(ms)
+
+def _count(name, n=1):
+    with _stats_lock:
+        _counters[name] += n
+
+def _backoff(attempt, response=None):
+    # Full jitter; a Retry-After from the server is a lower bound
+    delay = random.uniform(0, min(LLM_BACKOFF_MAX, LLM_BACKOFF_BASE * 2 ** attempt))
+    retry_after = response.headers.get('Retry-After') if response is not None else None
+    if retry_after and retry_after.isdigit():
+        delay = max(delay, min(float(retry_after), LLM_BACKOFF_MAX))
+    return delay
+
+def model_url(model, method="generateContent"):
+    return f"{GEMINI_API_BASE}/v1beta/models/{model}:{method}"
+
+@contextmanager
+def _slot():
+    # One of the LLM_MAX_IN_FLIGHT call slots, held for the whole call (a stream until it's closed)
+    start = time.monotonic()
+    if not _slots.acquire(timeout=LLM_QUEUE_TIMEOUT):
+        _count("rejected")
+        raise LLMBusy(time.monotonic() - start)
+    _observe("queue_wait", (time.monotonic() - start) * 1000)
+    _count("calls")
+    _count("in_flight")
+    try:
+        yield
+    finally:
+        _count("in_flight", -1)
+        _slots.release()
+        _observe("call", (time.monotonic() - start) * 1000)
+
+def _send(url, json, params, headers, timeout, stream=False):
+    session = get_session()
+    timeout = timeout or (LLM_CONNECT_TIMEOUT, LLM_READ_TIMEOUT)
+    attempt = 0
+    while True:
+        attempt_start = time.monotonic()
+        _count("attempts")
+        response = None
+        try:
+            response = session.post(url, json=json, params=params, headers=headers, timeout=timeout, stream=stream)
+        except requests.ConnectionError:
+            _observe("attempt_error", (time.monotonic() - attempt_start) * 1000)
+            if attempt >= LLM_MAX_RETRIES:
+                _count("failures")
+                raise
+        except requests.RequestException:
+            _observe("attempt_error", (time.monotonic() - attempt_start) * 1000)
+            _count("failures")
+            raise
+        if response is not None:
+            ok = response.status_code < 400
+            _observe("attempt_ok" if ok else "attempt_error", (time.monotonic() - attempt_start) * 1000)
+            if response.status_code not in RETRY_STATUSES or attempt >= LLM_MAX_RETRIES:
+                if not ok:
+                    _count("failures")
+                return response
+            response.close()
+        delay = _backoff(attempt, response)
+        print(f"DEBUG: Gemini call failed ({response.status_code if response is not None else 'connection error'}), "
+              f"retry {attempt + 1}/{LLM_MAX_RETRIES} in {delay:.1f}s")
+        _count("retries")
+        time.sleep(delay)
+        attempt += 1
+
+def post(url, json=None, params=None, headers=None, timeout=None):
+    """
+    POSTs to the Gemini API through the pooled session and returns the last response.
+    Retryable statuses come back as-is once the retries are used up; connection errors
+    and timeouts are raised (read timeouts are not retried: the request may be running).
+    """
+    with _slot():
+        return _send(url, json, params, headers, timeout)
+
+@contextmanager
+def stream(url, json=None, params=None, headers=None, timeout=None):
+    """
+    Like post(), for a streamed response (e.g. streamGenerateContent?alt=sse): the body is
+    read as it arrives, with iter_events(). Only the request is retried, never a stream
+    that has started. The call holds its slot until the block exits.
+    """
+    with _slot():
+        response = _send(url, json, params, headers, timeout, stream=True)
+        try:
+            yield response
+        finally:
+            response.close()
+
+def iter_events(response):
+    """The JSON payloads of a server-sent event stream, as they arrive."""
+    start = time.monotonic()
+    first = True
+    data = []
+    # Event streams are UTF-8 by definition; requests would guess (ISO-8859-1 without a charset)
+    for line in response.iter_lines():
+        line = line.decode('utf-8')
+        if line.startswith('data:'):
+            data.append(line[5:].lstrip())
+        elif not line and data:
+            if first:
+                _observe("first_event", (time.monotonic() - start) * 1000)
+                first = False
+            yield json.loads("\n".join(data))
+            data = []
+    if data:
+        yield json.loads("\n".join(data))
+
+def stats():
+    """Counters and latency histograms (ms) of this process: call, attempt_ok/_error, queue_wait, first_event."""
+    with _stats_lock:
+        return {
+            **_counters,
+            "max_in_flight": LLM_MAX_IN_FLIGHT,
+            "latency": {name: h.snapshot() for name, h in sorted(_histograms.items())},
+        }
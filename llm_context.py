@@ -0,0 +1,318 @@
+"""
+Builds the document extract sent to the LLM, in a compact line format and within a
+token budget.
+
+The extract has one short record per line instead of the structure's JSON:
+
+    ## s3 Methodology (12 paragraphs)
+    s3_p1|h1|Methodology
+    s3_p2||The survey ran for six weeks…[+412 chars]
+    s3_t1 after s3_p4, 3x2:
+    | Site | Responses |
+
+Keys, quotes and null metadata are gone, empty spacer paragraphs are left out and long
+paragraphs are cut with a length marker. Ids are written out in full, so the ones in the
+model's reply are the structure's own.
+
+A document that fits the budget is sent whole. A larger one is windowed, in this order
+of priority:
+
+  1. the focus paragraph (the `context` of an edit) and its neighbours, in full
+  2. the outline: a header line per section, nearest the focus first
+     (sections that don't fit are summarised as skipped ranges)
+  3. excerpts of every paragraph for the sections nearest the focus
+  4. more paragraphs in full, nearest the focus first
+
+Without a focus, the start of the document counts as the focus. Token counts are
+estimates (about 4 characters per token), which is close enough to size a prompt.
+"""
+import os
+import json
+
+LLM_CONTEXT_TOKENS = int(os.environ.get("LLM_CONTEXT_TOKENS", "12000"))
+LLM_CONTEXT_NEIGHBOURS = int(os.environ.get("LLM_CONTEXT_NEIGHBOURS", "8"))
+# Longest paragraph text sent in full (the focus paragraph is never cut)
+LLM_PARAGRAPH_CHARS = int(os.environ.get("LLM_PARAGRAPH_CHARS", "2000"))
+EXCERPT_CHARS = 80
+
+FORMAT_NOTE = (
+    "Document Extract format, one record per line:\n"
+    "- '## <section_id> <title> (<n> paragraphs)' starts a section.\n"
+    "- '<paragraph_id>|<type>|<text>' is a paragraph; type is h1, h2, h3, title or li (list item), "
+    "empty for body text. Line breaks inside a paragraph are written as \\n.\n"
+    "  In actions, write style_type in full: list_item, text.\n"
+    "- Text ending in '…[+N chars]' was cut short: N more characters are not shown. "
+    "Only quote or rewrite text you can see in full.\n"
+    "- '<table_id> after <paragraph_id>, <rows>x<cols>:' starts a table, followed by one "
+    "'| cell | cell |' line per row; rows and columns are numbered from 0.\n"
+    "- Empty paragraphs are not listed.\n"
+    "Use section, paragraph and table ids exactly as written."
+)
+
+WINDOW_NOTE = (
+    "The extract is windowed: a section listing fewer paragraphs than its count shows only "
+    "some of them, a header without paragraphs lists none, and '… N sections skipped' lines "
+    "stand for sections left out. Every id in the extract can be used in actions."
+)
+
+_TYPE_CODES = {"text": "", "list_item": "li"}
+_TYPE_NAMES = {code: name for name, code in _TYPE_CODES.items()}
+
+def type_name(code):
+    """The paragraph type a compact-extract type code stands for ("li" -> "list_item")."""
+    return _TYPE_NAMES.get(code, code)
+
+def estimate_tokens(text):
+    return (len(text) + 3) // 4
+
+def _line_cost(line):
+    return estimate_tokens(line) + 1 # the newline
+
+def _clip(text, limit):
+    if limit is None or len(text) <= limit:
+        return text
+    cut = text[:limit].rsplit(' ', 1)[0] or text[:limit]
+    return f"{cut}…[+{len(text) - len(cut)} chars]"
+
+def _is_empty(p):
+    return not (p.get("text") or "").strip()
+
+def paragraph_line(p, limit=None):
+    text = (p.get("text") or "").replace("\r", "").replace("\n", "\\n")
+    return f"{p.get('id')}|{_TYPE_CODES.get(p.get('type'), p.get('type') or '')}|{_clip(text, limit)}"
+
+def section_line(sec, paragraph_count):
+    return f"## {sec.get('id')} {sec.get('title') or ''} ({paragraph_count} paragraphs)"
+
+def table_lines(t, cells=True):
+    rows = t.get("rows", [])
+    head = f"{t.get('id')} after {t.get('after_paragraph')}, {len(rows)}x{max((len(r) for r in rows), default=0)}"
+    if not cells:
+        return [head + " (cells not shown)"]
+    lines = [head + ":"]
+    for row in rows:
+        cells_text = [str(c).replace("\n", "\\n").replace("|", "\\|") for c in row]
+        lines.append("| " + " | ".join(cells_text) + " |")
+    return lines
+
+def _skipped_line(skipped):
+    return f"… {len(skipped)} sections skipped ({skipped[0]} to {skipped[-1]})"
+
+def _meta_line(meta):
+    # Counts and timestamps tell the model nothing; style definitions do
+    meta = {k: v for k, v in (meta or {}).items() if v is not None and k not in ("paragraph_count", "table_count", "created_at")}
+    return f"meta: {json.dumps(meta, ensure_ascii=False, separators=(',', ':'))}" if meta else None
+
+def build_context(structure, context_pid=None, budget=None):
+    """
+    The extract of `structure` to send with an edit request, focused on paragraph (or
+    section) `context_pid`. Returns (text, info), where info has the estimated "tokens" of
+    the text, "json_tokens" of the whole structure as JSON, "windowed" and "paragraphs"
+    (ids whose text is shown in full).
+    """
+    budget = budget if budget is not None else LLM_CONTEXT_TOKENS
+    sections = structure.get("sections", [])
+    json_tokens = estimate_tokens(json.dumps(structure, ensure_ascii=False))
+
+    # Document order of listed paragraphs, (section index, paragraph); empty ones are left out
+    flat = []
+    by_section = [[] for _ in sections]
+    focus = 0
+    focus_section = 0
+    for si, sec in enumerate(sections):
+        if context_pid is not None and sec.get("id") == context_pid:
+            focus, focus_section = len(flat), si
+        for p in sec.get("paragraphs", []):
+            if p.get("id") == context_pid:
+                focus, focus_section = len(flat), si
+            elif _is_empty(p):
+                continue
+            by_section[si].append(len(flat))
+            flat.append((si, p))
+    # A context section with no listed paragraph is anchored on its header line instead,
+    # with the nearest listed paragraphs (focus points at the next one, if any) around it
+    header_focus = context_pid is not None and not (focus < len(flat) and flat[focus][0] == focus_section)
+    focus = min(focus, max(len(flat) - 1, 0))
+
+    full_lines = [paragraph_line(p, None if p.get("id") == context_pid else LLM_PARAGRAPH_CHARS) for _, p in flat]
+    excerpt_lines = [paragraph_line(p, EXCERPT_CHARS) for _, p in flat]
+    full_cost = [_line_cost(line) for line in full_lines]
+    excerpt_cost = [_line_cost(line) for line in excerpt_lines]
+    header_lines = [section_line(sec, len(by_section[si])) for si, sec in enumerate(sections)]
+    meta_line = _meta_line(structure.get("meta"))
+
+    # Tables by the listed paragraph they follow; the others (after an empty paragraph) by section
+    index_of = {p.get("id"): i for i, (_, p) in enumerate(flat)}
+    anchored = {}
+    unanchored = [[] for _ in sections]
+    for si, sec in enumerate(sections):
+        for t in sec.get("tables", []):
+            i = index_of.get(t.get("after_paragraph"))
+            if i is not None and flat[i][0] == si:
+                anchored.setdefault(i, []).append(t)
+            else:
+                unanchored[si].append(t)
+
+    def tables_cost(tables, cells):
+        return sum(_line_cost(line) for t in tables for line in table_lines(t, cells))
+
+    def render(full, outlined, excerpted, cells):
+        lines = [meta_line] if meta_line else []
+        shown = []
+        skipped = []
+        for si, sec in enumerate(sections):
+            if si not in outlined:
+                skipped.append(sec.get("id"))
+                continue
+            if skipped:
+                lines.append(_skipped_line(skipped))
+                skipped = []
+            lines.append(header_lines[si])
+            for i in by_section[si]:
+                if i in full or (si in excerpted and excerpt_lines[i] == full_lines[i]):
+                    lines.append(full_lines[i])
+                    shown.append(flat[i][1].get("id"))
+                elif si in excerpted:
+                    lines.append(excerpt_lines[i])
+                else:
+                    continue
+                for t in anchored.get(i, []):
+                    lines.extend(table_lines(t, cells=i in cells))
+            if si in excerpted:
+                for t in unanchored[si]:
+                    lines.extend(table_lines(t, cells=False))
+        if skipped:
+            lines.append(_skipped_line(skipped))
+        return "\n".join(lines), shown
+
+    everything = set(range(len(sections)))
+    every_paragraph = set(range(len(flat)))
+    text, shown = render(every_paragraph, everything, everything, every_paragraph)
+    if estimate_tokens(text) <= budget:
+        return text, {"tokens": estimate_tokens(text), "json_tokens": json_tokens, "windowed": False, "paragraphs": shown}
+
+    used = _line_cost(meta_line) if meta_line else 0
+    full = set()       # indexes into flat
+    cells = set()      # indexes into flat whose tables are sent with their cells
+    outlined = set()   # section indexes with a header line
+    excerpted = set()  # section indexes with every paragraph at least excerpted
+
+    def add_full(i, force=False):
+        nonlocal used
+        si = flat[i][0]
+        extra = full_cost[i]
+        if si in excerpted:
+            extra -= excerpt_cost[i] # its table headers are counted already
+        else:
+            extra += tables_cost(anchored.get(i, []), cells=False)
+        if si not in outlined:
+            extra += _line_cost(header_lines[si])
+        if used + extra > budget and not force:
+            return False
+        full.add(i)
+        outlined.add(si)
+        used += extra
+        if i in anchored:
+            extra = tables_cost(anchored[i], cells=True) - tables_cost(anchored[i], cells=False)
+            if used + extra <= budget:
+                cells.add(i)
+                used += extra
+        return True
+
+    by_distance = sorted(range(len(flat)), key=lambda i: (abs(i - focus), i))
+    sections_by_distance = sorted(range(len(sections)), key=lambda s: (abs(s - focus_section), s))
+
+    # 1. Focus, always (clipped to what's left of the budget if it doesn't fit), then neighbours
+    if header_focus:
+        outlined.add(focus_section)
+        used += _line_cost(header_lines[focus_section])
+    elif flat and not add_full(focus):
+        si, p = flat[focus]
+        overhead = _line_cost(paragraph_line(dict(p, text=""))) + _line_cost("…[+1000000 chars]")
+        overhead += _line_cost(header_lines[si]) + tables_cost(anchored.get(focus, []), cells=False)
+        full_lines[focus] = paragraph_line(p, max((budget - used - overhead) * 4, EXCERPT_CHARS))
+        full_cost[focus] = _line_cost(full_lines[focus])
+        add_full(focus, force=True)
+    for i in by_distance:
+        if abs(i - focus) > LLM_CONTEXT_NEIGHBOURS:
+            break
+        if i != focus or header_focus:
+            add_full(i)
+
+    # 2. Outline, nearest sections first; the rest is summarised as skipped ranges
+    for si in sections_by_distance:
+        if si not in outlined and used + _line_cost(header_lines[si]) <= budget:
+            outlined.add(si)
+            used += _line_cost(header_lines[si])
+
+    # 3. Excerpts, nearest sections first (tables as a header line only)
+    for si in sections_by_distance:
+        if si not in outlined:
+            continue
+        extra = sum(excerpt_cost[i] + tables_cost(anchored.get(i, []), cells=False)
+                    for i in by_section[si] if i not in full)
+        extra += tables_cost(unanchored[si], cells=False)
+        if used + extra <= budget:
+            excerpted.add(si)
+            used += extra
+
+    # 4. More paragraphs in full, in sections already shown
+    for i in by_distance:
+        if i not in full and flat[i][0] in outlined:
+            add_full(i)
+
+    text, shown = render(full, outlined, excerpted, cells)
+    return text, {"tokens": estimate_tokens(text), "json_tokens": json_tokens, "windowed": True, "paragraphs": shown}
+
+def known_ids(structure):
+    """(section ids, paragraph ids, table ids) of `structure`, for check_action_ids."""
+    sections = set()
+    paragraphs = set()
+    tables = set()
+    for sec in structure.get("sections", []):
+        sections.add(sec.get("id"))
+        paragraphs.update(p.get("id") for p in sec.get("paragraphs", []))
+        tables.update(t.get("id") for t in sec.get("tables", []))
+    return sections, paragraphs, tables
+
+def _map_id(value, known):
+    # Ids copied with a bit of their record around them ("s2_p4|h2", " s2_p4") map back to the id
+    if value in known or not isinstance(value, str):
+        return value
+    candidate = value.split('|', 1)[0].strip()
+    return candidate if candidate in known else value
+
+def check_action_ids(actions, structure, known=None):
+    """
+    Checks the ids in `actions` against the full `structure`, since the model may have
+    seen only part of it. Ids outside the window are fine as long as they exist.
+    Ids copied with part of their extract record are mapped back to the plain id.
+    An action whose target (paragraph, table, or section for section-level actions)
+    doesn't exist becomes a noop saying so; an unknown insertion anchor is dropped, so
+    the paragraph is appended to its section as the applyer does for a missing anchor.
+    `known` is known_ids(structure), passed in when checking actions one at a time.
+    """
+    sections, paragraphs, tables = known or known_ids(structure)
+    checked = []
+    for action in actions:
+        for key, ids in (("section_id", sections), ("paragraph_id", paragraphs), ("after_paragraph_id", paragraphs),
+                         ("before_paragraph_id", paragraphs), ("table_id", tables)):
+            if key in action and action[key] not in ids:
+                action = dict(action, **{key: _map_id(action[key], ids)})
+        unknown = None
+        if action.get("action") in ("insert_paragraph", "rewrite_section") and action.get("section_id") not in sections:
+            unknown = f"section {action.get('section_id')}"
+        elif "paragraph_id" in action and action["paragraph_id"] not in paragraphs:
+            unknown = f"paragraph {action['paragraph_id']}"
+        elif "table_id" in action and action["table_id"] not in tables:
+            unknown = f"table {action['table_id']}"
+        if unknown:
+            print(f"DEBUG: Dropping {action.get('action')} action for unknown {unknown}")
+            checked.append({"action": "noop", "reason": f"Unknown {unknown}"})
+            continue
+        for key in ("after_paragraph_id", "before_paragraph_id"):
+            if key in action and action[key] not in paragraphs:
+                print(f"DEBUG: Ignoring unknown {key} {action[key]}")
+                action = {k: v for k, v in action.items() if k != key}
+        checked.append(action)
+    return checked
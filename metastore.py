@@ -0,0 +1,501 @@
+"""
+Storage backends for document metadata: structure manifests and revision snapshots,
+sections, history, head revision, revision counter and patch layouts.
+
+DOCX files, revision parts and PDF previews always stay on the filesystem in the
+document directory (see docpaths and revstore); only the metadata goes through a backend.
+STORAGE_BACKEND selects it:
+
+  files   (default) JSON files in the document directory, read through jsoncache
+  sqlite  one SQLite database in WAL mode (data/metadata.sqlite3), indexed by document
+          and revision. Paragraphs are rows of their own, keyed by content hash, and the
+          paragraph order of a section and the layout of a revision are stored in
+          content-defined chunks, so a one-paragraph edit stores one new paragraph row and
+          the chunk around it next to the section, snapshot and history rows, all in a
+          single transaction.
+
+Both backends are called with the document lock held for writes (see storage.document_lock)
+and keep the same contract: read methods raise FileNotFoundError for a missing document
+or revision, values returned may be shared with a read cache and must not be modified.
+Documents are not migrated between backends.
+"""
+import os
+import json
+import sqlite3
+import tempfile
+import threading
+import zlib
+import hashlib
+from contextlib import contextmanager
+from doc_editor import jsoncache, docpaths, serialization
+
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "files")
+SQLITE_BUSY_TIMEOUT = float(os.environ.get("SQLITE_BUSY_TIMEOUT", "30"))
+
+class FileMetaStore:
+    """
+    In the document directory (see docpaths):
+    structure.json      head manifest: meta plus {id, title, hash} per section
+    sections/<hash>.json or .bin  (by codec, see serialization)
+    revisions/<rev>.structure.json, <rev>.layout.json
+    history.json, HEAD, REV_COUNTER
+    """
+
+    def __init__(self, base_dir):
+        self.base_dir = base_dir
+
+    def _path(self, doc_id, *parts):
+        return os.path.join(docpaths.get_doc_dir(self.base_dir, doc_id), *parts)
+
+    def get_snapshot_path(self, doc_id, rev_id):
+        return self._path(doc_id, 'revisions', f'{rev_id}.structure.json')
+
+    def get_layout_path(self, doc_id, rev_id):
+        return self._path(doc_id, 'revisions', f'{rev_id}.layout.json')
+
+    def get_sections_dir(self, doc_id):
+        return self._path(doc_id, 'sections')
+
+    @contextmanager
+    def transaction(self):
+        # Every file is replaced atomically on its own; there is nothing to group
+        yield
+
+    def create_document(self, doc_id, created):
+        pass # the document directory is all there is
+
+    def list_documents(self):
+        return sorted(doc_id for doc_id, path, _ in docpaths.iter_doc_dirs(self.base_dir)
+                      if os.path.exists(os.path.join(path, 'history.json')))
+
+    # Structure
+
+    def read_manifest(self, doc_id, rev_id=None):
+        if rev_id is None:
+            return jsoncache.read_json(self._path(doc_id, 'structure.json'))
+        return jsoncache.read_json(self.get_snapshot_path(doc_id, rev_id))
+
+    def write_manifest(self, doc_id, manifest, rev_id=None):
+        if rev_id is not None:
+            jsoncache.write_json(self.get_snapshot_path(doc_id, rev_id), manifest)
+        jsoncache.write_json(self._path(doc_id, 'structure.json'), manifest)
+
+    def has_snapshot(self, doc_id, rev_id):
+        return os.path.exists(self.get_snapshot_path(doc_id, rev_id))
+
+    def put_section(self, doc_id, section_hash, data, section):
+        sections_dir = self.get_sections_dir(doc_id)
+        path = os.path.join(sections_dir, section_hash + serialization.codec_of(data).suffix)
+        if os.path.exists(path):
+            return
+        os.makedirs(sections_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=sections_dir, suffix='.part')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def load_section(self, doc_id, section_hash):
+        sections_dir = self.get_sections_dir(doc_id)
+        for suffix in serialization.suffixes():
+            try:
+                return jsoncache.read_decoded(os.path.join(sections_dir, section_hash + suffix), serialization.decode)
+            except FileNotFoundError:
+                continue
+        raise FileNotFoundError(f"Section {section_hash} of document {doc_id} not found")
+
+    def collect_section_garbage(self, doc_id):
+        # Deletes section files that neither the head nor any revision snapshot references
+        manifests = [self._path(doc_id, 'structure.json')]
+        manifests += [e.path for e in os.scandir(self._path(doc_id, 'revisions')) if e.name.endswith('.structure.json')]
+        referenced = set()
+        for path in manifests:
+            try:
+                manifest = jsoncache.read_json(path)
+            except FileNotFoundError:
+                continue
+            referenced.update(e["hash"] for e in manifest.get("sections", []) if "hash" in e)
+
+        removed = 0
+        for entry in os.scandir(self.get_sections_dir(doc_id)):
+            section_hash, suffix = os.path.splitext(entry.name)
+            if suffix in serialization.suffixes() and section_hash not in referenced:
+                try:
+                    os.remove(entry.path)
+                    removed += 1
+                except FileNotFoundError:
+                    pass
+        return removed
+
+    # Revisions
+
+    def get_history(self, doc_id):
+        return jsoncache.read_json(self._path(doc_id, 'history.json'))
+
+    def append_history(self, doc_id, entry, limit):
+        """Appends `entry`, keeping the newest `limit` entries. Returns the new history."""
+        try:
+            history = list(self.get_history(doc_id)) # the cached list is shared
+        except FileNotFoundError:
+            history = []
+        history.append(entry)
+        history = history[-limit:]
+        jsoncache.write_json(self._path(doc_id, 'history.json'), history)
+        return history
+
+    def get_head(self, doc_id):
+        try:
+            return jsoncache.read_text(self._path(doc_id, 'HEAD')).strip()
+        except FileNotFoundError:
+            return None
+
+    def set_head(self, doc_id, rev_id):
+        jsoncache.write_text(self._path(doc_id, 'HEAD'), rev_id)
+
+    def next_revision_id(self, doc_id):
+        # Documents that predate the counter continue after their newest (timestamp) revision id
+        path = self._path(doc_id, 'REV_COUNTER')
+        try:
+            last = int(jsoncache.read_text(path))
+        except FileNotFoundError:
+            last = max((int(h["rev_id"]) for h in self.get_history(doc_id) if h["rev_id"].isdigit()), default=0)
+        rev_id = str(last + 1)
+        jsoncache.write_text(path, rev_id)
+        return rev_id
+
+    def read_layout(self, doc_id, rev_id):
+        try:
+            return jsoncache.read_json(self.get_layout_path(doc_id, rev_id))
+        except FileNotFoundError:
+            return None
+
+    def write_layout(self, doc_id, rev_id, layout):
+        jsoncache.write_json(self.get_layout_path(doc_id, rev_id), layout)
+
+    def drop_revisions(self, doc_id, live_rev_ids):
+        """Deletes the metadata of revisions not in `live_rev_ids`; returns their ids."""
+        dead = set()
+        for entry in os.scandir(self._path(doc_id, 'revisions')):
+            for suffix in ('.structure.json', '.layout.json'):
+                if entry.name.endswith(suffix):
+                    rev_id = entry.name[:-len(suffix)]
+                    if rev_id not in live_rev_ids:
+                        os.remove(entry.path)
+                        jsoncache.invalidate(entry.path)
+                        dead.add(rev_id)
+        return dead
+
+class SQLiteMetaStore:
+    """
+    Metadata in one SQLite database. Sections are stored with their paragraphs replaced
+    by the chunks (see _put_chunks) of their paragraph hash list; the paragraphs
+    themselves are rows keyed by (doc_id, hash). Both are encoded with STRUCTURE_CODEC
+    (see serialization). Revision layouts are stored as chunks too, so a one-paragraph
+    edit writes the paragraph row and the chunks around it rather than every paragraph
+    hash of its section and the layout of the whole document.
+    Connections are per thread; the database runs in WAL mode so readers never wait
+    for a writer.
+    """
+
+    # Average number of list items per chunk
+    CHUNK_ITEMS = 64
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS documents (
+        doc_id TEXT PRIMARY KEY,
+        created REAL,
+        head_rev TEXT,
+        rev_counter INTEGER NOT NULL DEFAULT 0,
+        manifest TEXT
+    );
+    CREATE TABLE IF NOT EXISTS revisions (
+        doc_id TEXT NOT NULL,
+        rev_id TEXT NOT NULL,
+        manifest TEXT,
+        layout TEXT,
+        PRIMARY KEY (doc_id, rev_id)
+    ) WITHOUT ROWID;
+    CREATE TABLE IF NOT EXISTS history (
+        id INTEGER PRIMARY KEY,
+        doc_id TEXT NOT NULL,
+        rev_id TEXT NOT NULL,
+        entry TEXT NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS history_doc ON history (doc_id, id);
+    CREATE TABLE IF NOT EXISTS sections (
+        doc_id TEXT NOT NULL,
+        hash TEXT NOT NULL,
+        data BLOB NOT NULL,
+        PRIMARY KEY (doc_id, hash)
+    ) WITHOUT ROWID;
+    CREATE TABLE IF NOT EXISTS paragraphs (
+        doc_id TEXT NOT NULL,
+        hash TEXT NOT NULL,
+        data BLOB NOT NULL,
+        PRIMARY KEY (doc_id, hash)
+    ) WITHOUT ROWID;
+    CREATE TABLE IF NOT EXISTS chunks (
+        doc_id TEXT NOT NULL,
+        hash TEXT NOT NULL,
+        data TEXT NOT NULL,
+        PRIMARY KEY (doc_id, hash)
+    ) WITHOUT ROWID;
+    """
+
+    def __init__(self, base_dir):
+        self.base_dir = base_dir
+        self.path = os.path.join(base_dir, 'metadata.sqlite3')
+        self._local = threading.local()
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            os.makedirs(self.base_dir, exist_ok=True)
+            # Autocommit; transaction() groups statements explicitly
+            conn = sqlite3.connect(self.path, timeout=SQLITE_BUSY_TIMEOUT, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(self.SCHEMA)
+            self._local.conn = conn
+            self._local.depth = 0
+        return conn
+
+    @contextmanager
+    def transaction(self):
+        """Groups the writes made inside it into one transaction (nested calls join the outer one)."""
+        conn = self._conn()
+        if self._local.depth:
+            self._local.depth += 1
+            try:
+                yield
+            finally:
+                self._local.depth -= 1
+            return
+        conn.execute("BEGIN IMMEDIATE")
+        self._local.depth = 1
+        try:
+            yield
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        finally:
+            self._local.depth = 0
+
+    def _one(self, sql, params):
+        return self._conn().execute(sql, params).fetchone()
+
+    def _document(self, doc_id, column):
+        row = self._one(f"SELECT {column} FROM documents WHERE doc_id = ?", (doc_id,))
+        if row is None:
+            raise FileNotFoundError(f"Document {doc_id} not found")
+        return row[0]
+
+    def _put_chunks(self, doc_id, items, key):
+        """
+        Stores list `items` as content-defined chunks and returns their hashes. A chunk ends
+        after an item whose key(item) hashes to 0 mod CHUNK_ITEMS, so editing an item only
+        changes the chunk around it: the others are the rows earlier versions of the list
+        already wrote.
+        """
+        chunks = [[]]
+        for item in items:
+            chunks[-1].append(item)
+            if zlib.crc32(key(item).encode('utf-8')) % self.CHUNK_ITEMS == 0:
+                chunks.append([])
+        if not chunks[-1]:
+            chunks.pop()
+        rows = []
+        for chunk in chunks:
+            data = json.dumps(chunk, separators=(',', ':'))
+            rows.append((doc_id, hashlib.sha256(data.encode('utf-8')).hexdigest(), data))
+        self._conn().executemany("INSERT OR IGNORE INTO chunks (doc_id, hash, data) VALUES (?, ?, ?)", rows)
+        return [row[1] for row in rows]
+
+    def _load_rows(self, table, doc_id, hashes):
+        # hash -> data for the distinct `hashes`, staying below SQLite's bound parameter limit
+        unique = list(set(hashes))
+        found = {}
+        for i in range(0, len(unique), 500):
+            chunk = unique[i:i + 500]
+            placeholders = ",".join("?" * len(chunk))
+            found.update(self._conn().execute(
+                f"SELECT hash, data FROM {table} WHERE doc_id = ? AND hash IN ({placeholders})", [doc_id] + chunk))
+        return found
+
+    def _load_chunks(self, doc_id, hashes):
+        # The list _put_chunks stored as `hashes`
+        found = self._load_rows("chunks", doc_id, hashes)
+        items = []
+        for h in hashes:
+            items.extend(json.loads(found[h]))
+        return items
+
+    def _paragraph_hashes(self, doc_id, skeleton):
+        # Sections written before paragraph lists were chunked list the hashes themselves
+        if "paragraph_chunks" in skeleton:
+            return self._load_chunks(doc_id, skeleton["paragraph_chunks"])
+        return skeleton.get("paragraphs", [])
+
+    def create_document(self, doc_id, created):
+        self._conn().execute("INSERT OR IGNORE INTO documents (doc_id, created) VALUES (?, ?)", (doc_id, created))
+
+    def list_documents(self):
+        return [r[0] for r in self._conn().execute("SELECT doc_id FROM documents ORDER BY doc_id")]
+
+    # Structure
+
+    def read_manifest(self, doc_id, rev_id=None):
+        if rev_id is None:
+            data = self._document(doc_id, "manifest")
+        else:
+            row = self._one("SELECT manifest FROM revisions WHERE doc_id = ? AND rev_id = ?", (doc_id, rev_id))
+            data = row[0] if row is not None else None
+        if data is None:
+            raise FileNotFoundError(f"No structure for document {doc_id} revision {rev_id or 'head'}")
+        return json.loads(data)
+
+    def write_manifest(self, doc_id, manifest, rev_id=None):
+        data = json.dumps(manifest)
+        with self.transaction():
+            conn = self._conn()
+            if rev_id is not None:
+                conn.execute("INSERT INTO revisions (doc_id, rev_id, manifest) VALUES (?, ?, ?) "
+                             "ON CONFLICT (doc_id, rev_id) DO UPDATE SET manifest = excluded.manifest",
+                             (doc_id, rev_id, data))
+            conn.execute("UPDATE documents SET manifest = ? WHERE doc_id = ?", (data, doc_id))
+
+    def has_snapshot(self, doc_id, rev_id):
+        row = self._one("SELECT manifest IS NOT NULL FROM revisions WHERE doc_id = ? AND rev_id = ?", (doc_id, rev_id))
+        return bool(row and row[0])
+
+    def put_section(self, doc_id, section_hash, data, section):
+        conn = self._conn()
+        if self._one("SELECT 1 FROM sections WHERE doc_id = ? AND hash = ?", (doc_id, section_hash)):
+            return
+        paragraph_rows = []
+        paragraph_hashes = []
+        for p in section.get("paragraphs", []):
+            p_data = serialization.encode(p)
+            p_hash = hashlib.sha256(p_data).hexdigest()
+            paragraph_rows.append((doc_id, p_hash, p_data))
+            paragraph_hashes.append(p_hash)
+        skeleton = {k: v for k, v in section.items() if k != "paragraphs"}
+        with self.transaction():
+            conn.executemany("INSERT OR IGNORE INTO paragraphs (doc_id, hash, data) VALUES (?, ?, ?)", paragraph_rows)
+            skeleton["paragraph_chunks"] = self._put_chunks(doc_id, paragraph_hashes, lambda h: h)
+            conn.execute("INSERT OR IGNORE INTO sections (doc_id, hash, data) VALUES (?, ?, ?)",
+                         (doc_id, section_hash, serialization.encode(skeleton)))
+
+    def load_section(self, doc_id, section_hash):
+        row = self._one("SELECT data FROM sections WHERE doc_id = ? AND hash = ?", (doc_id, section_hash))
+        if row is None:
+            raise FileNotFoundError(f"Section {section_hash} of document {doc_id} not found")
+        section = serialization.decode(row[0])
+        hashes = self._paragraph_hashes(doc_id, section)
+        section.pop("paragraph_chunks", None)
+        paragraphs = self._load_rows("paragraphs", doc_id, hashes)
+        # Identical paragraphs share a row but each gets its own object
+        section["paragraphs"] = [serialization.decode(paragraphs[h]) for h in hashes]
+        return section
+
+    def collect_section_garbage(self, doc_id):
+        conn = self._conn()
+        referenced = set()
+        manifests = [r[0] for r in conn.execute("SELECT manifest FROM revisions WHERE doc_id = ? AND manifest IS NOT NULL", (doc_id,))]
+        manifests += [r[0] for r in conn.execute("SELECT manifest FROM documents WHERE doc_id = ? AND manifest IS NOT NULL", (doc_id,))]
+        for data in manifests:
+            referenced.update(e["hash"] for e in json.loads(data).get("sections", []) if "hash" in e)
+
+        with self.transaction():
+            dead = [(doc_id, h) for (h,) in conn.execute("SELECT hash FROM sections WHERE doc_id = ?", (doc_id,))
+                    if h not in referenced]
+            conn.executemany("DELETE FROM sections WHERE doc_id = ? AND hash = ?", dead)
+            # Chunks of the live sections' paragraph lists and of the retained revisions' layouts
+            live_paragraphs = set()
+            live_chunks = set()
+            for (data,) in conn.execute("SELECT data FROM sections WHERE doc_id = ?", (doc_id,)):
+                skeleton = serialization.decode(data)
+                live_chunks.update(skeleton.get("paragraph_chunks", []))
+                live_paragraphs.update(self._paragraph_hashes(doc_id, skeleton))
+            for (data,) in conn.execute("SELECT layout FROM revisions WHERE doc_id = ? AND layout IS NOT NULL", (doc_id,)):
+                layout = json.loads(data)
+                if isinstance(layout, dict):
+                    live_chunks.update(layout["chunks"])
+            conn.executemany("DELETE FROM paragraphs WHERE doc_id = ? AND hash = ?",
+                             [(doc_id, h) for (h,) in conn.execute("SELECT hash FROM paragraphs WHERE doc_id = ?", (doc_id,))
+                              if h not in live_paragraphs])
+            conn.executemany("DELETE FROM chunks WHERE doc_id = ? AND hash = ?",
+                             [(doc_id, h) for (h,) in conn.execute("SELECT hash FROM chunks WHERE doc_id = ?", (doc_id,))
+                              if h not in live_chunks])
+        return len(dead)
+
+    # Revisions
+
+    def get_history(self, doc_id):
+        self._document(doc_id, "doc_id")
+        return [json.loads(entry) for (entry,) in self._conn().execute(
+            "SELECT entry FROM history WHERE doc_id = ? ORDER BY id", (doc_id,))]
+
+    def append_history(self, doc_id, entry, limit):
+        conn = self._conn()
+        with self.transaction():
+            conn.execute("INSERT INTO history (doc_id, rev_id, entry) VALUES (?, ?, ?)",
+                         (doc_id, entry["rev_id"], json.dumps(entry)))
+            conn.execute("DELETE FROM history WHERE doc_id = ? AND id NOT IN "
+                         "(SELECT id FROM history WHERE doc_id = ? ORDER BY id DESC LIMIT ?)",
+                         (doc_id, doc_id, limit))
+        return self.get_history(doc_id)
+
+    def get_head(self, doc_id):
+        row = self._one("SELECT head_rev FROM documents WHERE doc_id = ?", (doc_id,))
+        return row[0] if row is not None else None
+
+    def set_head(self, doc_id, rev_id):
+        self._conn().execute("UPDATE documents SET head_rev = ? WHERE doc_id = ?", (rev_id, doc_id))
+
+    def next_revision_id(self, doc_id):
+        with self.transaction():
+            self._conn().execute("UPDATE documents SET rev_counter = rev_counter + 1 WHERE doc_id = ?", (doc_id,))
+            return str(self._document(doc_id, "rev_counter"))
+
+    def read_layout(self, doc_id, rev_id):
+        row = self._one("SELECT layout FROM revisions WHERE doc_id = ? AND rev_id = ?", (doc_id, rev_id))
+        if row is None or row[0] is None:
+            return None
+        layout = json.loads(row[0])
+        # Layouts written before they were chunked are the list itself
+        return self._load_chunks(doc_id, layout["chunks"]) if isinstance(layout, dict) else layout
+
+    def write_layout(self, doc_id, rev_id, layout):
+        with self.transaction():
+            chunks = self._put_chunks(doc_id, layout, lambda run: str(run[0]))
+            self._conn().execute("INSERT INTO revisions (doc_id, rev_id, layout) VALUES (?, ?, ?) "
+                                 "ON CONFLICT (doc_id, rev_id) DO UPDATE SET layout = excluded.layout",
+                                 (doc_id, rev_id, json.dumps({"chunks": chunks})))
+
+    def drop_revisions(self, doc_id, live_rev_ids):
+        conn = self._conn()
+        with self.transaction():
+            dead = [r for (r,) in conn.execute("SELECT rev_id FROM revisions WHERE doc_id = ?", (doc_id,))
+                    if r not in live_rev_ids]
+            conn.executemany("DELETE FROM revisions WHERE doc_id = ? AND rev_id = ?", [(doc_id, r) for r in dead])
+        return set(dead)
+
+BACKENDS = {
+    "files": FileMetaStore,
+    "sqlite": SQLiteMetaStore,
+}
+
+_instances = {}
+_instances_lock = threading.Lock()
+
+def get_metastore(base_dir, backend=None):
+    """The metadata backend for the data directory `base_dir` (STORAGE_BACKEND by default)."""
+    backend = backend or STORAGE_BACKEND
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown STORAGE_BACKEND {backend!r}; expected one of {', '.join(BACKENDS)}")
+    key = (backend, base_dir)
+    with _instances_lock:
+        if key not in _instances:
+            _instances[key] = BACKENDS[backend](base_dir)
+        return _instances[key]
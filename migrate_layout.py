@@ -0,0 +1,64 @@
+"""
+Moves documents from the flat data/<doc_id>/ layout into the sharded data/ab/cd/<doc_id>/
+one (see docpaths).
+
+It can run while the app is serving. Each document is moved with a single rename,
+made while holding the document's lock, so no save or restore is cut in half and
+ones waiting for the lock continue in the new location. A read that resolved the
+old path just before the rename may fail once and succeed when retried.
+Ids and metadata don't change, so this works with either storage backend.
+
+    python -m doc_editor.migrate_layout [--data-dir data] [--dry-run]
+"""
+import os
+import sys
+import fcntl
+import argparse
+from doc_editor import docpaths
+
+def migrate_document(base_dir, doc_id, flat_path):
+    """Moves one flat document directory into its shard. Returns the new path."""
+    target = docpaths.shard_dir(base_dir, doc_id)
+    with open(os.path.join(flat_path, '.lock'), 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            if os.path.exists(target):
+                raise FileExistsError(f"{target} already exists, not moving {flat_path}")
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            os.rename(flat_path, target)
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+    return target
+
+def migrate(base_dir, dry_run=False):
+    """Migrates every flat document directory under `base_dir`. Returns (moved, failed)."""
+    # Collect first: renaming while scanning base_dir would change what the scan sees
+    flat = [(doc_id, path) for doc_id, path, sharded in docpaths.iter_doc_dirs(base_dir)
+            if not sharded and os.path.exists(os.path.join(path, 'original.docx'))]
+    moved = failed = 0
+    for doc_id, path in flat:
+        if dry_run:
+            print(f"{path} -> {docpaths.shard_dir(base_dir, doc_id)}")
+            moved += 1
+            continue
+        try:
+            migrate_document(base_dir, doc_id, path)
+            moved += 1
+        except OSError as e:
+            print(f"Skipping {doc_id}: {e}", file=sys.stderr)
+            failed += 1
+    return moved, failed
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Move documents into the sharded data directory layout.")
+    parser.add_argument('--data-dir', default=os.path.join(os.getcwd(), 'data'))
+    parser.add_argument('--dry-run', action='store_true', help="only list the moves")
+    args = parser.parse_args(argv)
+
+    moved, failed = migrate(args.data_dir, dry_run=args.dry_run)
+    verb = "Would move" if args.dry_run else "Moved"
+    print(f"{verb} {moved} documents, {failed} failed")
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
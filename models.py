@@ -57,7 +57,8 @@ EDIT_SCHEMA = {
                     "action": {"const": "replace_text_globally"},
                     "old_text": {"type": "string"},
                     "new_text": {"type": "string"},
-                    "case_sensitive": {"type": "boolean"}
+                    "case_sensitive": {"type": "boolean"},
+                    "whole_word": {"type": "boolean"}
                 },
                 "required": ["action", "old_text", "new_text"]
             },
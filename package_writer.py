@@ -0,0 +1,110 @@
+"""
+Zip-level passthrough writer for DOCX packages.
+
+python-docx's Document.save() re-compresses every part of the package, including
+embedded images and fonts that never change between revisions. save_document()
+writes the same package, but any part whose bytes are identical to a member of
+the source file (same size and CRC-32) is copied over as its raw compressed
+bytes; only parts that actually changed (typically word/document.xml, sometimes
+word/styles.xml or a new image) go through the compressor.
+"""
+import os
+import struct
+import zipfile
+import zlib
+from docx.opc.pkgwriter import PackageWriter
+
+# zlib level for the parts we do re-compress: 1 = fastest / biggest, 9 = slowest / smallest
+DOCX_COMPRESS_LEVEL = int(os.environ.get("DOCX_COMPRESS_LEVEL", "6"))
+
+_LOCAL_HEADER = struct.Struct("<4s5H3L2H")
+_DATA_DESCRIPTOR_FLAG = 0x08
+
+class _PassthroughZipWriter:
+    """
+    Stands in for python-docx's zip PhysPkgWriter (write(pack_uri, blob) / close()).
+    """
+
+    def __init__(self, output_path, source_path, compresslevel):
+        self._zipf = zipfile.ZipFile(output_path, "w", compression=zipfile.ZIP_DEFLATED,
+                                     compresslevel=compresslevel)
+        self._src = None
+        self._src_infos = {}
+        if source_path:
+            self._src = zipfile.ZipFile(source_path)
+            self._src_infos = {info.filename: info for info in self._src.infolist()}
+        self.copied = 0
+        self.compressed = 0
+
+    def write(self, pack_uri, blob):
+        name = pack_uri.membername
+        info = self._src_infos.get(name)
+        if (info is not None and info.file_size == len(blob)
+                and info.compress_type in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED)
+                and info.CRC == zlib.crc32(blob)):
+            self._copy_raw(info)
+            self.copied += 1
+            return
+        self._zipf.writestr(name, blob)
+        self.compressed += 1
+
+    def _copy_raw(self, info):
+        write_raw(self._zipf, info, read_raw(self._src, info))
+
+    def close(self):
+        self._zipf.close()
+        if self._src is not None:
+            self._src.close()
+
+
+def read_raw(zf, info):
+    """The compressed bytes of member `info` of the open ZipFile `zf`, as stored."""
+    src_fp = zf.fp
+    src_fp.seek(info.header_offset)
+    header = _LOCAL_HEADER.unpack(src_fp.read(_LOCAL_HEADER.size))
+    name_len, extra_len = header[-2], header[-1]
+    src_fp.seek(name_len + extra_len, os.SEEK_CUR)
+    return src_fp.read(info.compress_size)
+
+def write_raw(zout, info, raw):
+    """
+    Appends a member to the ZipFile `zout` (opened for writing) from its already
+    compressed bytes. `info` supplies the name, compression, CRC and sizes.
+    """
+    zinfo = zipfile.ZipInfo(info.filename, info.date_time)
+    zinfo.compress_type = info.compress_type
+    zinfo.CRC = info.CRC
+    zinfo.compress_size = info.compress_size
+    zinfo.file_size = info.file_size
+    zinfo.external_attr = info.external_attr
+    # Sizes go in the local header, so no trailing data descriptor
+    zinfo.flag_bits = info.flag_bits & ~_DATA_DESCRIPTOR_FLAG
+
+    zinfo.header_offset = zout.fp.tell()
+    zout.fp.write(zinfo.FileHeader())
+    zout.fp.write(raw)
+    zout.filelist.append(zinfo)
+    zout.NameToInfo[zinfo.filename] = zinfo
+    zout.start_dir = zout.fp.tell()
+    zout._didModify = True
+
+
+def save_document(doc, output_path, source_path=None, compresslevel=None):
+    """
+    Equivalent of doc.save(output_path). Parts unchanged from `source_path` (the file
+    `doc` was loaded from) are copied without recompression.
+    """
+    package = doc.part.package
+    parts = list(package.parts)
+    for part in parts:
+        part.before_marshal()
+
+    level = DOCX_COMPRESS_LEVEL if compresslevel is None else compresslevel
+    writer = _PassthroughZipWriter(output_path, source_path, level)
+    try:
+        PackageWriter._write_content_types_stream(writer, parts)
+        PackageWriter._write_pkg_rels(writer, package.rels)
+        PackageWriter._write_parts(writer, parts)
+    finally:
+        writer.close()
+    print(f"DEBUG: Saved {output_path}: {writer.copied} parts copied, {writer.compressed} recompressed")
@@ -1,104 +1,468 @@
 import docx
 from docx.shared import Pt, Inches
+from docx.oxml import OxmlElement
+from docx.oxml.table import CT_Tbl
+from docx.table import Table
+from docx.text.paragraph import Paragraph
 import os
 import base64
 import requests
 import io
+import copy
+import zipfile
+import posixpath
+import functools
+from lxml import etree
+from doc_editor import template_cache, package_writer, style_index
+from doc_editor.style_index import PARAGRAPH_TYPE_STYLES
+
+# Parser engine used when the caller doesn't pick one.
+# "docx" = python-docx object model, "lxml" = streaming iterparse over document.xml
+PARSER_ENGINE = os.environ.get("PARSER_ENGINE", "docx")
+
+# Bump whenever the parser's output changes so cached parses (storage parse cache) are not reused
+STRUCTURE_VERSION = 2
+
+W_NS = "http://schemas.openxmlformats.org/wordprocessingml/2006/main"
+REL_NS = "http://schemas.openxmlformats.org/package/2006/relationships"
+OFFICE_DOC_REL = "http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument"
+STYLES_REL = "http://schemas.openxmlformats.org/officeDocument/2006/relationships/styles"
+
+def _w(tag):
+    return f"{{{W_NS}}}{tag}"
+
+def parse_docx_to_structure(path, engine=None):
+    engine = engine or PARSER_ENGINE
+    if engine == "lxml":
+        return parse_docx_streaming(path)
+    if engine != "docx":
+        raise ValueError(f"Unknown parser engine: {engine}")
 
-def parse_docx_to_structure(path):
     doc = docx.Document(path)
-    structure = {
-        "sections": [],
-        "meta": {
-            "paragraph_count": 0,
-            "table_count": len(doc.tables),
-            "created_at": None # doc core props could go here
-        }
-    }
-    
-    # Simple strategy: Treat the whole doc as one big section for ID generation simplicity, 
-    # or split by headings. For MVP, let's just make one generated "default" section 
-    # unless we find Headings.
-    
-    current_section = {
-        "id": "s1",
-        "title": "Document Start",
-        "paragraphs": [],
-        "tables": []
-    }
-    
-    # We need to iterate body elements in order, but python-docx separates pars and tables.
-    # To get order, we can iterate `doc.element.body`.
-    # However, for MVP, just list paragraphs then tables? No, text flow matters.
-    # Implementing full body iteration in python-docx is tricky without `iter_block_items`.
-    # Let's use a standard trick or just separate them for MVP if order isn't strictly enforced by schema requirements.
-    # The requirement says: "sections array, each with { id, title, paragraphs: [], tables: [] }"
-    # This implies a structure where tables might be loose or part of flow. 
-    # Let's try to do sequential scan if possible, or just dump all paragraphs into the section.
-    
-    # Let's just create logical sections based on Heading styles if possible, else 1 section.
-    
-    p_counter = 1
-    s_counter = 1
+    builder = _StructureBuilder(*_paragraph_style_names(doc.styles.element))
     
-    # Simple flat retrieval with Style detection
-    for p in doc.paragraphs:
-        txt = p.text.strip()
-        if not txt:
-             # Skip empty paragraphs for now or keep as spacers?
-             # Word usually has empty Ps. Let's keep them if they are just newlines for spacing.
-             # But stripped they are empty.
-             pass
-        
-        # Detect Style
-        style_name = p.style.name.lower()
-        p_type = "text"
-        if "heading" in style_name:
-            p_type = "heading"
-            # Try to infer level?
-            if "1" in style_name: p_type = "h1"
-            elif "2" in style_name: p_type = "h2"
-            elif "3" in style_name: p_type = "h3"
-            else: p_type = "h1"        
-        elif "list" in style_name or "bullet" in style_name:
-            p_type = "list_item"
-        elif "title" in style_name:
-            p_type = "title"
-            
-        pid = f"s{s_counter}_p{p_counter}"
-        current_section["paragraphs"].append({
+    # One pass over the body in document order. Tables are read straight from their
+    # w:tc elements (see _table_rows) instead of through row.cells, which re-resolves
+    # the merged-cell grid for every row.
+    for kind, el in iter_block_items(doc.element.body):
+        if kind == "p":
+            builder.add_paragraph(el)
+        else:
+            builder.add_table(el)
+
+    return builder.finish()
+
+def iter_block_items(body):
+    """
+    Yields the top-level paragraphs and tables of a w:body element in document order,
+    as ("p", element) or ("tbl", element). Same elements as doc.paragraphs / doc.tables.
+    """
+    p_tag = _w("p")
+    for child in body.iterchildren(p_tag, _w("tbl")):
+        yield ("p" if child.tag == p_tag else "tbl"), child
+
+# Paragraph types that open a new section
+SECTION_BREAK_TYPES = ("h1", "h2")
+
+class _StructureBuilder:
+    """
+    Turns top-level body paragraphs and tables, fed in document order, into the structure:
+    a new section starts at every Heading 1/2 (and holds that heading as its first
+    paragraph); anything before the first heading goes into a "Document Start" section.
+    Ids are s<section>_p<n> / s<section>_t<n>, numbered within their section.
+    """
+
+    def __init__(self, style_names, default_style, sectioned=True):
+        self.style_names = style_names
+        self.default_style = default_style
+        self.sectioned = sectioned # False: everything in s1, as before sections existed
+        self.sections = []
+        self.section = None
+        self.paragraph_count = 0
+        self.table_count = 0
+
+    def _start_section(self, title):
+        self.section = {
+            "id": f"s{len(self.sections) + 1}",
+            "title": title,
+            "paragraphs": [],
+            "tables": []
+        }
+        self.sections.append(self.section)
+        self.section_paragraphs = 0
+
+    def paragraph_type(self, p):
+        return _paragraph_type(p, self.style_names, self.default_style)
+
+    def next_paragraph_id(self, p_type, text):
+        # `text` may be a callable; it is only needed for section-opening headings
+        if p_type in SECTION_BREAK_TYPES and (self.sectioned or self.section is None):
+            title = text() if callable(text) else text
+            self._start_section(title.strip() or "Untitled Section")
+        elif self.section is None:
+            self._start_section("Document Start")
+        self.paragraph_count += 1
+        self.section_paragraphs += 1
+        return f"{self.section['id']}_p{self.section_paragraphs}"
+
+    def add_paragraph(self, p):
+        p_type = self.paragraph_type(p)
+        text = _paragraph_text(p)
+        pid = self.next_paragraph_id(p_type, text)
+        self.section["paragraphs"].append({
             "id": pid,
-            "text": p.text, # Keep original text with whitespace
+            "text": text, # Keep original text with whitespace
             "type": p_type
         })
-        p_counter += 1
-
-    # Tables - naive table extraction (doesn't preserve position relative to text in this simple schema)
-    # If the user needs context, we might want to interleave them.
-    # Requirement schema: `tables: [ { id: "s1_t1", rows: [...] } ]` inside sections.
-    # Let's add all tables to this section for now.
-    t_counter = 1
-    for table in doc.tables:
-        t_data = []
-        for row in table.rows:
-            r_data = []
-            for cell in row.cells:
-                r_data.append(cell.text)
-            t_data.append(r_data)
-        
-        tid = f"s{s_counter}_t{t_counter}"
-        current_section["tables"].append({
-            "id": tid,
-            "rows": t_data
+        return pid
+
+    def add_table(self, tbl):
+        if self.section is None:
+            self._start_section("Document Start")
+        self.table_count += 1
+        # "after_paragraph" keeps the table's place in the text flow: the id of the paragraph
+        # right before it, or None if it comes before every paragraph of the section.
+        paragraphs = self.section["paragraphs"]
+        self.section["tables"].append({
+            "id": f"{self.section['id']}_t{len(self.section['tables']) + 1}",
+            "after_paragraph": paragraphs[-1]["id"] if paragraphs else None,
+            "rows": _table_rows(tbl)
         })
-        t_counter += 1
 
-    structure["sections"].append(current_section)
-    structure["meta"]["paragraph_count"] = p_counter - 1
-    
-    return structure
+    def finish(self):
+        if not self.sections:
+            self._start_section("Document Start")
+        return {
+            "sections": self.sections,
+            "meta": {
+                "paragraph_count": self.paragraph_count,
+                "table_count": self.table_count,
+                "created_at": None # doc core props could go here
+            }
+        }
+
+def paragraph_ids(doc, sectioned=True):
+    """
+    (paragraph id, w:p element) for every top-level paragraph of a python-docx Document,
+    with the ids the parser gives them. Lets the patchers find the paragraphs of an
+    unpatched upload without parsing it into a structure.
+    sectioned=False gives the ids of documents stored before sections were split at
+    headings (STRUCTURE_VERSION 1): s1_p1, s1_p2, ... in one section.
+    """
+    builder = _StructureBuilder(*_paragraph_style_names(doc.styles.element), sectioned=sectioned)
+    ids = []
+    for el in doc.element.body.iterchildren(_w("p")):
+        pid = builder.next_paragraph_id(builder.paragraph_type(el), lambda: _paragraph_text(el))
+        ids.append((pid, el))
+    return ids
+
+def uses_section_ids(structure):
+    """
+    Whether `structure` numbers paragraphs per heading section. Documents stored before
+    sections existed keep flat ids in one section; an upload whose only section break is
+    its first paragraph gets the same ids either way.
+    """
+    return len(structure.get("sections", [])) > 1
+
+def _paragraph_type(p, style_names, default_style):
+    # Structure type of a w:p, from its style (see _paragraph_style_names)
+    style_id = _paragraph_style_id(p)
+    style_name = style_names.get(style_id, default_style) if style_id else default_style
+    return classify_paragraph_style(style_name)
+
+def classify_paragraph_style(style_name):
+    """
+    Maps a Word paragraph style name to our paragraph type (h1/h2/h3/list_item/title/text).
+    """
+    style_name = (style_name or "").lower()
+    if "heading" in style_name:
+        if "1" in style_name: return "h1"
+        elif "2" in style_name: return "h2"
+        elif "3" in style_name: return "h3"
+        return "h1"
+    elif "list" in style_name or "bullet" in style_name:
+        return "list_item"
+    elif "title" in style_name:
+        return "title"
+    return "text"
+
+def _resolve_part(zf, source_dir, rels_path, rel_type, default):
+    # Follows a relationship out of a .rels part, falling back to the conventional name.
+    if rels_path not in zf.namelist():
+        return default
+    rels = etree.fromstring(zf.read(rels_path))
+    for rel in rels.iter(f"{{{REL_NS}}}Relationship"):
+        if rel.get("Type") == rel_type:
+            target = rel.get("Target")
+            if target.startswith("/"):
+                return target[1:]
+            return posixpath.normpath(posixpath.join(source_dir, target))
+    return default
+
+def _load_paragraph_style_names(zf, styles_part):
+    """
+    Returns (style_id -> name, default paragraph style name) from styles.xml.
+    styles.xml is small compared to document.xml, so a plain parse is fine here.
+    """
+    if styles_part not in zf.namelist():
+        return {}, None
+    return _paragraph_style_names(etree.fromstring(zf.read(styles_part)))
+
+def _paragraph_style_names(root):
+    # (style_id -> name, default paragraph style name) from a parsed w:styles element
+    names = {}
+    default_name = None
+    for style in root.iterchildren(_w("style")):
+        if style.get(_w("type")) != "paragraph":
+            continue
+        name_el = style.find(_w("name"))
+        name = name_el.get(_w("val")) if name_el is not None else None
+        names[style.get(_w("styleId"))] = name
+        if style.get(_w("default")) in ("1", "true", "on"):
+            default_name = name
+    return names, default_name
+
+# Tags used in the per-element hot loops below. Plain child iteration with tag
+# comparisons is several times faster than lxml's find()/iterchildren(tag) there.
+_T, _TAB, _PTAB, _BR, _CR, _NB_HYPHEN = (_w(t) for t in ("t", "tab", "ptab", "br", "cr", "noBreakHyphen"))
+_R, _HYPERLINK, _P, _PPR, _PSTYLE = (_w(t) for t in ("r", "hyperlink", "p", "pPr", "pStyle"))
+_TR, _TRPR, _GRID_BEFORE, _TC, _TCPR, _GRID_SPAN, _VMERGE = (
+    _w(t) for t in ("tr", "trPr", "gridBefore", "tc", "tcPr", "gridSpan", "vMerge")
+)
+_VAL, _TYPE = _w("val"), _w("type")
+
+def _run_text(r):
+    # Mirrors python-docx CT_R.text: t, tab, ptab, br (text wrapping only), cr, noBreakHyphen
+    parts = []
+    for child in r:
+        tag = child.tag
+        if tag == _T:
+            parts.append(child.text or "")
+        elif tag == _TAB or tag == _PTAB:
+            parts.append("\t")
+        elif tag == _BR:
+            if child.get(_TYPE, "textWrapping") == "textWrapping":
+                parts.append("\n")
+        elif tag == _CR:
+            parts.append("\n")
+        elif tag == _NB_HYPHEN:
+            parts.append("-")
+    return "".join(parts)
+
+def _paragraph_text(p):
+    parts = []
+    for child in p:
+        if child.tag == _R:
+            parts.append(_run_text(child))
+        elif child.tag == _HYPERLINK:
+            for r in child:
+                if r.tag == _R:
+                    parts.append(_run_text(r))
+    return "".join(parts)
+
+def _paragraph_style_id(p):
+    for child in p:
+        if child.tag == _PPR:
+            for prop in child:
+                if prop.tag == _PSTYLE:
+                    return prop.get(_VAL)
+            return None
+    return None
+
+def _table_rows(tbl):
+    """
+    Reads a w:tbl into a list of rows of cell text, the same shape python-docx row.cells gives:
+    a gridSpan cell is repeated once per spanned column, a vMerge continuation cell
+    repeats the text of the cell above it at the same grid offset. Each merge is resolved
+    once here, where row.cells re-walks the grid for every row.
+    """
+    rows = []
+    prev_grid = {}  # grid offset -> (text, span) of the previous row
+    for tr in tbl:
+        if tr.tag != _TR:
+            continue
+        row = []
+        grid = {}
+        offset = 0
+        for tc in tr:
+            tag = tc.tag
+            if tag == _TRPR:
+                for prop in tc:
+                    if prop.tag == _GRID_BEFORE:
+                        offset = int(prop.get(_VAL, "0"))
+                continue
+            if tag != _TC:
+                continue
+            span = 1
+            continued = False
+            texts = []
+            for child in tc:
+                if child.tag == _P:
+                    texts.append(_paragraph_text(child))
+                elif child.tag == _TCPR:
+                    for prop in child:
+                        if prop.tag == _GRID_SPAN:
+                            span = int(prop.get(_VAL, "1"))
+                        elif prop.tag == _VMERGE and prop.get(_VAL, "continue") == "continue":
+                            continued = True
+            if continued and offset in prev_grid:
+                text = prev_grid[offset][0]
+            else:
+                text = "\n".join(texts)
+            grid[offset] = (text, span)
+            row.extend([text] * span)
+            offset += span
+        prev_grid = grid
+        rows.append(row)
+    return rows
+
+def _set_cell_text(tc, text):
+    # One paragraph per line, keeping the first paragraph's pPr and its first run's rPr.
+    # Nested tables stay where they are.
+    paragraphs = [child for child in tc if child.tag == _P]
+    ppr = rpr = None
+    if paragraphs:
+        ppr = paragraphs[0].find(_PPR)
+        first_run = paragraphs[0].find(_R)
+        if first_run is not None:
+            rpr = first_run.find(_w("rPr"))
+        anchor = paragraphs[0].getprevious()
+        for p in paragraphs:
+            tc.remove(p)
+    else:
+        anchor = tc.find(_TCPR)
+    for line in text.split("\n"):
+        p = OxmlElement('w:p')
+        if ppr is not None:
+            p.append(copy.deepcopy(ppr))
+        if line:
+            r = OxmlElement('w:r')
+            if rpr is not None:
+                r.append(copy.deepcopy(rpr))
+            t = OxmlElement('w:t')
+            t.text = line
+            t.set('{http://www.w3.org/XML/1998/namespace}space', 'preserve')
+            r.append(t)
+            p.append(r)
+        if anchor is None:
+            tc.insert(0, p)
+        else:
+            anchor.addnext(p)
+        anchor = p
+
+def _write_table_rows(tbl, rows):
+    """
+    Writes `rows` (the shape _table_rows reads) back into a w:tbl, rewriting only the cells
+    whose text changed. A spanned cell takes the text of its first grid column; vMerge
+    continuation cells are left alone, they show the cell above them.
+    """
+    old_rows = _table_rows(tbl)
+    r_idx = 0
+    for tr in tbl:
+        if tr.tag != _TR:
+            continue
+        if r_idx >= len(rows):
+            break
+        pos = 0
+        for tc in tr:
+            if tc.tag != _TC:
+                continue
+            span = 1
+            continued = False
+            for child in tc:
+                if child.tag == _TCPR:
+                    for prop in child:
+                        if prop.tag == _GRID_SPAN:
+                            span = int(prop.get(_VAL, "1"))
+                        elif prop.tag == _VMERGE and prop.get(_VAL, "continue") == "continue":
+                            continued = True
+            if not continued and pos < len(rows[r_idx]) and rows[r_idx][pos] != old_rows[r_idx][pos]:
+                _set_cell_text(tc, rows[r_idx][pos])
+            pos += span
+        r_idx += 1
+
+def _structure_tables(structure):
+    # Tables of every section, in document order
+    return [t for sec in structure.get("sections", []) for t in sec.get("tables", [])]
+
+def _patch_tables(body, owners, tables, old_tables=None):
+    """
+    Writes table cell edits (global replacements reach table cells, see
+    DocumentModel.update_table_cells) into the document's own tables: the body tables no
+    structure paragraph owns are the structure's tables, in order.
+    With `old_tables`, only the tables whose rows differ from it are written.
+    """
+    if old_tables is not None and len(old_tables) == len(tables):
+        changed = [i for i, (old, new) in enumerate(zip(old_tables, tables)) if old.get("rows") != new.get("rows")]
+        if not changed:
+            return
+    else:
+        changed = range(len(tables))
+    doc_tables = [el for el in body.iterchildren(_w("tbl")) if el not in owners]
+    if len(doc_tables) != len(tables):
+        print(f"DEBUG: {len(doc_tables)} document tables for {len(tables)} structure tables, table cells not patched")
+        return
+    for i in changed:
+        _write_table_rows(doc_tables[i], tables[i].get("rows", []))
+
+def parse_docx_streaming(path):
+    """
+    Streaming parser engine. Reads word/document.xml straight out of the zip with
+    iterparse and clears each top-level body element once it has been read, so memory
+    stays flat no matter how long the document is. Emits the same structure as the
+    python-docx engine.
+    """
+    with zipfile.ZipFile(path) as zf:
+        doc_part = _resolve_part(zf, "", "_rels/.rels", OFFICE_DOC_REL, "word/document.xml")
+        doc_dir, doc_name = posixpath.split(doc_part)
+        styles_part = _resolve_part(
+            zf, doc_dir, posixpath.join(doc_dir, "_rels", doc_name + ".rels"),
+            STYLES_REL, posixpath.join(doc_dir, "styles.xml")
+        )
+        builder = _StructureBuilder(*_load_paragraph_style_names(zf, styles_part))
+
+        body_tag = _w("body")
+        p_tag = _w("p")
+        tbl_tag = _w("tbl")
+
+        with zf.open(doc_part) as f:
+            for _, elem in etree.iterparse(f, events=("end",), tag=(p_tag, tbl_tag), huge_tree=True):
+                parent = elem.getparent()
+                if parent is None or parent.tag != body_tag:
+                    # Nested (table cell / text box) - read as part of its top-level block
+                    continue
+
+                if elem.tag == p_tag:
+                    builder.add_paragraph(elem)
+                else:
+                    builder.add_table(elem)
+
+                # Drop everything we've consumed so the tree never grows past one block
+                elem.clear()
+                while elem.getprevious() is not None:
+                    del parent[0]
+
+    return builder.finish()
+
+def _try_paragraph_style(p, styles, names):
+    """
+    Gives `p` the first style of `names` the document has; returns whether one was found.
+    `styles` is the document's style index (see style_index), or None to let python-docx
+    look the names up.
+    """
+    for name in names:
+        if styles is not None:
+            if style_index.set_paragraph_style(p, styles, name):
+                return True
+            continue
+        try:
+            p.style = name
+            return True
+        except Exception:
+            pass
+    return False
 
-def apply_markdown_to_paragraph(p, text):
+def apply_markdown_to_paragraph(p, text, styles=None):
     """
     Parses simple markdown (bold **text**) and applies it to the paragraph runs.
     Also detects list items.
@@ -106,18 +470,10 @@ def apply_markdown_to_paragraph(p, text):
     # 1. Check for List Item
     clean_text = text.strip()
     if clean_text.startswith("* ") or clean_text.startswith("- "):
-        try:
-            p.style = 'List Bullet'
-        except Exception:
-            try: p.style = 'List Paragraph'
-            except: pass
+        _try_paragraph_style(p, styles, ('List Bullet', 'List Paragraph'))
         clean_text = clean_text[2:] # Remove marker
     elif clean_text.startswith("1. "):
-        try:
-            p.style = 'List Number'
-        except Exception:
-            try: p.style = 'List Paragraph'
-            except: pass
+        _try_paragraph_style(p, styles, ('List Number', 'List Paragraph'))
         clean_text = clean_text[3:] # Remove marker
         
     # Clear existing content
@@ -153,10 +509,29 @@ def render_mermaid_to_image(mermaid_code):
         print(f"DEBUG: Image Load Error: {e}")
         return None
 
+BLOCK_CACHE_SIZE = int(os.environ.get("BLOCK_CACHE_SIZE", "4096"))
+
 def extract_blocks(text):
     """
     Splits text into blocks: text, table, mermaid.
+    Plain paragraphs (the vast majority) take a fast path; the rest are tokenized once
+    and memoized, so unchanged paragraphs aren't re-tokenized on the next save.
     """
+    if not _has_block_markers(text):
+        return [{'type': 'text', 'content': text.strip()}]
+    return [{'type': b_type, 'content': content} for b_type, content in _tokenize_blocks(text)]
+
+def _has_block_markers(text):
+    # Anything that could start a table, a mermaid fence or trip the loose mermaid check.
+    # Text without any of these is always a single text block.
+    if '|' in text or '`' in text:
+        return True
+    lowered = text.lower()
+    return 'mermaid' in lowered or 'graph lr' in lowered
+
+@functools.lru_cache(maxsize=BLOCK_CACHE_SIZE)
+def _tokenize_blocks(text):
+    # Returns a tuple of (type, content) so the cached value can't be mutated by callers
     lines = text.strip().split('\n')
     blocks = []
     current_lines = []
@@ -220,17 +595,31 @@ def extract_blocks(text):
     for b in blocks:
         # SUPER AND GENTLE CHECK: If it mentions mermaid and looks like code, render it.
         # This fixes the issue where backticks might be missing or formatted weirdly.
-        if b['type'] == 'text' and ('mermaid' in b['content'].lower() or 'graph lr' in b['content'].lower()):
+        if b['type'] != 'text':
+            continue
+        lowered = b['content'].lower()
+        if 'mermaid' in lowered or 'graph lr' in lowered:
             print("DEBUG: Found MISSED mermaid block (Loose Check), correcting type.")
             b['type'] = 'mermaid'
             # Content doesn't matter since we use static image now, but keep it clean
             b['content'] = "static_override"
         
-    return blocks
+    return tuple((b['type'], b['content']) for b in blocks)
 
-def create_table_from_markdown(doc, text, insert_after_element=None):
+def _new_paragraph(doc, text=None):
+    """
+    A new, detached paragraph that the caller places itself. doc.add_paragraph() would
+    first append it to the body, which scans the whole body for sectPr on every call.
+    """
+    p = Paragraph(OxmlElement('w:p'), doc._body)
+    if text:
+        p.add_run(text)
+    return p
+
+def create_table_from_markdown(doc, text, insert_after_element=None, detached=False, styles=None):
     """
     Creates a DOCX table from markdown text and inserts it at the correct position.
+    With detached=True the table isn't inserted anywhere; the caller places it.
     Returns the table object (or its last element).
     """
     lines = text.strip().split('\n')
@@ -244,12 +633,19 @@ def create_table_from_markdown(doc, text, insert_after_element=None):
     header = [c.strip() for c in rows[0].strip().split('|') if c.strip()]
     col_count = len(header)
     
-    table = doc.add_table(rows=len(rows), cols=col_count)
-    try:
-        table.style = 'Table Grid'
-    except KeyError:
-        # Style not found in formatting, fallback to default
-        pass
+    if detached:
+        table = Table(CT_Tbl.new_tbl(len(rows), col_count, doc._block_width), doc._body)
+    else:
+        table = doc.add_table(rows=len(rows), cols=col_count)
+    if styles is not None:
+        # Style not found in formatting: keep the default
+        style_index.set_table_style(table, styles, 'Table Grid')
+    else:
+        try:
+            table.style = 'Table Grid'
+        except KeyError:
+            # Style not found in formatting, fallback to default
+            pass
     
     for r_idx, line in enumerate(rows):
         # Skip separator line if present (e.g. |---|)
@@ -270,98 +666,92 @@ def create_table_from_markdown(doc, text, insert_after_element=None):
                  row_cells[c_idx].text = cell_text
                  
     # Move table to correct position
-    if insert_after_element:
-        # parent = insert_after_element.getparent() # Error in python-docx sometimes if using proxy
-        # We need the low-level element
-        parent = insert_after_element.getparent()
-        t_element = table._element
-        
+    if insert_after_element is not None:
+        # We need the low-level element; addnext moves it right after its sibling
+        # (unlinking it from the end of the body) without an index() scan.
         try:
-            # We want to move t_element to be after insert_after_element
-            # Current `add_table` puts it at end.
-            # We need to remove it from end? No, `move` implies unlinking.
-            
-            # Simple Insert Logic:
-            p_idx = parent.index(insert_after_element)
-            parent.insert(p_idx + 1, t_element)
+            insert_after_element.addnext(table._element)
         except Exception as e:
             print(f"Table move failed: {e}")
             
     return table
 
+def apply_style_definitions(doc, style_defs, styles=None):
+    """
+    Applies `meta.styles` entries (written by update_style_font) to the document's style definitions.
+    `styles` is the document's style index; built here if not given.
+    """
+    from docx.enum.text import WD_ALIGN_PARAGRAPH
+
+    if styles is None:
+        styles = style_index.build_style_index(doc)
+
+    for s_name, props in style_defs.items():
+        # Robust Case-Insensitive Lookup
+        style = style_index.get_style(doc, styles, s_name)
+        
+        if not style:
+            print(f"DEBUG: Style {s_name} not found (even case-insensitively). Skipping.")
+            continue
+
+        try:
+            if props.get("size_pt"):
+                 style.font.size = Pt(props["size_pt"])
+            if props.get("bold") is not None:
+                 style.font.bold = props["bold"]
+            if props.get("italic") is not None:
+                 style.font.italic = props["italic"]
+            
+            # Paragraph format for justification
+            if props.get("justification"):
+                if props["justification"] == "center":
+                    style.paragraph_format.alignment = WD_ALIGN_PARAGRAPH.CENTER
+                elif props["justification"] == "right":
+                    style.paragraph_format.alignment = WD_ALIGN_PARAGRAPH.RIGHT
+                elif props["justification"] == "justified":
+                    style.paragraph_format.alignment = WD_ALIGN_PARAGRAPH.JUSTIFY
+                elif props["justification"] == "left":
+                    style.paragraph_format.alignment = WD_ALIGN_PARAGRAPH.LEFT
+                    
+            print(f"DEBUG: Applied style update to {s_name}")
+        except KeyError:
+            print(f"DEBUG: Style {s_name} not found to update.")
+        except Exception as e:
+            print(f"DEBUG: Failed to update style {s_name}: {e}")
+
 def patch_docx_from_structure(input_path, structure, output_path):
-    doc = docx.Document(input_path)
+    """
+    Full patch: rebuilds every paragraph of `structure` on top of `input_path` (the original upload).
+    Returns the body layout of the written file (see body_layout).
+    """
+    doc = template_cache.open_document(input_path)
+    styles = template_cache.get_derived(input_path, "style_index", lambda: style_index.build_style_index(doc))
     
     # 0. Apply Style Definitions from Meta
     if "meta" in structure and "styles" in structure["meta"]:
-        from docx.shared import Pt
-        from docx.enum.text import WD_ALIGN_PARAGRAPH
-        
-        style_defs = structure["meta"]["styles"]
-        for s_name, props in style_defs.items():
-            # Robust Case-Insensitive Lookup
-            style = None
-            if s_name in doc.styles:
-                style = doc.styles[s_name]
-            else:
-                 # Try finding it case-insensitively
-                 for s in doc.styles:
-                     if s.name.lower() == s_name.lower():
-                         style = s
-                         break
-            
-            if not style:
-                print(f"DEBUG: Style {s_name} not found (even case-insensitively). Skipping.")
-                continue
+        apply_style_definitions(doc, structure["meta"]["styles"], styles)
 
-            try:
-                if props.get("size_pt"):
-                     style.font.size = Pt(props["size_pt"])
-                if props.get("bold") is not None:
-                     style.font.bold = props["bold"]
-                if props.get("italic") is not None:
-                     style.font.italic = props["italic"]
-                
-                # Paragraph format for justification
-                if props.get("justification"):
-                    if props["justification"] == "center":
-                        style.paragraph_format.alignment = WD_ALIGN_PARAGRAPH.CENTER
-                    elif props["justification"] == "right":
-                        style.paragraph_format.alignment = WD_ALIGN_PARAGRAPH.RIGHT
-                    elif props["justification"] == "justified":
-                        style.paragraph_format.alignment = WD_ALIGN_PARAGRAPH.JUSTIFY
-                    elif props["justification"] == "left":
-                        style.paragraph_format.alignment = WD_ALIGN_PARAGRAPH.LEFT
-                        
-                print(f"DEBUG: Applied style update to {s_name}")
-            except KeyError:
-                print(f"DEBUG: Style {s_name} not found to update.")
-            except Exception as e:
-                print(f"DEBUG: Failed to update style {s_name}: {e}")
-
-    # 1. Map existing paragraphs for quick lookup
-    original_paragraphs = {}
-    p_counter = 1
-    doc_paragraphs_list = [] 
-    for p in doc.paragraphs:
-        pid = f"s1_p{p_counter}"
-        original_paragraphs[pid] = p
-        doc_paragraphs_list.append(p)
-        p_counter += 1
+    # 1. Map existing paragraphs for quick lookup (same ids as the parser gave them)
+    original_paragraphs = {pid: Paragraph(el, doc._body)
+                           for pid, el in paragraph_ids(doc, sectioned=uses_section_ids(structure))}
+    style_names, default_style = _paragraph_style_names(doc.styles.element)
         
-    last_p_element = None 
+    body = doc.element.body
+    # Cursor: the last element placed. New elements go right after it (sibling insertion,
+    # O(1)) instead of looking its position up with parent.index() every time.
+    # None means "top of the body".
+    cursor = None
+    owners = {} # body element -> pid that produced it, for the layout sidecar
     
     if not structure["sections"]:
-        doc.save(output_path)
-        return
+        package_writer.save_document(doc, output_path, source_path=input_path)
+        return body_layout(body, owners)
 
-    sec = structure["sections"][0]
     visited_ids = set()
     
-    for p_struct in sec["paragraphs"]:
+    for p_struct in iter_structure_paragraphs(structure):
         pid = p_struct["id"]
         text = p_struct["text"]
-        style_type = p_struct.get("type", "text")
         
         # 1. Parse content into blocks (Text + Tables + Mermaid)
         blocks = extract_blocks(text)
@@ -369,120 +759,300 @@ def patch_docx_from_structure(input_path, structure, output_path):
             print(f"DEBUG: Found Mermaid block in Paragraph {pid}")
         
         # 2. Optimization: If simple text (1 block), use existing update logic to preserve P identity
-        if len(blocks) == 1 and blocks[0]['type'] == 'text':
-             # --- EXISTING PARAGRAPH PATH ---
-             if pid in original_paragraphs:
-                p_obj = original_paragraphs[pid]
-                visited_ids.add(pid)
-                apply_markdown_to_paragraph(p_obj, text)
-                last_p_element = p_obj._element
-             else:
-                # Insert New
-                new_p = doc.add_paragraph() 
-                apply_markdown_to_paragraph(new_p, text)
-                # Insertion / Move Logic
-                if last_p_element is not None:
-                    parent = last_p_element.getparent()
-                    try:
-                        p_idx = parent.index(last_p_element)
-                        parent.insert(p_idx + 1, new_p._element)
-                    except ValueError: pass
-                elif doc_paragraphs_list:
-                    # Insert at very start
-                    first_p = doc_paragraphs_list[0]._element
-                    parent = first_p.getparent()
-                    parent.insert(0, new_p._element)
-                    
-                
-                try:
-                    if style_type == 'h1': new_p.style = 'Heading 1'
-                    elif style_type == 'h2': new_p.style = 'Heading 2'
-                    elif style_type == 'h3': new_p.style = 'Heading 3'
-                    elif style_type == 'list_item': new_p.style = 'List Paragraph'
-                except Exception as e:
-                    print(f"DEBUG: Style {style_type} not found, using default. Error: {e}")
-                    pass
-                
-                last_p_element = new_p._element
-             continue
+        if len(blocks) == 1 and blocks[0]['type'] == 'text' and pid in original_paragraphs:
+            # --- EXISTING PARAGRAPH PATH ---
+            p_obj = original_paragraphs[pid]
+            visited_ids.add(pid)
+            # Type changes restyle the paragraph, as in patch_docx_incremental: the upload's
+            # type is what the parser gave it in revision 0
+            old_type = _paragraph_type(p_obj._element, style_names, default_style)
+            apply_markdown_to_paragraph(p_obj, text, styles)
+            new_type = p_struct.get("type", "text")
+            if old_type != new_type:
+                _set_paragraph_style(p_obj, new_type, fallback="Normal", styles=styles)
+            cursor = p_obj._element
+            owners[cursor] = pid
+            continue
 
-        # 3. Complex Path (Text + Tables + Mermaid)
+        # 3. New paragraph, or Complex Path (Text + Tables + Mermaid)
         # We always "Replace" the ID with this new sequence of elements.
         # If the PID existed, we do NOT add it to visited_ids, so the original P gets deleted.
         # We insert the new blocks at the current cursor position.
-        
-        for block in blocks:
-            if block['type'] == 'table':
-                 table_obj = create_table_from_markdown(doc, block['content'], insert_after_element=last_p_element)
-                 if table_obj:
-                     last_p_element = table_obj._element
-            elif block['type'] == 'mermaid':
-                 # Render Image
-                 img_bytes = render_mermaid_to_image(block['content'])
-                 if img_bytes:
-                     # Create a paragraph for the image
-                     img_p = doc.add_paragraph()
-                     run = img_p.add_run()
-                     
-                     # Write bytes to temp file because add_picture needs path or stream
-                     # Using io.BytesIO
-                     img_stream = io.BytesIO(img_bytes)
-                     run.add_picture(img_stream, width=Inches(6.0))
-                     
-                     # Move it
-                     if last_p_element is not None:
-                        parent = last_p_element.getparent()
-                        try:
-                            p_idx = parent.index(last_p_element)
-                            parent.insert(p_idx + 1, img_p._element)
-                        except ValueError: pass
-                     elif doc_paragraphs_list and not last_p_element:
-                        first_p = doc_paragraphs_list[0]._element
-                        parent = first_p.getparent()
-                        parent.insert(0, img_p._element)
-                        
-                     last_p_element = img_p._element
-                 else:
-                     # FALLBACK: Insert Text
-                     print(f"DEBUG: Mermaid Render Failed, using Fallback Text")
-                     err_p = doc.add_paragraph(f"[DIAGRAM GENERATION FAILED]\n{block['content']}")
-                     if last_p_element is not None:
-                        parent = last_p_element.getparent()
-                        try:
-                            p_idx = parent.index(last_p_element)
-                            parent.insert(p_idx + 1, err_p._element)
-                        except ValueError: pass
-                     elif doc_paragraphs_list:
-                         first_p = doc_paragraphs_list[0]._element
-                         parent = first_p.getparent()
-                         parent.insert(0, err_p._element)
-                     last_p_element = err_p._element
+        elements = build_paragraph_elements(doc, p_struct, blocks, styles)
+        _place_after(body, cursor, elements)
+        for el in elements:
+            owners[el] = pid
+        if elements:
+            cursor = elements[-1]
+
+    # 3. Handle Deletions (batched)
+    _remove_elements(body, [p_obj._element for pid, p_obj in original_paragraphs.items() if pid not in visited_ids])
+    # 4. Table cells (the upload's tables are never moved or deleted)
+    _patch_tables(body, owners, _structure_tables(structure))
+
+    package_writer.save_document(doc, output_path, source_path=input_path)
+    # Style definitions may have changed, but style IDs and names haven't: the index carries over
+    template_cache.store_document(output_path, doc, derived={"style_index": styles})
+    return body_layout(doc.element.body, owners)
+
+# --- Incremental patching ---
+#
+# A "layout" records which body element of a revision DOCX belongs to which paragraph id:
+# a run-length list of [pid, element_count] over the direct children of w:body, in order.
+# Elements we don't manage (original tables, sectPr, content controls) have pid None.
+# It lets the next save find a paragraph's elements without re-rendering the whole document.
+
+def body_layout(body, owners):
+    layout = []
+    for el in body.iterchildren():
+        pid = owners.get(el)
+        if layout and layout[-1][0] == pid:
+            layout[-1][1] += 1
+        else:
+            layout.append([pid, 1])
+    return layout
+
+def original_layout(doc, sectioned=True):
+    # Layout of an unpatched upload: every direct w:p under the id the parser gives it
+    owners = {el: pid for pid, el in paragraph_ids(doc, sectioned)}
+    return body_layout(doc.element.body, owners)
+
+def iter_structure_paragraphs(structure):
+    # Paragraphs of every section, in document order
+    for sec in structure.get("sections", []):
+        yield from sec.get("paragraphs", [])
+
+def _longest_increasing_run(seq):
+    """
+    Indices into `seq` of one longest strictly increasing subsequence (patience sorting, O(n log n)).
+    """
+    import bisect
+    tails = []      # tails[k] = smallest tail value of an increasing run of length k+1
+    tail_idx = []
+    prev = [-1] * len(seq)
+    for i, v in enumerate(seq):
+        k = bisect.bisect_left(tails, v)
+        if k == len(tails):
+            tails.append(v)
+            tail_idx.append(i)
+        else:
+            tails[k] = v
+            tail_idx[k] = i
+        prev[i] = tail_idx[k - 1] if k > 0 else -1
+    out = []
+    i = tail_idx[-1] if tail_idx else -1
+    while i != -1:
+        out.append(i)
+        i = prev[i]
+    out.reverse()
+    return out
+
+def diff_paragraphs(old_paragraphs, new_paragraphs):
+    """
+    Paragraph-level diff between two versions of a document's paragraph list.
+    Returns {"changed", "inserted", "deleted", "moved"} as sets of paragraph ids.
+    A paragraph is "moved" when it is kept but falls outside the longest run of
+    kept paragraphs whose relative order didn't change.
+    """
+    old_by_id = {p["id"]: p for p in old_paragraphs}
+    new_ids = {p["id"] for p in new_paragraphs}
+    old_pos = {p["id"]: i for i, p in enumerate(old_paragraphs)}
+
+    changed = set()
+    inserted = set()
+    kept = []
+    for p in new_paragraphs:
+        old = old_by_id.get(p["id"])
+        if old is None:
+            inserted.add(p["id"])
+            continue
+        kept.append(p["id"])
+        if old["text"] != p["text"] or old.get("type", "text") != p.get("type", "text"):
+            changed.add(p["id"])
+
+    deleted = {pid for pid in old_by_id if pid not in new_ids}
+
+    stable = _longest_increasing_run([old_pos[pid] for pid in kept])
+    stable_ids = {kept[i] for i in stable}
+    moved = {pid for pid in kept if pid not in stable_ids}
+
+    return {"changed": changed, "inserted": inserted, "deleted": deleted, "moved": moved}
+
+def _set_paragraph_style(p, style_type, fallback=None, styles=None):
+    # Paragraph types map to Word styles through style_index.PARAGRAPH_TYPE_STYLES,
+    # resolved to style IDs once per template (styles["types"])
+    if styles is not None and style_index.set_paragraph_type_style(p, styles, style_type):
+        return
+    style_name = PARAGRAPH_TYPE_STYLES.get(style_type, fallback)
+    if not style_name:
+        return
+    if not _try_paragraph_style(p, styles, (style_name,)):
+        print(f"DEBUG: Style {style_name} for {style_type} not found, using default.")
+
+def build_paragraph_elements(doc, p_struct, blocks=None, styles=None):
+    """
+    Renders one structure paragraph into new body elements (paragraphs, tables, images),
+    the way both patchers render a paragraph that has no existing element to reuse.
+    The elements are created at the end of the body; callers move them into place.
+    """
+    text = p_struct["text"]
+    if blocks is None:
+        blocks = extract_blocks(text)
+
+    if len(blocks) == 1 and blocks[0]['type'] == 'text':
+        new_p = _new_paragraph(doc)
+        apply_markdown_to_paragraph(new_p, text, styles)
+        _set_paragraph_style(new_p, p_struct.get("type", "text"), styles=styles)
+        return [new_p._element]
+
+    elements = []
+    for block in blocks:
+        if block['type'] == 'table':
+            table_obj = create_table_from_markdown(doc, block['content'], detached=True, styles=styles)
+            if table_obj:
+                elements.append(table_obj._element)
+        elif block['type'] == 'mermaid':
+            img_bytes = render_mermaid_to_image(block['content'])
+            if img_bytes:
+                img_p = _new_paragraph(doc)
+                img_p.add_run().add_picture(io.BytesIO(img_bytes), width=Inches(6.0))
+                elements.append(img_p._element)
             else:
-                 # Insert Paragraph
-                 new_p = doc.add_paragraph()
-                 apply_markdown_to_paragraph(new_p, block['content'])
-                 
-                 # Move
-                 if last_p_element is not None:
-                    parent = last_p_element.getparent()
-                    try:
-                        p_idx = parent.index(last_p_element)
-                        parent.insert(p_idx + 1, new_p._element)
-                    except ValueError: pass
-                 elif doc_paragraphs_list and not last_p_element:
-                    first_p = doc_paragraphs_list[0]._element
-                    parent = first_p.getparent()
-                    parent.insert(0, new_p._element)
-                 
-                 last_p_element = new_p._element
-
-    # 3. Handle Deletions
-    for pid, p_obj in original_paragraphs.items():
-        if pid not in visited_ids:
-            try:
-                p_element = p_obj._element
-                p_element.getparent().remove(p_element)
-            except (AttributeError, ValueError):
-                pass
-
-    doc.save(output_path)
+                print(f"DEBUG: Mermaid Render Failed, using Fallback Text")
+                err_p = _new_paragraph(doc, f"[DIAGRAM GENERATION FAILED]\n{block['content']}")
+                elements.append(err_p._element)
+        else:
+            new_p = _new_paragraph(doc)
+            apply_markdown_to_paragraph(new_p, block['content'], styles)
+            elements.append(new_p._element)
+    return elements
+
+def patch_docx_incremental(prev_docx_path, prev_structure, structure, prev_layout, output_path):
+    """
+    Applies only the paragraph-level diff between `prev_structure` and `structure` to the
+    previous revision's DOCX. Untouched paragraphs are never re-rendered, so the work done
+    here scales with the size of the edit rather than the size of the document.
+
+    `prev_layout` is the layout returned when the previous revision was written, or None
+    if `prev_docx_path` is the unpatched upload.
+    Returns the new layout, or None if the layout doesn't match the file (caller should
+    fall back to patch_docx_from_structure).
+    """
+    doc = template_cache.open_document(prev_docx_path)
+    body = doc.element.body
+    styles = template_cache.get_derived(prev_docx_path, "style_index", lambda: style_index.build_style_index(doc))
+
+    # 0. Style definitions: only the ones that changed since the previous revision
+    old_styles = prev_structure.get("meta", {}).get("styles", {})
+    new_styles = structure.get("meta", {}).get("styles", {})
+    changed_styles = {k: v for k, v in new_styles.items() if old_styles.get(k) != v}
+    if changed_styles:
+        apply_style_definitions(doc, changed_styles, styles)
+
+    # 1. Resolve pid -> body elements from the previous layout
+    children = list(body.iterchildren())
+    if prev_layout is None:
+        prev_layout = original_layout(doc, sectioned=uses_section_ids(prev_structure))
+    if sum(count for _, count in prev_layout) != len(children):
+        print("DEBUG: Revision layout doesn't match document body, falling back to full patch")
+        return None
+
+    elements_by_pid = {}
+    owners = {}
+    pos = 0
+    for pid, count in prev_layout:
+        if pid is not None:
+            els = children[pos:pos + count]
+            elements_by_pid.setdefault(pid, []).extend(els)
+            for el in els:
+                owners[el] = pid
+        pos += count
+    del children
+
+    old_paragraphs = list(iter_structure_paragraphs(prev_structure))
+    new_paragraphs = list(iter_structure_paragraphs(structure))
+    diff = diff_paragraphs(old_paragraphs, new_paragraphs)
+    print(f"DEBUG: Incremental patch - changed {len(diff['changed'])}, inserted {len(diff['inserted'])}, "
+          f"deleted {len(diff['deleted'])}, moved {len(diff['moved'])}")
+
+    # 2. Deletions
+    doomed = []
+    for pid in diff["deleted"]:
+        for el in elements_by_pid.pop(pid, []):
+            owners.pop(el, None)
+            doomed.append(el)
+    _remove_elements(body, doomed)
+
+    # 3. Walk the new order with a cursor (the last element placed so far).
+    # Untouched paragraphs only move the cursor.
+    old_by_id = {p["id"]: p for p in old_paragraphs}
+    cursor = None
+    for p_struct in new_paragraphs:
+        pid = p_struct["id"]
+        els = elements_by_pid.get(pid)
+
+        if pid in diff["changed"] or pid in diff["inserted"] or not els:
+            simple = False
+            if els and len(els) == 1 and els[0].tag == _w("p"):
+                blocks = extract_blocks(p_struct["text"])
+                simple = len(blocks) == 1 and blocks[0]['type'] == 'text'
+
+            if simple:
+                # Same path as the full patcher: keep the paragraph (and its pPr), rewrite the runs
+                p_obj = Paragraph(els[0], doc._body)
+                apply_markdown_to_paragraph(p_obj, p_struct["text"], styles)
+                old_type = old_by_id[pid].get("type", "text") if pid in old_by_id else None
+                new_type = p_struct.get("type", "text")
+                if old_type != new_type:
+                    _set_paragraph_style(p_obj, new_type, fallback="Normal", styles=styles)
+            else:
+                for el in els or []:
+                    owners.pop(el, None)
+                    body.remove(el)
+                els = build_paragraph_elements(doc, p_struct, styles=styles)
+                elements_by_pid[pid] = els
+                for el in els:
+                    owners[el] = pid
+                # Fresh elements always need placing
+                _place_after(body, cursor, els)
+                if els:
+                    cursor = els[-1]
+                continue
+
+        if pid in diff["moved"]:
+            _place_after(body, cursor, els)
+
+        if els:
+            cursor = els[-1]
+
+    # 4. Table cells
+    _patch_tables(body, owners, _structure_tables(structure), _structure_tables(prev_structure))
+
+    package_writer.save_document(doc, output_path, source_path=prev_docx_path)
+    layout = body_layout(body, owners)
+    # The next save of this document starts from exactly this package
+    template_cache.store_document(output_path, doc, derived={"style_index": styles})
+    return layout
+
+def _remove_elements(body, elements):
+    """
+    Removes many body children at once. Past a handful of elements, rebuilding the
+    child list in one slice assignment is cheaper than unlinking them one by one.
+    """
+    if not elements:
+        return
+    if len(elements) < 32:
+        for el in elements:
+            body.remove(el)
+        return
+    doomed = set(elements)
+    body[:] = [el for el in body if el not in doomed]
+
+def _place_after(body, cursor, elements):
+    # Moves `elements` (in order) to sit right after `cursor`, or at the top of the body
+    for el in elements:
+        if cursor is None:
+            body.insert(0, el)
+        else:
+            cursor.addnext(el)
+        cursor = el
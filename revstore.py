@@ -0,0 +1,193 @@
+"""
+Content-addressed store for revision DOCX files.
+
+A revision is kept as a manifest (revisions/<rev>.manifest.json) listing its zip
+members, while the members themselves live in parts/<sha256>, keyed by the hash of
+their compressed bytes. The patcher copies unchanged parts byte for byte (see
+package_writer), so images, fonts, styles and the like are stored once per document
+and every new revision only adds the parts it changed, typically word/document.xml.
+
+revisions/<rev>.docx is a cache: the newest REVISION_CACHE_SIZE revisions are kept
+as ready-made files and older ones are rebuilt from their manifest on demand.
+"""
+import os
+import json
+import time
+import hashlib
+import zipfile
+import tempfile
+from doc_editor import package_writer
+
+REVISION_CACHE_SIZE = int(os.environ.get("REVISION_CACHE_SIZE", "3"))
+
+# Revisions that are never evicted from the cache: "0" is a hard link to the upload blob,
+# so it costs nothing and is not ingested
+PINNED_REVISIONS = ("0",)
+
+def get_parts_dir(doc_dir):
+    return os.path.join(doc_dir, 'parts')
+
+def get_docx_path(doc_dir, rev_id):
+    return os.path.join(doc_dir, 'revisions', f'{rev_id}.docx')
+
+def get_manifest_path(doc_dir, rev_id):
+    return os.path.join(doc_dir, 'revisions', f'{rev_id}.manifest.json')
+
+def _part_path(doc_dir, digest):
+    return os.path.join(get_parts_dir(doc_dir), digest[:2], digest)
+
+def _write_atomic(path, data):
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.part')
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+def _member_key(m):
+    return (m["name"], m["compress_type"], m["crc"], m["file_size"], m["compress_size"])
+
+def ingest(doc_dir, rev_id, docx_path, parent_rev_id=None):
+    """
+    Adds the DOCX at `docx_path` to the store as revision `rev_id`.
+    Members identical to one of `parent_rev_id` (same name, CRC and sizes, the test the
+    patcher uses to copy them raw) reuse its part without being read or hashed again,
+    so only the delta from the parent revision is processed.
+    Returns (parts added, bytes added).
+    """
+    parent = {}
+    if parent_rev_id is not None and has_revision(doc_dir, parent_rev_id):
+        parent = {_member_key(m): m["sha"] for m in _read_manifest(doc_dir, parent_rev_id)["members"]}
+
+    members = []
+    added = 0
+    added_bytes = 0
+    with zipfile.ZipFile(docx_path) as zf:
+        for info in zf.infolist():
+            member = {
+                "name": info.filename,
+                "compress_type": info.compress_type,
+                "crc": info.CRC,
+                "file_size": info.file_size,
+                "compress_size": info.compress_size,
+                "date_time": list(info.date_time),
+                "external_attr": info.external_attr,
+                "flag_bits": info.flag_bits,
+            }
+            digest = parent.get(_member_key(member))
+            if digest is None or not os.path.exists(_part_path(doc_dir, digest)):
+                raw = package_writer.read_raw(zf, info)
+                digest = hashlib.sha256(raw).hexdigest()
+                path = _part_path(doc_dir, digest)
+                if not os.path.exists(path):
+                    _write_atomic(path, raw)
+                    added += 1
+                    added_bytes += len(raw)
+            member["sha"] = digest
+            members.append(member)
+    manifest = {"parent": parent_rev_id, "members": members}
+    _write_atomic(get_manifest_path(doc_dir, rev_id), json.dumps(manifest).encode('utf-8'))
+    return added, added_bytes
+
+def has_revision(doc_dir, rev_id):
+    return os.path.exists(get_manifest_path(doc_dir, rev_id))
+
+def _read_manifest(doc_dir, rev_id):
+    with open(get_manifest_path(doc_dir, rev_id), 'r') as f:
+        return json.load(f)
+
+def materialize(doc_dir, rev_id, output_path):
+    """Rebuilds revision `rev_id` at `output_path` from its manifest and stored parts."""
+    manifest = _read_manifest(doc_dir, rev_id)
+    directory = os.path.dirname(output_path)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.part')
+    os.close(fd)
+    try:
+        with zipfile.ZipFile(tmp_path, 'w') as zout:
+            for m in manifest["members"]:
+                info = zipfile.ZipInfo(m["name"], tuple(m["date_time"]))
+                info.compress_type = m["compress_type"]
+                info.CRC = m["crc"]
+                info.file_size = m["file_size"]
+                info.compress_size = m["compress_size"]
+                info.external_attr = m["external_attr"]
+                info.flag_bits = m["flag_bits"]
+                with open(_part_path(doc_dir, m["sha"]), 'rb') as f:
+                    package_writer.write_raw(zout, info, f.read())
+        os.replace(tmp_path, output_path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return output_path
+
+def checkout(doc_dir, rev_id):
+    """
+    Path of revision `rev_id` as a DOCX file, rebuilt from the store if it isn't cached.
+    Returns the path even if the revision doesn't exist (callers check os.path.exists).
+    """
+    path = get_docx_path(doc_dir, rev_id)
+    if os.path.exists(path):
+        _touch(path)
+    elif has_revision(doc_dir, rev_id):
+        materialize(doc_dir, rev_id, path)
+        print(f"DEBUG: Rebuilt revision {rev_id} from the revision store")
+    return path
+
+def _touch(path):
+    # LRU signal for trim_cache. Only the access time: the template cache keys on mtime.
+    try:
+        st = os.stat(path)
+        os.utime(path, ns=(time.time_ns(), st.st_mtime_ns))
+    except FileNotFoundError:
+        pass
+
+def trim_cache(doc_dir, keep=REVISION_CACHE_SIZE):
+    """Deletes all but the `keep` most recently used revision files that can be rebuilt."""
+    revisions_dir = os.path.join(doc_dir, 'revisions')
+    cached = []
+    for entry in os.scandir(revisions_dir):
+        if not entry.name.endswith('.docx'):
+            continue
+        rev_id = entry.name[:-len('.docx')]
+        if rev_id in PINNED_REVISIONS or not has_revision(doc_dir, rev_id):
+            continue
+        cached.append((entry.stat().st_atime_ns, entry.path))
+    cached.sort(reverse=True)
+    for _, path in cached[keep:]:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+def collect_garbage(doc_dir, live_rev_ids):
+    """
+    Drops the manifests of revisions not in `live_rev_ids`, then every part that no
+    remaining manifest references. Returns (manifests removed, parts removed).
+    """
+    live = set(live_rev_ids)
+    revisions_dir = os.path.join(doc_dir, 'revisions')
+    referenced = set()
+    removed_manifests = 0
+    for entry in os.scandir(revisions_dir):
+        if not entry.name.endswith('.manifest.json'):
+            continue
+        rev_id = entry.name[:-len('.manifest.json')]
+        if rev_id not in live:
+            os.remove(entry.path)
+            removed_manifests += 1
+            continue
+        with open(entry.path, 'r') as f:
+            referenced.update(m["sha"] for m in json.load(f)["members"])
+
+    removed_parts = 0
+    parts_dir = get_parts_dir(doc_dir)
+    if os.path.isdir(parts_dir):
+        for bucket in os.scandir(parts_dir):
+            if not bucket.is_dir():
+                continue
+            for part in os.scandir(bucket.path):
+                if part.name not in referenced and not part.name.endswith('.part'):
+                    os.remove(part.path)
+                    removed_parts += 1
+    return removed_manifests, removed_parts
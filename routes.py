@@ -1,9 +1,11 @@
-from flask import Blueprint, request, jsonify, send_file, current_app, abort, url_for
+from flask import Blueprint, request, jsonify, send_file, current_app, abort, url_for, Response, stream_with_context
 import os
+import json
 import time
 import requests
 from werkzeug.utils import secure_filename
-from doc_editor import storage, parsers, llm, applyer, pdf_gen, onlyoffice
+from doc_editor import storage, parsers, llm, applyer, pdf_gen, onlyoffice, llm_client
+from doc_editor.docmodel import DocumentModel
 
 doc_bp = Blueprint('doc', __name__)
 
@@ -71,7 +73,7 @@ def get_raw_doc(doc_id):
          path = storage.get_revision_path(doc_id, "0")
          # Fallback check
          if not os.path.exists(path):
-             path = os.path.join(current_app.config['UPLOAD_FOLDER'], doc_id, 'original.docx')
+             path = os.path.join(storage.get_doc_dir(doc_id), 'original.docx')
     else:
          path = storage.get_revision_path(doc_id, rev_id)
          
@@ -91,7 +93,7 @@ def get_pdf_preview(doc_id):
     try:
         rev_id = storage.get_latest_revision_id(doc_id)
         if rev_id == "0":
-             docx_path = os.path.join(current_app.config['UPLOAD_FOLDER'], doc_id, 'original.docx') # or revs/0.docx
+             docx_path = os.path.join(storage.get_doc_dir(doc_id), 'original.docx') # or revs/0.docx
              docx_path = storage.get_revision_path(doc_id, "0")
         else:
              docx_path = storage.get_revision_path(doc_id, rev_id)
@@ -99,7 +101,7 @@ def get_pdf_preview(doc_id):
         # Generate PDF
         # We store PDF in a 'previews' folder or temp?
         # Let's verify if PDF exists for this rev_id to cache it.
-        pdf_dir = os.path.join(current_app.config['UPLOAD_FOLDER'], doc_id, 'previews')
+        pdf_dir = os.path.join(storage.get_doc_dir(doc_id), 'previews')
         pdf_name = f"{rev_id}.pdf"
         pdf_path = os.path.join(pdf_dir, pdf_name)
         
@@ -146,14 +148,73 @@ def upload_file():
         return jsonify({"document_id": doc_id, "structure": structure})
     return jsonify({"error": "Invalid file type"}), 400
 
+def _etag_revision(value):
+    # ETags are the quoted revision id; accept weak ones too
+    value = (value or "").strip()
+    if value.startswith("W/"):
+        value = value[2:]
+    return value.strip('"') or None
+
+def _base_revision(data):
+    # Revision the client's edit was made against: If-Match (the ETag of /structure) or "base_rev"
+    return _etag_revision(request.headers.get('If-Match')) or (data or {}).get('base_rev')
+
+def _conflict_response(e):
+    return jsonify({
+        "error": "Document was modified by another edit; reload and retry",
+        "base_rev": e.base_rev,
+        "head_rev": e.head_rev
+    }), 409
+
+def _load_for_edit(doc_id, data):
+    # (base_rev, structure, None) to edit, or (None, None, error response): 404 for an unknown
+    # document, 409 if the client's base revision isn't the head
+    try:
+        # Read the head before the structure: a save in between then shows up as a conflict
+        head_rev = storage.get_latest_revision_id(doc_id)
+        base_rev = _base_revision(data) or head_rev
+        if base_rev != head_rev:
+            # Fail fast, before spending an LLM call on a stale document
+            return None, None, _conflict_response(storage.RevisionConflict(doc_id, base_rev, head_rev))
+        return base_rev, storage.get_structure(doc_id), None
+    except FileNotFoundError:
+        return None, None, (jsonify({"error": "Document not found"}), 404)
+
 @doc_bp.route('/doc/<doc_id>/structure', methods=['GET'])
 def get_structure(doc_id):
+    # ?sections=s1,s3 loads only those sections; the others come back as {id, title, hash} stubs
+    # ?rev=<rev_id> serves the structure snapshot of a retained revision instead of the head
+    # The ETag is the revision served; send it back as If-Match with /edit or /apply.
+    sections = request.args.get('sections')
+    section_ids = [s for s in sections.split(',') if s] if sections else None
+    rev_id = request.args.get('rev')
     try:
-        structure = storage.get_structure(doc_id)
-        return jsonify(structure)
+        etag_rev = rev_id or storage.get_latest_revision_id(doc_id)
+        if _etag_revision(request.headers.get('If-None-Match')) == etag_rev:
+            response = current_app.response_class(status=304)
+        else:
+            response = jsonify(storage.get_structure(doc_id, section_ids, rev_id=rev_id))
+        response.headers['ETag'] = f'"{etag_rev}"'
+        return response
     except FileNotFoundError:
+        if rev_id:
+            return jsonify({"error": "Revision not found"}), 404
         return jsonify({"error": "Document not found"}), 404
 
+@doc_bp.route('/doc/<doc_id>/revisions/<rev_id>/restore', methods=['POST'])
+def restore_revision(doc_id, rev_id):
+    # Moves the head back (or forward) to a retained revision; nothing is re-patched
+    try:
+        storage.restore_revision(doc_id, rev_id)
+    except FileNotFoundError as e:
+        return jsonify({"error": str(e)}), 404
+    return jsonify({
+        "status": "ok",
+        "head": rev_id,
+        "preview_html_url": f"/doc/{doc_id}/structure",
+        "docx_download_url": f"/doc/{doc_id}/download/{rev_id}"
+    })
+
 @doc_bp.route('/doc/<doc_id>/edit', methods=['POST'])
 def edit_document(doc_id):
     data = request.json
@@ -163,13 +224,16 @@ def edit_document(doc_id):
     if not instruction:
         return jsonify({"error": "Instruction is required"}), 400
 
+    base_rev, structure, error = _load_for_edit(doc_id, data)
+    if error:
+        return error
+
     try:
-        structure = storage.get_structure(doc_id)
-        
         # Rate limiting logic could go here (using storage or redis)
         
         # Call LLM
-        actions = llm.get_edit_actions(instruction, structure, context_pid)
+        actions = llm.get_edit_actions(instruction, structure, context_pid,
+                                       use_cache=not data.get('no_cache'))
         print(f"DEBUG: LLM Actions: {actions}")
         
         # Check for clarification
@@ -188,20 +252,109 @@ def edit_document(doc_id):
         # For the MVP flow described: "If valid, apply edits to the stored AST and generate... Patched DOCX file saved as a new revision."
         
         # Let's save the revision immediately as per requirements
-        rev_id = storage.save_revision(doc_id, new_structure, changes, instruction)
+        rev_id = storage.save_revision(doc_id, new_structure, changes, instruction, base_rev=base_rev)
         
         return jsonify({
             "status": "ok",
             "preview_html_url": f"/doc/{doc_id}/structure", # Frontend re-fetches structure
             "docx_download_url": f"/doc/{doc_id}/download/{rev_id}",
+            "rev_id": rev_id, # new ETag for the next edit
             "changes": changes,
             "actions": actions # Debugging safely
         })
         
+    except storage.RevisionConflict as e:
+        return _conflict_response(e)
+    except llm_client.LLMBusy as e:
+        response = jsonify({"error": str(e)})
+        response.headers['Retry-After'] = str(e.retry_after)
+        return response, 503
     except Exception as e:
         current_app.logger.error(f"Edit failed: {e}")
         return jsonify({"error": str(e)}), 500
 
+def _sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+def _apply_streamed(doc, batch, changes, applied):
+    # The "action" event for a batch of streamed actions, the last of which is action number applied - 1
+    done = len(changes)
+    applyer.apply_to_model(doc, batch, changes)
+    return {"index": applied - len(batch), "actions": batch, "changes": changes[done:]}
+
+@doc_bp.route('/doc/<doc_id>/edit/stream', methods=['POST'])
+def edit_document_stream(doc_id):
+    # Same request as /edit, answered as server-sent events while the model writes:
+    #   start     {base_rev}
+    #   action    {index, actions, changes} applied as soon as complete (a run of global
+    #                                       replacements together, with the action after it)
+    #   invalid   {action, error}           skipped
+    #   truncated {reason, finish_reason}   the response was cut off; the actions so far are kept
+    #   clarification {question}            nothing is saved
+    #   done      the /edit response body, once the revision is saved
+    #   conflict / error                    as the 409 / 5xx bodies of /edit
+    data = request.json
+    instruction = data.get('instruction')
+    context_pid = data.get('context')
+    
+    if not instruction:
+        return jsonify({"error": "Instruction is required"}), 400
+
+    base_rev, structure, error = _load_for_edit(doc_id, data)
+    if error:
+        return error
+    use_cache = not data.get('no_cache')
+
+    def generate():
+        doc = DocumentModel(structure)
+        changes = []
+        actions = []
+        replacements = [] # a run of replace_text_globally actions is applied together, as in /edit
+        truncated = False
+        yield _sse("start", {"base_rev": base_rev})
+        try:
+            for event, payload in llm.stream_edit_actions(instruction, structure, context_pid, use_cache=use_cache):
+                if event != "action":
+                    truncated = truncated or event == "truncated"
+                    yield _sse(event, payload)
+                    continue
+                if payload["action"] == "clarify":
+                    yield _sse("clarification", {"question": payload.get("question")})
+                    return
+                actions.append(payload)
+                if payload["action"] == "replace_text_globally":
+                    replacements.append(payload)
+                    continue
+                yield _sse("action", _apply_streamed(doc, replacements + [payload], changes, len(actions)))
+                replacements = []
+            if replacements:
+                yield _sse("action", _apply_streamed(doc, replacements, changes, len(actions)))
+            if not actions:
+                yield _sse("done", {"status": "ok", "rev_id": base_rev, "changes": [], "actions": [], "truncated": truncated})
+                return
+
+            rev_id = storage.save_revision(doc_id, doc.to_structure(), changes, instruction, base_rev=base_rev)
+            yield _sse("done", {
+                "status": "ok",
+                "preview_html_url": f"/doc/{doc_id}/structure",
+                "docx_download_url": f"/doc/{doc_id}/download/{rev_id}",
+                "rev_id": rev_id,
+                "changes": changes,
+                "actions": actions,
+                "truncated": truncated
+            })
+        except storage.RevisionConflict as e:
+            yield _sse("conflict", {"error": "Document was modified by another edit; reload and retry",
+                                    "base_rev": e.base_rev, "head_rev": e.head_rev})
+        except llm_client.LLMBusy as e:
+            yield _sse("error", {"error": str(e), "retry_after": e.retry_after})
+        except Exception as e:
+            current_app.logger.error(f"Streamed edit failed: {e}")
+            yield _sse("error", {"error": str(e)})
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
 @doc_bp.route('/doc/<doc_id>/download/<rev_id>', methods=['GET'])
 def download_revision(doc_id, rev_id):
     path = storage.get_revision_path(doc_id, rev_id)
@@ -223,5 +376,10 @@ def apply_manual_edits(doc_id):
     if not new_structure:
          return jsonify({"error": "Structure required"}), 400
          
-    rev_id = storage.save_revision(doc_id, new_structure, [{"type": "manual", "desc": "User manual edit"}], "Manual Edit")
-    return jsonify({"status": "ok", "docx_download_url": f"/doc/{doc_id}/download/{rev_id}"})
+    # Without a base revision the structure simply becomes the new head
+    try:
+        rev_id = storage.save_revision(doc_id, new_structure, [{"type": "manual", "desc": "User manual edit"}], "Manual Edit",
+                                       base_rev=_base_revision(data))
+    except storage.RevisionConflict as e:
+        return _conflict_response(e)
+    return jsonify({"status": "ok", "rev_id": rev_id, "docx_download_url": f"/doc/{doc_id}/download/{rev_id}"})
@@ -0,0 +1,255 @@
+"""
+Codecs for stored structure sections.
+
+STRUCTURE_CODEC picks the one new sections are written with:
+
+  json     stdlib json, compact, key-sorted, UTF-8 (the default)
+  orjson   JSON through orjson, when it is installed (much faster)
+  binary   a compact tagged binary format (below)
+
+Every codec is deterministic, since stored sections are named by the hash of their
+bytes. decode() recognises all formats, so documents can mix codecs and the setting
+can change at any time. The codecs read each other's output but don't write the same
+bytes: json and orjson differ at least in how they write floats like 1e16. Every save
+re-encodes all sections of a document, so after a change of codec each section is
+written once more under its new hash the next time its document is saved.
+
+The binary format ("DSB1") stores each distinct string once, in a table at the start.
+Dict key sets ("shapes", e.g. id/text/type) are listed once too, so a paragraph costs a
+shape index plus one table index per value. Ids like s3_p17 that follow the previous
+id (s3_p16) are written as a single byte.
+"""
+import os
+import re
+import json
+import struct
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+STRUCTURE_CODEC = os.environ.get("STRUCTURE_CODEC", "json")
+
+class JsonCodec:
+    name = "json"
+    suffix = ".json"
+
+    def encode(self, value):
+        # Raw UTF-8 like orjson (sections written before used \u escapes for non-ASCII)
+        return json.dumps(value, sort_keys=True, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+
+    def decode(self, data):
+        return json.loads(data)
+
+class OrjsonCodec:
+    name = "orjson"
+    suffix = ".json"
+
+    def encode(self, value):
+        return orjson.dumps(value, option=orjson.OPT_SORT_KEYS)
+
+    def decode(self, data):
+        return orjson.loads(data)
+
+# --- Binary format ---
+
+MAGIC = b"DSB1"
+
+_NONE, _FALSE, _TRUE, _INT, _FLOAT, _STR, _LIST, _DICT, _NEXT_ID = range(9)
+
+_ID_PATTERN = re.compile(r'^(.*?)(\d+)$')
+_DOUBLE = struct.Struct('<d')
+
+# Tags followed by a varint (string index, shape index, length or zigzag integer)
+_INDEXED = frozenset((_STR, _DICT, _LIST, _INT))
+
+def _id_parts(match):
+    # (prefix, number) of an id ending in a canonical number, the only ones _NEXT_ID continues
+    if match is None or match.group(2) != str(int(match.group(2))):
+        return None
+    return match.group(1), int(match.group(2))
+
+def _varint(out, n):
+    while n > 0x7f:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+
+class BinaryCodec:
+    name = "binary"
+    suffix = ".bin"
+
+    def encode(self, value):
+        strings = {}
+        shapes = {}
+        body = bytearray()
+        last_id = [None] # (prefix, number) of the last id written
+
+        def string(s):
+            index = strings.get(s)
+            if index is None:
+                index = strings[s] = len(strings)
+            return index
+
+        def write(v, key=None):
+            if v is None:
+                body.append(_NONE)
+            elif v is True:
+                body.append(_TRUE)
+            elif v is False:
+                body.append(_FALSE)
+            elif isinstance(v, str):
+                if key == "id":
+                    m = _ID_PATTERN.match(v)
+                    prev = last_id[0]
+                    # str(int()) round trip: "p07" must not come back as "p7"
+                    if m is not None and prev is not None and prev[0] == m.group(1) and m.group(2) == str(prev[1] + 1):
+                        body.append(_NEXT_ID)
+                        last_id[0] = (prev[0], prev[1] + 1)
+                        return
+                    last_id[0] = _id_parts(m)
+                body.append(_STR)
+                _varint(body, string(v))
+            elif isinstance(v, dict):
+                keys = tuple(sorted(v))
+                shape = shapes.get(keys)
+                if shape is None:
+                    for k in keys:
+                        if not isinstance(k, str):
+                            raise TypeError(f"Binary codec needs string keys, got {k!r}")
+                    shape = shapes[keys] = len(shapes)
+                body.append(_DICT)
+                _varint(body, shape)
+                for k in keys:
+                    write(v[k], k)
+            elif isinstance(v, (list, tuple)):
+                body.append(_LIST)
+                _varint(body, len(v))
+                for item in v:
+                    write(item)
+            elif isinstance(v, int):
+                body.append(_INT)
+                _varint(body, (v << 1) if v >= 0 else ((-v << 1) - 1)) # zigzag
+            elif isinstance(v, float):
+                body.append(_FLOAT)
+                body.extend(_DOUBLE.pack(v))
+            else:
+                raise TypeError(f"Binary codec can't encode {type(v).__name__}")
+
+        write(value)
+        # Shape keys go into the string table after the values, so it's built before writing it
+        shape_indexes = [[string(k) for k in keys] for keys in shapes]
+
+        out = bytearray(MAGIC)
+        _varint(out, len(strings))
+        for s in strings:
+            data = s.encode('utf-8')
+            _varint(out, len(data))
+            out += data
+        _varint(out, len(shape_indexes))
+        for indexes in shape_indexes:
+            _varint(out, len(indexes))
+            for i in indexes:
+                _varint(out, i)
+        out += body
+        return bytes(out)
+
+    def decode(self, data):
+        data = bytes(data)
+        if data[:4] != MAGIC:
+            raise ValueError("Not a DSB1 binary structure")
+        pos = 4
+
+        def varint():
+            nonlocal pos
+            result = shift = 0
+            while True:
+                b = data[pos]
+                pos += 1
+                result |= (b & 0x7f) << shift
+                if b < 0x80:
+                    return result
+                shift += 7
+
+        strings = []
+        for _ in range(varint()):
+            n = varint()
+            strings.append(data[pos:pos + n].decode('utf-8'))
+            pos += n
+        shapes = []
+        for _ in range(varint()):
+            shapes.append(tuple(strings[varint()] for _ in range(varint())))
+
+        last_id = [None]
+
+        def read(key=None):
+            nonlocal pos
+            tag = data[pos]
+            n = data[pos + 1] if tag in _INDEXED else 0
+            if n < 0x80:
+                # Single-byte count or index, by far the most common case
+                pos += 2 if tag in _INDEXED else 1
+            else:
+                pos += 1
+                n = varint()
+            if tag == _STR:
+                s = strings[n]
+                if key == "id":
+                    last_id[0] = _id_parts(_ID_PATTERN.match(s))
+                return s
+            if tag == _DICT:
+                return {k: read(k) for k in shapes[n]}
+            if tag == _LIST:
+                return [read() for _ in range(n)]
+            if tag == _NEXT_ID:
+                prefix, number = last_id[0]
+                last_id[0] = (prefix, number + 1)
+                return f"{prefix}{number + 1}"
+            if tag == _NONE:
+                return None
+            if tag == _TRUE:
+                return True
+            if tag == _FALSE:
+                return False
+            if tag == _INT:
+                return (n >> 1) if not n & 1 else -((n + 1) >> 1)
+            if tag == _FLOAT:
+                value = _DOUBLE.unpack_from(data, pos)[0]
+                pos += 8
+                return value
+            raise ValueError(f"Bad tag {tag} at offset {pos - 1}")
+
+        return read()
+
+CODECS = {"json": JsonCodec(), "binary": BinaryCodec()}
+if orjson is not None:
+    CODECS["orjson"] = OrjsonCodec()
+
+def get_codec(name=None):
+    """The codec called `name`, STRUCTURE_CODEC by default."""
+    name = name or STRUCTURE_CODEC
+    if name not in CODECS:
+        hint = " (pip install orjson)" if name == "orjson" else ""
+        raise ValueError(f"Unknown STRUCTURE_CODEC {name!r}{hint}; available: {', '.join(CODECS)}")
+    return CODECS[name]
+
+def _json_codec():
+    return CODECS.get("orjson") or CODECS["json"]
+
+def codec_of(data):
+    """The codec that reads `data` (bytes or str): binary by its magic number, JSON otherwise."""
+    if isinstance(data, (bytes, bytearray, memoryview)) and bytes(data[:4]) == MAGIC:
+        return CODECS["binary"]
+    return _json_codec()
+
+def encode(value, codec=None):
+    return get_codec(codec).encode(value)
+
+def decode(data):
+    return codec_of(data).decode(data)
+
+def suffixes():
+    """File suffixes in use, the current codec's first."""
+    current = get_codec().suffix
+    return [current] + sorted({c.suffix for c in CODECS.values()} - {current})
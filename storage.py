@@ -1,99 +1,430 @@
 import os
 import shutil
-import json
 import time
+import hashlib
+import tempfile
+import fcntl
+from contextlib import contextmanager
 from werkzeug.utils import secure_filename
-from doc_editor import parsers, utils
+from doc_editor import parsers, utils, revstore, metastore, docpaths, serialization, jsoncache
 
 BASE_DIR = os.path.join(os.getcwd(), 'data')
 
+# Content-addressed store: uploads are kept once per distinct content hash,
+# together with their parsed structure.
+BLOB_DIR = os.path.join(BASE_DIR, '_blobs')
+PARSE_CACHE_DIR = os.path.join(BASE_DIR, '_parse_cache')
+PARSE_CACHE_MAX_ENTRIES = int(os.environ.get("PARSE_CACHE_MAX_ENTRIES", "500"))
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+HISTORY_LIMIT = 10
+
+# Per-process counters (see parse_cache_stats)
+_parse_cache_stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+def _meta():
+    # Metadata backend (STORAGE_BACKEND, see metastore); DOCX and PDF files stay under BASE_DIR
+    return metastore.get_metastore(BASE_DIR)
+
+def get_doc_dir(doc_id):
+    # data/ab/cd/<doc_id>, or data/<doc_id> for documents not migrated yet (see docpaths)
+    return docpaths.get_doc_dir(BASE_DIR, doc_id)
+
+class RevisionConflict(Exception):
+    """The revision an update was based on is no longer the document's head revision."""
+
+    def __init__(self, doc_id, base_rev, head_rev):
+        super().__init__(f"Document {doc_id} is at revision {head_rev}, not {base_rev}")
+        self.base_rev = base_rev
+        self.head_rev = head_rev
+
+@contextmanager
+def document_lock(doc_id):
+    """
+    Exclusive lock on one document, held while its revision state changes. It's an flock
+    on <doc dir>/.lock, so it holds across threads and gunicorn worker processes
+    alike; other documents are never blocked.
+    migrate_layout moves a document directory while holding its lock, so a lock taken
+    on the old location is retried on the new one.
+    """
+    while True:
+        doc_dir = get_doc_dir(doc_id)
+        if not os.path.isdir(doc_dir):
+            raise FileNotFoundError(f"Document {doc_id} not found")
+        with open(os.path.join(doc_dir, '.lock'), 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                if get_doc_dir(doc_id) != doc_dir:
+                    continue # moved while we waited
+                yield
+                return
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
 def create_document(file):
-    doc_id = str(int(time.time() * 1000)) # Simple ID
-    doc_dir = os.path.join(BASE_DIR, doc_id)
-    os.makedirs(doc_dir, exist_ok=True)
+    doc_id = docpaths.new_doc_id()
+    doc_dir = docpaths.shard_dir(BASE_DIR, doc_id)
+    os.makedirs(doc_dir) # ids don't collide; fail loudly if one ever does
     os.makedirs(os.path.join(doc_dir, 'revisions'), exist_ok=True)
     
+    # Hash while streaming to disk; identical uploads share one blob
+    digest, blob_path = store_upload_blob(file)
     original_path = os.path.join(doc_dir, 'original.docx')
-    file.save(original_path)
+    _link_or_copy(blob_path, original_path)
     
-    # Initial Parse
-    structure = parsers.parse_docx_to_structure(original_path)
-    with open(os.path.join(doc_dir, 'structure.json'), 'w') as f:
-        json.dump(structure, f)
+    # Initial Parse (skipped when these exact bytes were parsed before)
+    structure = get_cached_parse(digest, blob_path)
         
     # Initial Revision 0
-    shutil.copy(original_path, os.path.join(doc_dir, 'revisions', '0.docx'))
+    _link_or_copy(blob_path, os.path.join(doc_dir, 'revisions', '0.docx'))
     
-    # Init History
-    history = [{
-        "rev_id": "0",
-        "timestamp": time.time(),
-        "instruction": "Original Upload",
-        "changes": []
-    }]
-    with open(os.path.join(doc_dir, 'history.json'), 'w') as f:
-        json.dump(history, f)
+    meta = _meta()
+    with meta.transaction():
+        meta.create_document(doc_id, time.time())
+        write_structure(doc_id, structure, rev_id="0")
+        # Init History
+        meta.append_history(doc_id, {
+            "rev_id": "0",
+            "timestamp": time.time(),
+            "instruction": "Original Upload",
+            "changes": []
+        }, HISTORY_LIMIT)
         
     return doc_id
 
-def get_structure(doc_id):
-    path = os.path.join(BASE_DIR, doc_id, 'structure.json')
-    if not os.path.exists(path):
-        raise FileNotFoundError()
-    with open(path, 'r') as f:
-        return json.load(f)
+def list_documents():
+    return _meta().list_documents()
+
+def get_structure(doc_id, section_ids=None, rev_id=None):
+    """
+    The document's current structure, or the snapshot of revision `rev_id`.
+    With `section_ids`, only those sections are loaded; the others are returned as stubs
+    ({id, title, hash}, no paragraphs or tables). Stubs can be passed back to
+    save_revision as they are.
+    Sections and meta may be shared with a read cache (see jsoncache): don't modify them
+    in place (applyer.apply_actions never does).
+    """
+    manifest = _meta().read_manifest(doc_id, rev_id)
+    wanted = set(section_ids) if section_ids is not None else None
+    sections = []
+    for entry in manifest.get("sections", []):
+        if "hash" not in entry or (wanted is not None and entry.get("id") not in wanted):
+            # Inline section (structure.json written before sections were split out) or a stub
+            sections.append(entry)
+        else:
+            sections.append(load_section(doc_id, entry["hash"]))
+    structure = dict(manifest)
+    structure["sections"] = sections
+    return structure
+
+# --- Per-section storage ---
+#
+# The stored structure is a manifest: meta plus one {id, title, hash} entry per section.
+# Each section is stored on its own, encoded with STRUCTURE_CODEC (see serialization) and
+# keyed by the sha256 of the encoded bytes, so a save
+# only writes the sections that actually changed and readers can load just the sections
+# they need (sections/<hash>.json or .bin with the files backend).
+#
+# Every revision also keeps a copy of its manifest as a snapshot
+# (revisions/<rev>.structure.json). Snapshots share the stored sections, so one costs a
+# few hundred bytes plus the sections its edit changed. The head manifest
+# (structure.json) is the current structure: restoring a revision just puts its snapshot
+# back there and points HEAD at it.
 
-def save_revision(doc_id, structure, changes, instruction):
-    doc_dir = os.path.join(BASE_DIR, doc_id)
-    rev_id = str(int(time.time() * 1000))
+def _is_stub(section):
+    return "hash" in section and "paragraphs" not in section
+
+def encode_section(section):
+    """(content hash, encoded bytes) of a section."""
+    data = serialization.encode(section)
+    return hashlib.sha256(data).hexdigest(), data
+
+def load_section(doc_id, section_hash):
+    return _meta().load_section(doc_id, section_hash)
+
+def write_structure(doc_id, structure, encoded=None, rev_id=None):
+    """
+    Stores `structure` as the document's current structure, and as the snapshot of
+    revision `rev_id` if given. Sections whose content is already stored (and stubs from
+    get_structure) cost no write. `encoded` is the encode_section() result for each
+    section, if the caller already has it.
+    Returns the manifest's section entries.
+    """
+    meta = _meta()
+    entries = []
+    for i, sec in enumerate(structure.get("sections", [])):
+        if _is_stub(sec):
+            entries.append({"id": sec.get("id"), "title": sec.get("title"), "hash": sec["hash"]})
+            continue
+        section_hash, data = encoded[i] if encoded is not None else encode_section(sec)
+        meta.put_section(doc_id, section_hash, data, sec)
+        entries.append({"id": sec.get("id"), "title": sec.get("title"), "hash": section_hash})
+
+    manifest = {k: v for k, v in structure.items() if k != "sections"}
+    manifest["sections"] = entries
+    with meta.transaction():
+        meta.write_manifest(doc_id, manifest, rev_id)
+    return entries
+
+def _resolve_sections(doc_id, structure, loaded=None):
+    """
+    `structure` with every stub replaced by its stored section. `loaded` maps hashes to
+    sections already in memory, so each one is read from disk at most once.
+    """
+    if not any(_is_stub(sec) for sec in structure.get("sections", [])):
+        return structure
+    loaded = loaded if loaded is not None else {}
+    sections = []
+    for sec in structure["sections"]:
+        if _is_stub(sec):
+            if sec["hash"] not in loaded:
+                loaded[sec["hash"]] = load_section(doc_id, sec["hash"])
+            sec = loaded[sec["hash"]]
+        sections.append(sec)
+    return dict(structure, sections=sections)
+
+def _previous_structure(doc_id, structure, encoded):
+    """
+    The stored structure, for diffing against `structure` (fully loaded, with `encoded`
+    its encode_section() results). Sections whose hash didn't change are taken from
+    `structure` instead of being read back from disk, so only the sections in play are loaded.
+    """
+    try:
+        manifest = _meta().read_manifest(doc_id)
+    except FileNotFoundError:
+        return None
+    current = {}
+    for sec, (section_hash, _) in zip(structure.get("sections", []), encoded):
+        current.setdefault(section_hash, sec)
+    return _resolve_sections(doc_id, manifest, loaded=current)
+
+def save_revision(doc_id, structure, changes, instruction, base_rev=None):
+    """
+    Writes `structure` as a new revision on top of the head revision and returns its id.
+    `base_rev` is the head revision the caller read `structure` from (optimistic
+    concurrency): if another revision was saved in the meantime, RevisionConflict is raised
+    and nothing is written.
+    """
+    with document_lock(doc_id):
+        head = get_latest_revision_id(doc_id)
+        if base_rev is not None and base_rev != head:
+            raise RevisionConflict(doc_id, base_rev, head)
+        return _write_revision(doc_id, structure, changes, instruction)
+
+def _write_revision(doc_id, structure, changes, instruction):
+    # Only called with the document lock held
+    doc_dir = get_doc_dir(doc_id)
+    meta = _meta()
+    rev_id = meta.next_revision_id(doc_id)
     
-    # Save JSON structure
-    with open(os.path.join(doc_dir, 'structure.json'), 'w') as f:
-        json.dump(structure, f)
+    # Stub sections (see get_structure) are unchanged: load them for the patcher
+    structure = _resolve_sections(doc_id, structure)
+    encoded = [encode_section(sec) for sec in structure.get("sections", [])]
+    
+    # Previous state, needed to patch incrementally
+    prev_rev_id = get_latest_revision_id(doc_id)
+    prev_structure = _previous_structure(doc_id, structure, encoded)
         
     # Create DOCX Patch
-    # We base off 'original.docx' and apply edits? 
-    # OR we base off the LAST revision?
-    # Ideally base off the previous revision to keep accumulation? 
-    # Or always original + current structure? 
-    # parsers.patch_docx_from_structure implementation currently works on *an* input file.
-    # If we use original.docx, we lose previous structural changes if our pacther isn't perfect.
-    # Let's use original to serve as the template, assuming structure has full state.
+    # Fast path: apply only the paragraph diff to the previous revision's DOCX.
+    # Fallback: rebuild from 'original.docx' as the template, assuming structure has full state
+    # (used when the previous revision has no layout, e.g. revisions written before layouts existed).
     original_path = os.path.join(doc_dir, 'original.docx')
-    rev_path = os.path.join(doc_dir, 'revisions', f'{rev_id}.docx')
+    rev_path = revstore.get_docx_path(doc_dir, rev_id)
+    prev_path = get_revision_path(doc_id, prev_rev_id)
     
-    parsers.patch_docx_from_structure(original_path, structure, rev_path)
+    layout = None
+    prev_layout = get_revision_layout(doc_id, prev_rev_id)
+    if prev_structure is not None and os.path.exists(prev_path) and (prev_layout is not None or prev_rev_id == "0"):
+        try:
+            layout = parsers.patch_docx_incremental(prev_path, prev_structure, structure, prev_layout, rev_path)
+        except Exception as e:
+            print(f"DEBUG: Incremental patch failed ({e}), falling back to full patch")
+            layout = None
     
-    # Update History
-    hist_path = os.path.join(doc_dir, 'history.json')
-    with open(hist_path, 'r') as f:
-        history = json.load(f)
-        
-    history.append({
-        "rev_id": rev_id,
-        "timestamp": time.time(),
-        "instruction": instruction,
-        "changes": changes
-    })
+    if layout is None:
+        layout = parsers.patch_docx_from_structure(original_path, structure, rev_path)
     
-    # Keep only last 10
-    if len(history) > 10:
-        history = history[-10:]
-        
-    with open(hist_path, 'w') as f:
-        json.dump(history, f)
+    # Keep the revision in the part store; rev_path stays as its cached copy
+    added, added_bytes = revstore.ingest(doc_dir, rev_id, rev_path, parent_rev_id=prev_rev_id)
+    print(f"DEBUG: Revision {rev_id} stored: {added} new parts, {added_bytes} bytes")
+    
+    # Save JSON structure, layout and history; the sqlite backend commits them together
+    with meta.transaction():
+        write_structure(doc_id, structure, encoded, rev_id=rev_id)
+        meta.write_layout(doc_id, rev_id, layout)
+        # Keep only the last HISTORY_LIMIT entries
+        history = meta.append_history(doc_id, {
+            "rev_id": rev_id,
+            "timestamp": time.time(),
+            "instruction": instruction,
+            "changes": changes
+        }, HISTORY_LIMIT)
+        meta.set_head(doc_id, rev_id)
+    
+    # Once the upload entry has gone, every save pushes a revision out of the history
+    trimmed = history[0]["rev_id"] != "0"
+    if trimmed:
+        collect_revision_garbage(doc_id, [h["rev_id"] for h in history])
+    revstore.trim_cache(doc_dir)
         
     return rev_id
 
 def get_latest_revision_id(doc_id):
-    hist_path = os.path.join(BASE_DIR, doc_id, 'history.json')
-    if not os.path.exists(hist_path):
+    # The head revision: the newest one, unless an older one was restored since
+    head = _meta().get_head(doc_id)
+    if head is not None:
+        return head
+    try:
+        history = get_history(doc_id)
+    except FileNotFoundError:
         return "0"
-    with open(hist_path, 'r') as f:
-        history = json.load(f)
     if not history:
         return "0"
     return history[-1]['rev_id']
 
+def get_history(doc_id):
+    # May be shared with the read cache: copy before modifying
+    return _meta().get_history(doc_id)
+
+def restore_revision(doc_id, rev_id):
+    """
+    Makes retained revision `rev_id` the head again: its structure snapshot becomes the
+    current structure and the next save patches its DOCX. Nothing is re-parsed or
+    re-patched, and later revisions stay in the history.
+    Raises FileNotFoundError if the revision isn't retained or has no snapshot.
+    """
+    with document_lock(doc_id):
+        return _restore_revision(doc_id, rev_id)
+
+def _restore_revision(doc_id, rev_id):
+    meta = _meta()
+    retained = {h["rev_id"] for h in get_history(doc_id)} | set(revstore.PINNED_REVISIONS)
+    if rev_id not in retained:
+        raise FileNotFoundError(f"Revision {rev_id} not found")
+    if not meta.has_snapshot(doc_id, rev_id):
+        raise FileNotFoundError(f"Revision {rev_id} has no structure snapshot")
+
+    with meta.transaction():
+        meta.write_manifest(doc_id, meta.read_manifest(doc_id, rev_id))
+        meta.set_head(doc_id, rev_id)
+    return rev_id
+
 def get_revision_path(doc_id, rev_id):
-    return os.path.join(BASE_DIR, doc_id, 'revisions', f'{rev_id}.docx')
+    # Rebuilt from the revision store if it has been evicted from the cache
+    return revstore.checkout(get_doc_dir(doc_id), rev_id)
+
+def collect_revision_garbage(doc_id, live_rev_ids):
+    """
+    Deletes everything kept for revisions that are no longer in the history (cached DOCX,
+    layout, structure snapshot, PDF preview, store manifest), then the parts and sections
+    only they referenced.
+    Revision "0" is always kept: the full patcher and the raw route fall back to it.
+    """
+    doc_dir = get_doc_dir(doc_id)
+    live = set(live_rev_ids) | set(revstore.PINNED_REVISIONS)
+    revisions_dir = os.path.join(doc_dir, 'revisions')
+    previews_dir = os.path.join(doc_dir, 'previews')
+    dead = _meta().drop_revisions(doc_id, live)
+    for entry in os.scandir(revisions_dir):
+        if not entry.name.endswith('.docx'):
+            continue # metadata (dropped above), store manifests (revstore drops those below), writes in progress
+        rev_id = entry.name[:-len('.docx')]
+        if rev_id not in live:
+            dead.add(rev_id)
+            os.remove(entry.path)
+    for rev_id in dead:
+        pdf_path = os.path.join(previews_dir, f'{rev_id}.pdf')
+        if os.path.exists(pdf_path):
+            os.remove(pdf_path)
+    manifests, parts = revstore.collect_garbage(doc_dir, live)
+    sections = _meta().collect_section_garbage(doc_id)
+    print(f"DEBUG: Revision GC for {doc_id}: {len(dead)} revisions, {manifests} manifests, "
+          f"{parts} parts, {sections} sections removed")
+
+def get_revision_layout(doc_id, rev_id):
+    # Body layout written alongside a revision by the patcher; None for the upload or legacy revisions
+    return _meta().read_layout(doc_id, rev_id)
+
+# --- Content-addressed uploads and parse cache ---
+
+def store_upload_blob(file):
+    """
+    Streams an uploaded file into the blob store, hashing it on the way.
+    Returns (sha256 hex digest, blob path). A blob that already exists is reused.
+    """
+    os.makedirs(BLOB_DIR, exist_ok=True)
+    sha = hashlib.sha256()
+    fd, tmp_path = tempfile.mkstemp(dir=BLOB_DIR, suffix='.part')
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            while True:
+                chunk = file.stream.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                sha.update(chunk)
+                out.write(chunk)
+        digest = sha.hexdigest()
+        blob_path = get_blob_path(digest)
+        if os.path.exists(blob_path):
+            os.remove(tmp_path)
+        else:
+            os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+            os.replace(tmp_path, blob_path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return digest, blob_path
+
+def get_blob_path(digest):
+    return os.path.join(BLOB_DIR, digest[:2], f'{digest}.docx')
+
+def _link_or_copy(src, dst):
+    # Blobs are never written in place, so a hard link is safe to share
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy(src, dst)
+
+def get_cached_parse(digest, docx_path):
+    """
+    Parsed structure for the DOCX with content hash `digest`, parsing `docx_path` on a miss.
+    Entries are keyed by hash and parser structure version; least recently used
+    entries are evicted past PARSE_CACHE_MAX_ENTRIES.
+    """
+    cache_path = os.path.join(PARSE_CACHE_DIR, f'{digest}.v{parsers.STRUCTURE_VERSION}.json')
+    try:
+        structure = jsoncache.read_json(cache_path, cache=False)
+        os.utime(cache_path) # mark as recently used
+        _parse_cache_stats["hits"] += 1
+        return structure
+    except (FileNotFoundError, ValueError):
+        pass
+
+    _parse_cache_stats["misses"] += 1
+    structure = parsers.parse_docx_to_structure(docx_path)
+
+    os.makedirs(PARSE_CACHE_DIR, exist_ok=True)
+    jsoncache.write_json(cache_path, structure, cache=False)
+    _evict_parse_cache()
+    return structure
+
+def _evict_parse_cache():
+    entries = [e for e in os.scandir(PARSE_CACHE_DIR) if e.name.endswith('.json')]
+    excess = len(entries) - PARSE_CACHE_MAX_ENTRIES
+    if excess <= 0:
+        return
+    entries.sort(key=lambda e: e.stat().st_mtime)
+    for e in entries[:excess]:
+        try:
+            os.remove(e.path)
+            _parse_cache_stats["evictions"] += 1
+        except FileNotFoundError:
+            pass
+
+def parse_cache_stats():
+    stats = dict(_parse_cache_stats)
+    lookups = stats["hits"] + stats["misses"]
+    stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+    return stats
@@ -0,0 +1,103 @@
+"""
+Case-insensitive style lookup for a DOCX package.
+
+python-docx resolves `p.style = "Heading 1"` by an XPath over every style in
+styles.xml, and the old style-definition code looped over all of doc.styles per
+definition. Corporate templates carry hundreds of (latent) styles, so we build
+the lookup tables once per template package instead (template_cache keeps them
+next to the parsed package) and assign style IDs directly.
+
+The index only holds style IDs (strings), so it stays valid for every copy of
+the package handed out by template_cache.
+"""
+from docx.oxml.ns import qn
+from docx.styles import BabelFish
+from docx.styles.style import StyleFactory
+
+# Structure paragraph types -> Word style the patcher gives them
+PARAGRAPH_TYPE_STYLES = {
+    "h1": "Heading 1",
+    "h2": "Heading 2",
+    "h3": "Heading 3",
+    "list_item": "List Paragraph",
+    "title": "Title",
+}
+
+def build_style_index(doc):
+    """
+    One pass over styles.xml. Returns
+      {"paragraph" | "character" | "table" | "numbering": {key: style_id},
+       "any": {key: style_id}, "defaults": {style_type: style_id}, "types": {paragraph type: style_id}}
+    where keys are the lowercased style name (UI and internal spelling) and style ID.
+    """
+    index = {"paragraph": {}, "character": {}, "table": {}, "numbering": {}, "any": {}, "defaults": {}, "types": {}}
+    for style in doc.styles.element.iterchildren(qn("w:style")):
+        style_id = style.get(qn("w:styleId"))
+        if not style_id:
+            continue
+        style_type = style.get(qn("w:type"), "paragraph")
+        keys = [style_id.lower()]
+        name_el = style.find(qn("w:name"))
+        if name_el is not None and name_el.get(qn("w:val")):
+            name = name_el.get(qn("w:val"))
+            keys += [name.lower(), BabelFish.internal2ui(name).lower()]
+        by_type = index.setdefault(style_type, {})
+        for key in keys:
+            by_type.setdefault(key, style_id)
+            index["any"].setdefault(key, style_id)
+        if style.get(qn("w:default")) in ("1", "true", "on"):
+            index["defaults"].setdefault(style_type, style_id)
+
+    for p_type, style_name in PARAGRAPH_TYPE_STYLES.items():
+        style_id = resolve_style_id(index, style_name)
+        if style_id:
+            index["types"][p_type] = style_id
+    return index
+
+def resolve_style_id(index, name, style_type="paragraph"):
+    """Style ID for `name` (any case, with or without spaces), or None."""
+    table = index.get(style_type, {})
+    key = name.lower()
+    return table.get(key) or table.get(key.replace(" ", ""))
+
+def get_style(doc, index, name):
+    """Style object for `name` of any type, or None (for editing style definitions)."""
+    key = name.lower()
+    style_id = index["any"].get(key) or index["any"].get(key.replace(" ", ""))
+    if style_id is None:
+        return None
+    style_el = doc.styles.element.get_by_id(style_id)
+    return StyleFactory(style_el) if style_el is not None else None
+
+def set_paragraph_style(p, index, name):
+    """
+    Same effect as `p.style = name`, without the scan over styles.xml.
+    Returns False if the document has no such paragraph style.
+    """
+    style_id = resolve_style_id(index, name)
+    if style_id is None:
+        return False
+    set_paragraph_style_id(p, index, style_id)
+    return True
+
+def set_paragraph_type_style(p, index, p_type):
+    """
+    Gives `p` the style of structure paragraph type `p_type` (PARAGRAPH_TYPE_STYLES),
+    resolved when the index was built. Returns False if the document has no such style.
+    """
+    style_id = index["types"].get(p_type)
+    if style_id is None:
+        return False
+    set_paragraph_style_id(p, index, style_id)
+    return True
+
+def set_paragraph_style_id(p, index, style_id):
+    # Like python-docx, the default paragraph style is expressed by having no pStyle
+    p._p.style = None if style_id == index["defaults"].get("paragraph") else style_id
+
+def set_table_style(table, index, name):
+    style_id = resolve_style_id(index, name, "table")
+    if style_id is None:
+        return False
+    table._tbl.tblStyle_val = None if style_id == index["defaults"].get("table") else style_id
+    return True
@@ -0,0 +1,120 @@
+"""
+In-process LRU of parsed DOCX packages.
+
+Patching a revision starts from a parsed package (unzip + lxml parse of
+document.xml, styles, numbering...). Consecutive edits on the same document keep
+re-opening the file that the previous save just wrote, so we keep the parsed
+package around and hand out deep copies of it instead; copying the lxml trees
+is much cheaper than re-parsing the zip.
+
+Entries are keyed by (path, mtime, size), so a file that changes on disk is never
+served stale. The cache is bounded both by entry count and by an estimate of the
+memory it holds (the uncompressed size of the package parts).
+"""
+import os
+import copy
+import zipfile
+import threading
+from collections import OrderedDict
+import docx
+
+TEMPLATE_CACHE_MAX_ENTRIES = int(os.environ.get("TEMPLATE_CACHE_MAX_ENTRIES", "32"))
+TEMPLATE_CACHE_MAX_BYTES = int(os.environ.get("TEMPLATE_CACHE_MAX_MB", "256")) * 1024 * 1024
+
+_entries = OrderedDict() # (path, mtime_ns, size) -> {"doc", "weight", "derived"}
+_total_weight = 0
+_lock = threading.Lock()
+_stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+def _key(path):
+    st = os.stat(path)
+    return (os.path.abspath(path), st.st_mtime_ns, st.st_size)
+
+def _package_weight(path):
+    # Uncompressed size of all parts: a rough proxy for the memory of the parsed trees
+    try:
+        with zipfile.ZipFile(path) as zf:
+            return sum(info.file_size for info in zf.infolist())
+    except (zipfile.BadZipFile, OSError):
+        return os.path.getsize(path)
+
+def _get_entry(path):
+    key = _key(path)
+    with _lock:
+        entry = _entries.get(key)
+        if entry is not None:
+            _entries.move_to_end(key)
+            _stats["hits"] += 1
+        else:
+            _stats["misses"] += 1
+        return key, entry
+
+def _put(key, doc, weight, derived=None):
+    global _total_weight
+    if weight > TEMPLATE_CACHE_MAX_BYTES or TEMPLATE_CACHE_MAX_ENTRIES <= 0:
+        return None
+    entry = {"doc": doc, "weight": weight, "derived": dict(derived or {})}
+    with _lock:
+        old = _entries.pop(key, None)
+        if old is not None:
+            _total_weight -= old["weight"]
+        _entries[key] = entry
+        _total_weight += weight
+        while len(_entries) > TEMPLATE_CACHE_MAX_ENTRIES or _total_weight > TEMPLATE_CACHE_MAX_BYTES:
+            _, evicted = _entries.popitem(last=False)
+            _total_weight -= evicted["weight"]
+            _stats["evictions"] += 1
+    return entry
+
+def open_document(path):
+    """
+    Returns a docx.Document for `path` that the caller is free to modify: a copy of the
+    cached package on a hit, a freshly loaded one (whose pristine copy is cached) on a miss.
+    """
+    key, entry = _get_entry(path)
+    if entry is not None:
+        return copy.deepcopy(entry["doc"])
+
+    doc = docx.Document(path)
+    _put(key, copy.deepcopy(doc), _package_weight(path))
+    return doc
+
+def store_document(path, doc, derived=None):
+    """
+    Caches `doc` as the parsed package of `path`, which it was just saved to.
+    The caller must not modify `doc` afterwards. `derived` carries over data from the
+    package it was opened from that is still valid (see get_derived).
+    """
+    _put(_key(path), doc, _package_weight(path), derived)
+
+def get_derived(path, name, build):
+    """
+    Data derived from the package at `path` (e.g. its style index), built with build()
+    the first time and then kept alongside the cached package. If `path` isn't cached,
+    build() runs every time.
+    """
+    key = _key(path)
+    with _lock:
+        entry = _entries.get(key)
+        if entry is not None and name in entry["derived"]:
+            return entry["derived"][name]
+    value = build()
+    if entry is not None:
+        with _lock:
+            entry["derived"][name] = value
+    return value
+
+def clear():
+    global _total_weight
+    with _lock:
+        _entries.clear()
+        _total_weight = 0
+
+def stats():
+    with _lock:
+        s = dict(_stats)
+        s["entries"] = len(_entries)
+        s["bytes"] = _total_weight
+    lookups = s["hits"] + s["misses"]
+    s["hit_rate"] = s["hits"] / lookups if lookups else 0.0
+    return s
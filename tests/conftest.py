@@ -0,0 +1,34 @@
+import os
+import docx
+import pytest
+from werkzeug.datastructures import FileStorage
+from doc_editor import storage
+
+@pytest.fixture
+def data_dir(tmp_path, monkeypatch):
+    """storage pointed at an empty data directory."""
+    base = str(tmp_path / "data")
+    monkeypatch.setattr(storage, "BASE_DIR", base)
+    monkeypatch.setattr(storage, "BLOB_DIR", os.path.join(base, "_blobs"))
+    monkeypatch.setattr(storage, "PARSE_CACHE_DIR", os.path.join(base, "_parse_cache"))
+    return base
+
+@pytest.fixture
+def chapters_docx(tmp_path):
+    """A small upload with an intro paragraph and two Heading 1 chapters."""
+    doc = docx.Document()
+    doc.add_paragraph("Intro")
+    doc.add_heading("Chapter A", level=1)
+    doc.add_paragraph("Alpha body")
+    doc.add_heading("Chapter B", level=1)
+    doc.add_paragraph("Beta body")
+    path = str(tmp_path / "chapters.docx")
+    doc.save(path)
+    return path
+
+def upload(path):
+    """A docx file as routes.upload_file hands it to storage.create_document."""
+    return FileStorage(stream=open(path, 'rb'), filename=os.path.basename(path))
+
+def body_texts(path):
+    return [p.text for p in docx.Document(path).paragraphs]
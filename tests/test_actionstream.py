@@ -0,0 +1,48 @@
+import json
+import random
+from doc_editor.actionstream import ActionStreamParser
+
+ACTIONS = [
+    {"action": "replace_paragraph", "section_id": "s1", "paragraph_id": "s1_p2",
+     "new_text": 'He said "go" [now] {fast} \\ done\n```mermaid\ngraph TD; A-->B\n```'},
+    {"action": "replace_text_globally", "old_text": "Größe ✓", "new_text": "size", "nested": [[1], {"a": []}]},
+    {"action": "noop", "reason": "}]"},
+]
+TEXT = "Here you go:\n```json\n" + json.dumps(ACTIONS, indent=2, ensure_ascii=False) + "\n```\nDone [1]."
+
+def _feed(text, sizes):
+    parser = ActionStreamParser()
+    found = []
+    pos = 0
+    while pos < len(text):
+        n = sizes()
+        found += parser.feed(text[pos:pos + n])
+        pos += n
+    return parser, found
+
+def test_whole_text():
+    parser = ActionStreamParser()
+    assert parser.feed(TEXT) == ACTIONS
+    assert parser.complete and not parser.truncated and not parser.errors
+
+def test_any_chunking():
+    rng = random.Random(0)
+    for _ in range(200):
+        parser, found = _feed(TEXT, lambda: rng.randint(1, 9))
+        assert found == ACTIONS
+        assert parser.complete
+
+def test_one_character_at_a_time():
+    parser, found = _feed(TEXT, lambda: 1)
+    assert found == ACTIONS
+
+def test_truncated_keeps_complete_actions():
+    cut = TEXT.index('"reason"')
+    parser, found = _feed(TEXT[:cut], lambda: 5)
+    assert found == ACTIONS[:2]
+    assert parser.truncated
+
+def test_no_array():
+    parser = ActionStreamParser()
+    assert parser.feed("I can't do that.") == []
+    assert not parser.started and not parser.truncated
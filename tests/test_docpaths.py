@@ -0,0 +1,60 @@
+import os
+import time
+import shutil
+from doc_editor import storage, metastore, docpaths, migrate_layout
+from conftest import upload, body_texts
+from test_storage import _replace
+
+def _legacy_document(chapters_docx, monkeypatch):
+    # A document created before sharding: a millisecond timestamp id in data/<doc_id>/
+    monkeypatch.setattr(metastore, "STORAGE_BACKEND", "files")
+    doc_id = storage.create_document(upload(chapters_docx))
+    legacy_id = "1700000000000"
+    shutil.move(storage.get_doc_dir(doc_id), docpaths.flat_dir(storage.BASE_DIR, legacy_id))
+    return legacy_id
+
+def test_new_ids_sort_by_creation_time():
+    ids = []
+    for _ in range(3):
+        ids.append(docpaths.new_doc_id())
+        time.sleep(0.002)
+    assert all(len(i) == 26 and set(i) <= set(docpaths._CROCKFORD) for i in ids)
+    assert sorted(ids) == ids
+
+def test_get_doc_dir_resolves_both_layouts(data_dir, chapters_docx, monkeypatch):
+    doc_id = storage.create_document(upload(chapters_docx))
+    legacy_id = _legacy_document(chapters_docx, monkeypatch)
+
+    assert docpaths.get_doc_dir(data_dir, doc_id) == docpaths.shard_dir(data_dir, doc_id)
+    assert docpaths.get_doc_dir(data_dir, legacy_id) == os.path.join(data_dir, legacy_id)
+    assert docpaths.get_doc_dir(data_dir, "unknown") == docpaths.shard_dir(data_dir, "unknown")
+    listed = {(i, sharded) for i, _, sharded in docpaths.iter_doc_dirs(data_dir)}
+    assert {(doc_id, True), (legacy_id, False)} <= listed
+    assert not any(i.startswith("_") for i, _ in listed) # blob store, parse cache
+    assert set(storage.list_documents()) == {doc_id, legacy_id}
+
+def test_migrate_legacy_layout(data_dir, chapters_docx, monkeypatch):
+    legacy_id = _legacy_document(chapters_docx, monkeypatch)
+    storage.save_revision(legacy_id, _replace(storage.get_structure(legacy_id), "s1_p1", "Before"), [], "edit")
+
+    assert migrate_layout.migrate(data_dir, dry_run=True) == (1, 0)
+    assert os.path.isdir(docpaths.flat_dir(data_dir, legacy_id))
+
+    assert migrate_layout.main(["--data-dir", data_dir]) == 0
+    assert not os.path.exists(docpaths.flat_dir(data_dir, legacy_id))
+    assert storage.get_doc_dir(legacy_id) == docpaths.shard_dir(data_dir, legacy_id)
+
+    # History and revisions moved with it; the next save patches the previous revision
+    rev_id = storage.save_revision(legacy_id, _replace(storage.get_structure(legacy_id), "s3_p2", "After"), [], "edit")
+    assert [h["rev_id"] for h in storage.get_history(legacy_id)] == ["0", "1", rev_id]
+    assert body_texts(storage.get_revision_path(legacy_id, rev_id)) == \
+        ["Before", "Chapter A", "Alpha body", "Chapter B", "After"]
+
+    # Running it again finds nothing to move
+    assert migrate_layout.migrate(data_dir) == (0, 0)
+
+def test_migrate_skips_existing_target(data_dir, chapters_docx, monkeypatch):
+    legacy_id = _legacy_document(chapters_docx, monkeypatch)
+    os.makedirs(docpaths.shard_dir(data_dir, legacy_id))
+    assert migrate_layout.migrate(data_dir) == (0, 1)
+    assert os.path.isdir(docpaths.flat_dir(data_dir, legacy_id))
@@ -0,0 +1,48 @@
+import os
+import pytest
+from doc_editor import llm
+
+ACTIONS = [{"action": "replace_text_globally", "old_text": "Acme", "new_text": "AcmeCorp"}]
+
+@pytest.fixture
+def cache_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(llm, "LLM_CACHE_DIR", str(tmp_path / "llm_cache"))
+    llm.clear_response_cache()
+    yield llm.LLM_CACHE_DIR
+    llm.clear_response_cache()
+
+def test_memory_and_disk_tiers(cache_dir):
+    key = llm.response_cache_key("Replace  Acme\n", "system", "extract")
+    assert key == llm.response_cache_key("Replace Acme", "system", "extract")
+    assert key != llm.response_cache_key("replace acme", "system", "extract")
+    assert llm._cache_get(key) is None
+
+    llm._cache_put(key, ACTIONS)
+    cached = llm._cache_get(key)
+    assert cached == ACTIONS
+    cached[0]["new_text"] = "changed" # callers get copies
+    llm.clear_response_cache()
+    assert llm._cache_get(key) == ACTIONS # from disk
+
+def test_expiry(cache_dir, monkeypatch):
+    key = llm.response_cache_key("Replace Acme", "system", "extract")
+    llm._cache_put(key, ACTIONS)
+    monkeypatch.setattr(llm, "LLM_CACHE_TTL", 0)
+    assert llm._cache_get(key) is None
+    assert not os.path.exists(llm._cache_path(key))
+
+def test_disk_failure_keeps_memory_tier(cache_dir, monkeypatch):
+    open(cache_dir, "w").close() # a file where the cache directory should be
+    key = llm.response_cache_key("Replace Acme", "system", "extract")
+    llm._cache_put(key, ACTIONS)
+    assert llm._cache_get(key) == ACTIONS
+
+def test_prune_skips_vanished_entries(cache_dir, monkeypatch):
+    monkeypatch.setattr(llm, "LLM_CACHE_DISK_MAX_ENTRIES", 2)
+    keys = [llm.response_cache_key(f"instruction {i}", "system", "extract") for i in range(5)]
+    for key in keys:
+        llm._cache_put(key, ACTIONS)
+    os.remove(llm._cache_path(keys[0])) # pruned by another worker
+    llm._prune_disk_cache()
+    remaining = [key for key in keys if os.path.exists(llm._cache_path(key))]
+    assert len(remaining) == 2
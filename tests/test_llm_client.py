@@ -0,0 +1,68 @@
+import json
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import pytest
+from doc_editor import llm_client
+
+EVENTS = [{"candidates": [{"content": {"parts": [{"text": '[{"action": "noop", "reason": "Größe ✓ 日本'}]}}]},
+          {"candidates": [{"content": {"parts": [{"text": '語"}]'}]}, "finishReason": "STOP"}]}]
+
+class StubGemini(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    content_type = "text/event-stream"
+    failures = 0 # answer this many requests with 503 first
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers["Content-Length"]))
+        server = self.server
+        server.requests += 1
+        if server.requests <= server.failures:
+            self.send_response(503)
+            self.send_header("Retry-After", "0")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        body = b"".join(f"data: {json.dumps(e, ensure_ascii=False)}\r\n\r\n".encode("utf-8") for e in EVENTS)
+        self.send_response(200)
+        if server.content_type:
+            self.send_header("Content-Type", server.content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+@pytest.fixture
+def stub():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubGemini)
+    server.requests = 0
+    server.failures = 0
+    server.content_type = "text/event-stream"
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+def _url(server):
+    return f"http://127.0.0.1:{server.server_port}/v1beta/models/test:streamGenerateContent"
+
+@pytest.mark.parametrize("content_type", ["text/event-stream", None])
+def test_events_are_utf8(stub, content_type):
+    stub.content_type = content_type
+    with llm_client.stream(_url(stub), json={}, params={"alt": "sse"}) as response:
+        assert list(llm_client.iter_events(response)) == EVENTS
+
+def test_retries_unavailable(stub, monkeypatch):
+    monkeypatch.setattr(llm_client, "LLM_BACKOFF_BASE", 0.001)
+    stub.failures = 2
+    response = llm_client.post(_url(stub), json={})
+    assert response.status_code == 200
+    assert stub.requests == 3
+
+def test_gives_up_after_max_retries(stub, monkeypatch):
+    monkeypatch.setattr(llm_client, "LLM_BACKOFF_BASE", 0.001)
+    monkeypatch.setattr(llm_client, "LLM_MAX_RETRIES", 1)
+    stub.failures = 5
+    assert llm_client.post(_url(stub), json={}).status_code == 503
+    assert stub.requests == 2
@@ -0,0 +1,63 @@
+from jsonschema import validate
+from doc_editor import llm, llm_context
+from doc_editor.models import EDIT_SCHEMA
+
+STRUCTURE = {
+    "meta": {},
+    "sections": [{"id": "s1", "title": "Intro", "tables": [], "paragraphs": [
+        {"id": "s1_p1", "text": "Intro", "type": "h1"},
+        {"id": "s1_p2", "text": "First item", "type": "list_item"},
+        {"id": "s1_p3", "text": "Body", "type": "text"},
+    ]}],
+}
+
+def test_compact_lines():
+    text, info = llm_context.build_context(STRUCTURE)
+    assert "s1_p2|li|First item" in text.splitlines()
+    assert "s1_p3||Body" in text.splitlines()
+    assert not info["windowed"]
+
+def test_echoed_type_codes_are_fixed():
+    actions = [
+        {"action": "update_paragraph_style", "section_id": "s1", "paragraph_id": "s1_p3", "style_type": "li"},
+        {"action": "replace_paragraph", "section_id": "s1", "paragraph_id": "s1_p2", "new_text": "x", "style_type": ""},
+    ]
+    fixed = [llm._fix_action(action) for action in actions]
+    validate(instance=fixed, schema=EDIT_SCHEMA)
+    assert [a["style_type"] for a in fixed] == ["list_item", "text"]
+
+def test_unknown_ids_become_noops():
+    actions = [{"action": "delete_paragraph", "section_id": "s1", "paragraph_id": "s1_p3|text"},
+               {"action": "delete_paragraph", "section_id": "s1", "paragraph_id": "s9_p1"}]
+    checked = llm_context.check_action_ids(actions, STRUCTURE)
+    assert checked[0]["paragraph_id"] == "s1_p3"
+    assert checked[1]["action"] == "noop"
+
+def _long_document(focus_chars):
+    paragraphs = [{"id": f"s1_p{i}", "text": f"Paragraph {i} " + "words " * 40, "type": "text"} for i in range(1, 200)]
+    paragraphs[99] = dict(paragraphs[99], text="Focus " + "x" * focus_chars)
+    return {"meta": {}, "sections": [{"id": "s1", "title": "Body", "tables": [], "paragraphs": paragraphs}]}
+
+def test_window_keeps_focus_and_neighbours():
+    text, info = llm_context.build_context(_long_document(100), "s1_p100", budget=1000)
+    assert info["windowed"]
+    assert {"s1_p99", "s1_p100", "s1_p101"} <= set(info["paragraphs"])
+    assert info["tokens"] <= 1000
+
+def test_focus_over_budget_is_clipped_not_dropped():
+    text, info = llm_context.build_context(_long_document(50000), "s1_p100", budget=1000)
+    assert "s1_p100" in info["paragraphs"]
+    focus_line = next(line for line in text.splitlines() if line.startswith("s1_p100|"))
+    assert focus_line.endswith("chars]")
+    assert info["tokens"] <= 1000
+
+def test_empty_trailing_section_as_context():
+    structure = _long_document(100)
+    structure["sections"].append({"id": "s2", "title": "Notes", "tables": [], "paragraphs": [
+        {"id": "s2_p1", "text": "", "type": "h1"}, {"id": "s2_p2", "text": "  ", "type": "text"}]})
+    text, info = llm_context.build_context(structure, "s2", budget=500)
+    assert info["windowed"]
+    assert "## s2 Notes (0 paragraphs)" in text.splitlines()
+    # The nearest listed paragraphs, from the end of the previous section
+    assert "s1_p199" in info["paragraphs"]
+    assert info["tokens"] <= 500
@@ -0,0 +1,94 @@
+import os
+import json
+import docx
+import pytest
+from doc_editor import storage, metastore
+from conftest import upload, body_texts
+from test_storage import _replace
+
+@pytest.fixture(params=["files", "sqlite"])
+def backend(request, data_dir, monkeypatch):
+    monkeypatch.setattr(metastore, "STORAGE_BACKEND", request.param)
+    return request.param
+
+def test_structure_round_trip(backend, chapters_docx):
+    doc_id = storage.create_document(upload(chapters_docx))
+    structure = storage.get_structure(doc_id)
+    assert [h["rev_id"] for h in storage.get_history(doc_id)] == ["0"]
+
+    edited = _replace(structure, "s2_p2", "Alpha ✓ EDITED")
+    rev_id = storage.save_revision(doc_id, edited, ["changed"], "edit", base_rev="0")
+    assert storage.get_latest_revision_id(doc_id) == rev_id
+    assert storage.get_structure(doc_id)["sections"] == edited["sections"]
+    assert storage.get_structure(doc_id, rev_id="0")["sections"] == structure["sections"]
+    assert storage.get_history(doc_id)[-1]["changes"] == ["changed"]
+
+def test_backends_store_the_same_structure(data_dir, chapters_docx, monkeypatch):
+    structures = []
+    for name in ("files", "sqlite"):
+        monkeypatch.setattr(metastore, "STORAGE_BACKEND", name)
+        doc_id = storage.create_document(upload(chapters_docx))
+        storage.save_revision(doc_id, _replace(storage.get_structure(doc_id), "s3_p2", "Beta EDITED"), [], "edit")
+        structures.append(storage.get_structure(doc_id)["sections"])
+    assert structures[0] == structures[1]
+
+def test_restore_revision(backend, chapters_docx):
+    doc_id = storage.create_document(upload(chapters_docx))
+    first = storage.save_revision(doc_id, _replace(storage.get_structure(doc_id), "s1_p1", "One"), [], "edit")
+    storage.save_revision(doc_id, _replace(storage.get_structure(doc_id), "s1_p1", "Two"), [], "edit")
+
+    assert storage.restore_revision(doc_id, first) == first
+    assert storage.get_latest_revision_id(doc_id) == first
+    assert storage.get_structure(doc_id)["sections"][0]["paragraphs"][0]["text"] == "One"
+
+    # The next save patches the restored revision
+    rev_id = storage.save_revision(doc_id, _replace(storage.get_structure(doc_id), "s3_p2", "Three"), [], "edit")
+    assert body_texts(storage.get_revision_path(doc_id, rev_id)) == \
+        ["One", "Chapter A", "Alpha body", "Chapter B", "Three"]
+    with pytest.raises(FileNotFoundError):
+        storage.restore_revision(doc_id, "99")
+
+def test_trimmed_revisions_are_collected(backend, chapters_docx, monkeypatch):
+    monkeypatch.setattr(storage, "HISTORY_LIMIT", 2)
+    doc_id = storage.create_document(upload(chapters_docx))
+    for n in range(4):
+        storage.save_revision(doc_id, _replace(storage.get_structure(doc_id), "s1_p1", f"Edit {n}"), [], "edit")
+
+    live = [h["rev_id"] for h in storage.get_history(doc_id)]
+    assert live == ["3", "4"]
+    meta = metastore.get_metastore(storage.BASE_DIR)
+    assert not meta.has_snapshot(doc_id, "2")
+    assert meta.has_snapshot(doc_id, "4")
+    revisions = os.listdir(os.path.join(storage.get_doc_dir(doc_id), "revisions"))
+    assert "2.docx" not in revisions
+    # Revision 0 is pinned: the full patcher falls back to it
+    assert body_texts(storage.get_revision_path(doc_id, "0"))[0] == "Intro"
+    assert storage.get_structure(doc_id)["sections"][0]["paragraphs"][0]["text"] == "Edit 3"
+
+def test_sqlite_edit_writes_what_changed(data_dir, tmp_path, monkeypatch):
+    # A one-paragraph edit of a long section stores the paragraph and the chunks around it,
+    # not every paragraph hash of the section or the layout of the whole document
+    monkeypatch.setattr(metastore, "STORAGE_BACKEND", "sqlite")
+    doc = docx.Document()
+    for i in range(2000):
+        doc.add_paragraph(f"Paragraph {i}")
+    path = str(tmp_path / "long.docx")
+    doc.save(path)
+    doc_id = storage.create_document(upload(path))
+    storage.save_revision(doc_id, _replace(storage.get_structure(doc_id), "s1_p1", "First"), [], "edit")
+
+    conn = metastore.get_metastore(storage.BASE_DIR)._conn()
+    def stored():
+        return {table: set(conn.execute(f"SELECT hash FROM {table}")) for table in ("paragraphs", "sections", "chunks")}
+    before = stored()
+    changes = conn.total_changes
+    rev_id = storage.save_revision(doc_id, _replace(storage.get_structure(doc_id), "s1_p1000", "Edited"), [], "edit")
+    added = {table: len(hashes - before[table]) for table, hashes in stored().items()}
+
+    assert added["paragraphs"] == 1 and added["sections"] == 1
+    assert added["chunks"] <= 3
+    assert conn.total_changes - changes <= 12
+    layout_row = conn.execute("SELECT length(layout) FROM revisions WHERE doc_id = ? AND rev_id = ?", (doc_id, rev_id)).fetchone()[0]
+    assert layout_row * 5 < len(json.dumps(storage.get_revision_layout(doc_id, rev_id)))
+    assert [p["text"] for p in storage.get_structure(doc_id)["sections"][0]["paragraphs"][998:1001]] == \
+        ["Paragraph 998", "Edited", "Paragraph 1000"]
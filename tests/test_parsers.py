@@ -0,0 +1,66 @@
+import docx
+from docx.enum.text import WD_BREAK
+import pytest
+from doc_editor import parsers
+
+@pytest.fixture
+def mixed_docx(tmp_path):
+    """Headings, lists, tabs and breaks, and tables with merged cells."""
+    doc = docx.Document()
+    doc.add_paragraph("Report", style="Title")
+    doc.add_paragraph("Before any heading")
+    doc.add_heading("Chapter 1", level=1)
+    p = doc.add_paragraph("Name")
+    p.add_run().add_tab()
+    p.add_run("Value")
+    p = doc.add_paragraph("Line one")
+    run = p.add_run()
+    run.add_break()
+    run.add_text("Line two")
+    run.add_break(WD_BREAK.PAGE)
+    run.add_text("After page break")
+    doc.add_paragraph("Bullet item", style="List Bullet")
+    doc.add_paragraph("Numbered item", style="List Number")
+    doc.add_paragraph("")
+
+    table = doc.add_table(rows=3, cols=3)
+    for r, row in enumerate(table.rows):
+        for c, cell in enumerate(row.cells):
+            cell.text = f"r{r}c{c}"
+    table.cell(0, 0).merge(table.cell(0, 1))    # horizontal merge
+    table.cell(1, 2).merge(table.cell(2, 2))    # vertical merge
+    doc.add_heading("Section 1.1", level=2)
+    doc.add_heading("Detail", level=3)
+    doc.add_paragraph("Tail text, **not markdown** & <escaped>")
+    doc.add_heading("Chapter 2", level=1)
+    doc.add_table(rows=1, cols=2).cell(0, 1).text = "only cell"
+
+    path = str(tmp_path / "mixed.docx")
+    doc.save(path)
+    return path
+
+def test_engines_agree(mixed_docx):
+    assert parsers.parse_docx_to_structure(mixed_docx, engine="lxml") == \
+        parsers.parse_docx_to_structure(mixed_docx, engine="docx")
+
+def test_structure(mixed_docx):
+    structure = parsers.parse_docx_to_structure(mixed_docx, engine="lxml")
+    assert [sec["title"] for sec in structure["sections"]] == \
+        ["Document Start", "Chapter 1", "Section 1.1", "Chapter 2"]
+    types = {p["text"]: p["type"] for p in parsers.iter_structure_paragraphs(structure)}
+    assert types["Report"] == "title"
+    assert types["Bullet item"] == "list_item"
+    assert types["Detail"] == "h3"
+    assert types["Name\tValue"] == "text"
+    assert types["Line one\nLine twoAfter page break"] == "text" # page breaks aren't text, as in python-docx
+
+    chapter = structure["sections"][1]
+    assert [p["id"] for p in chapter["paragraphs"]][:2] == ["s2_p1", "s2_p2"]
+    table = chapter["tables"][0]
+    assert table["id"] == "s2_t1"
+    assert table["after_paragraph"] == chapter["paragraphs"][-1]["id"]
+    assert len(table["rows"]) == 3
+
+def test_unknown_engine(mixed_docx):
+    with pytest.raises(ValueError):
+        parsers.parse_docx_to_structure(mixed_docx, engine="regex")
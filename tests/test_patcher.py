@@ -0,0 +1,47 @@
+import docx
+from doc_editor import parsers
+from conftest import body_texts
+
+def _styles(path):
+    return [(p.text, p.style.name) for p in docx.Document(path).paragraphs]
+
+def _paragraph_types(structure):
+    return [(p["text"], p["type"]) for p in parsers.iter_structure_paragraphs(structure)]
+
+def _edited(structure):
+    # Rewrite, restyle, insert and delete paragraphs (the full patcher keeps original paragraphs in place)
+    s1, s2, s3 = [dict(sec, paragraphs=list(sec["paragraphs"])) for sec in structure["sections"]]
+    s1["paragraphs"][0] = dict(s1["paragraphs"][0], text="Intro **bold** rewritten")
+    s2["paragraphs"][1] = dict(s2["paragraphs"][1], type="h3")
+    s2["paragraphs"].insert(1, {"id": "s2_new_1", "text": "Inserted", "type": "text"})
+    del s3["paragraphs"][1]
+    s3["paragraphs"].append({"id": "s3_new_2", "text": "Appended", "type": "list_item"})
+    return dict(structure, sections=[s1, s2, s3])
+
+def test_full_and_incremental_patch_agree(chapters_docx, tmp_path):
+    structure = parsers.parse_docx_to_structure(chapters_docx)
+    edited = _edited(structure)
+    full_path = str(tmp_path / "full.docx")
+    incremental_path = str(tmp_path / "incremental.docx")
+
+    parsers.patch_docx_from_structure(chapters_docx, edited, full_path)
+    assert parsers.patch_docx_incremental(chapters_docx, structure, edited, None, incremental_path) is not None
+
+    assert _styles(full_path) == _styles(incremental_path)
+    assert ("Alpha body", "Heading 3") in _styles(full_path)
+    assert body_texts(full_path) == ["Intro bold rewritten", "Chapter A", "Inserted",
+                                     "Alpha body", "Chapter B", "Appended"]
+
+def test_patched_document_parses_back(chapters_docx, tmp_path):
+    structure = parsers.parse_docx_to_structure(chapters_docx)
+    edited = _edited(structure)
+    path = str(tmp_path / "rev1.docx")
+    layout = parsers.patch_docx_incremental(chapters_docx, structure, edited, None, path)
+
+    # A second incremental patch on top of the first, through its layout
+    again = dict(edited, sections=[dict(edited["sections"][2], paragraphs=edited["sections"][2]["paragraphs"][:1])]
+                 + edited["sections"][:2])
+    path2 = str(tmp_path / "rev2.docx")
+    parsers.patch_docx_incremental(path, edited, again, layout, path2)
+    expected = [(t.replace("**", ""), kind) for t, kind in _paragraph_types(again)]
+    assert _paragraph_types(parsers.parse_docx_to_structure(path2)) == expected
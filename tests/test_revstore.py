@@ -0,0 +1,22 @@
+import os
+import zipfile
+from doc_editor import parsers, revstore
+from test_patcher import _edited
+
+def test_revision_store_rebuilds_identical_files(chapters_docx, tmp_path):
+    structure = parsers.parse_docx_to_structure(chapters_docx)
+    doc_dir = str(tmp_path / "doc")
+    os.makedirs(os.path.join(doc_dir, "revisions"))
+    rev1 = revstore.get_docx_path(doc_dir, "1")
+    parsers.patch_docx_from_structure(chapters_docx, _edited(structure), rev1)
+    with open(rev1, "rb") as f:
+        original = f.read()
+    revstore.ingest(doc_dir, "1", rev1)
+
+    rebuilt = str(tmp_path / "rebuilt.docx")
+    revstore.materialize(doc_dir, "1", rebuilt)
+    with zipfile.ZipFile(rev1) as a, zipfile.ZipFile(rebuilt) as b:
+        assert a.namelist() == b.namelist()
+        assert all(a.read(name) == b.read(name) for name in a.namelist())
+    with open(rebuilt, "rb") as f:
+        assert f.read() == original
@@ -0,0 +1,96 @@
+import json
+import pytest
+from doc_editor import storage, llm
+from conftest import upload
+
+@pytest.fixture
+def client(data_dir, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path) # create_app makes ./data
+    from doc_editor.app import create_app
+    return create_app().test_client()
+
+@pytest.fixture
+def doc_id(data_dir, chapters_docx):
+    return storage.create_document(upload(chapters_docx))
+
+def _events(response):
+    events = []
+    for block in response.get_data(as_text=True).split("\n\n"):
+        if block:
+            event, data = block.split("\n", 1)
+            events.append((event[len("event: "):], json.loads(data[len("data: "):])))
+    return events
+
+def _stub_stream(monkeypatch, events):
+    calls = []
+    def stream_edit_actions(instruction, structure, context_pid=None, use_cache=True):
+        calls.append(instruction)
+        yield from events
+    monkeypatch.setattr(llm, "stream_edit_actions", stream_edit_actions)
+    return calls
+
+def test_structure_etag(client, doc_id):
+    response = client.get(f"/doc/{doc_id}/structure")
+    assert response.status_code == 200
+    assert response.headers["ETag"] == '"0"'
+    response = client.get(f"/doc/{doc_id}/structure", headers={"If-None-Match": 'W/"0"'})
+    assert response.status_code == 304
+    assert response.headers["ETag"] == '"0"'
+
+def test_edit_stream(client, doc_id, monkeypatch):
+    _stub_stream(monkeypatch, [
+        ("action", {"action": "replace_text_globally", "old_text": "body", "new_text": "text"}),
+        ("action", {"action": "replace_paragraph", "section_id": "s1", "paragraph_id": "s1_p1", "new_text": "Hello"}),
+        ("truncated", {"reason": llm.TRUNCATED_REASON, "finish_reason": "MAX_TOKENS"}),
+    ])
+    response = client.post(f"/doc/{doc_id}/edit/stream", json={"instruction": "edit"}, headers={"If-Match": '"0"'})
+    assert response.mimetype == "text/event-stream"
+    events = _events(response)
+
+    assert [event for event, _ in events] == ["start", "action", "truncated", "done"]
+    assert events[0][1] == {"base_rev": "0"}
+    assert events[1][1]["index"] == 0
+    assert events[1][1]["changes"] == ["Replaced 2 occurrences of 'body' with 'text'", "Updated paragraph s1_p1"]
+    done = events[-1][1]
+    assert done["rev_id"] == "1" and done["truncated"]
+    assert client.get(f"/doc/{doc_id}/structure").headers["ETag"] == '"1"'
+    paragraphs = [p["text"] for sec in storage.get_structure(doc_id)["sections"] for p in sec["paragraphs"]]
+    assert paragraphs == ["Hello", "Chapter A", "Alpha text", "Chapter B", "Beta text"]
+
+def test_edit_stream_clarification_saves_nothing(client, doc_id, monkeypatch):
+    _stub_stream(monkeypatch, [("action", {"action": "clarify", "question": "Which chapter?"})])
+    events = _events(client.post(f"/doc/{doc_id}/edit/stream", json={"instruction": "edit"}))
+    assert events[-1] == ("clarification", {"question": "Which chapter?"})
+    assert storage.get_latest_revision_id(doc_id) == "0"
+
+def test_edit_stream_stale_base_revision(client, doc_id, monkeypatch):
+    calls = _stub_stream(monkeypatch, [])
+    storage.save_revision(doc_id, storage.get_structure(doc_id), [], "edit")
+    response = client.post(f"/doc/{doc_id}/edit/stream", json={"instruction": "edit"}, headers={"If-Match": '"0"'})
+    assert response.status_code == 409
+    assert response.json["head_rev"] == "1"
+    assert not calls
+
+@pytest.mark.parametrize("route", ["edit", "edit/stream"])
+def test_edit_unknown_document(client, data_dir, route):
+    response = client.post(f"/doc/01ARZ3NDEKTSV4RRFFQ69G5FAV/{route}", json={"instruction": "edit"})
+    assert response.status_code == 404
+    assert response.json == {"error": "Document not found"}
+
+def test_restore_revision(client, doc_id):
+    structure = storage.get_structure(doc_id)
+    storage.save_revision(doc_id, structure, [], "edit")
+
+    response = client.post(f"/doc/{doc_id}/revisions/0/restore")
+    assert response.status_code == 200
+    assert response.json["head"] == "0"
+    assert client.get(f"/doc/{doc_id}/structure").headers["ETag"] == '"0"'
+    assert client.post(f"/doc/{doc_id}/revisions/99/restore").status_code == 404
+
+def test_cache_health(client, chapters_docx):
+    storage.create_document(upload(chapters_docx))
+    storage.create_document(upload(chapters_docx))
+    stats = client.get("/health/cache").json
+    assert stats["parse"]["hits"] >= 1 and stats["parse"]["misses"] >= 1
+    assert {"hits", "misses", "evictions", "entries", "bytes", "hit_rate"} <= set(stats["json"])
+    assert {"hits", "misses", "evictions", "entries", "bytes", "hit_rate"} <= set(stats["template"])
@@ -0,0 +1,47 @@
+import pytest
+from doc_editor import serialization
+from doc_editor.bench_codecs import synthetic_structure
+
+SECTION = {
+    "id": "s2", "title": "Chapitre naïf — résumé ✓",
+    "paragraphs": [
+        {"id": "s2_p1", "text": "Chapitre naïf — résumé ✓", "type": "h1"},
+        {"id": "s2_p2", "text": "Größe: 12,5 € 日本語 \x1f", "type": "text"},
+        {"id": "s2_p07", "text": "", "type": "list_item"},
+        {"id": "s2_p8", "text": "emoji 🙂", "type": "list_item"},
+        {"id": "s2_new_1712345678901_3", "text": "inserted", "type": "text"},
+    ],
+    "tables": [{"id": "s2_t1", "after_paragraph": None, "rows": [["ä", ""], ["-1", "ß"]]}],
+    "meta": {"size_pt": 12.5, "bold": None, "italic": False, "level": -3},
+}
+
+@pytest.mark.parametrize("name", sorted(serialization.CODECS))
+def test_round_trip(name):
+    data = serialization.encode(SECTION, name)
+    assert serialization.decode(data) == SECTION
+    assert serialization.codec_of(data) is not None
+    assert serialization.encode(SECTION, name) == data # sections are named by hash: deterministic
+
+@pytest.mark.parametrize("name", sorted(serialization.CODECS))
+def test_round_trip_generated(name):
+    structure = synthetic_structure(2000, seed=1)
+    for sec in structure["sections"]:
+        assert serialization.decode(serialization.encode(sec, name)) == sec
+
+def test_json_writes_utf8():
+    assert "naïve ✓".encode("utf-8") in serialization.encode({"text": "naïve ✓"}, "json")
+
+@pytest.mark.skipif("orjson" not in serialization.CODECS, reason="orjson not installed")
+def test_json_and_orjson_agree():
+    assert serialization.encode(SECTION, "json") == serialization.encode(SECTION, "orjson")
+    assert serialization.CODECS["orjson"].decode(serialization.encode(SECTION, "json")) == SECTION
+
+def test_binary_is_detected():
+    data = serialization.encode(SECTION, "binary")
+    assert data.startswith(serialization.MAGIC)
+    assert serialization.codec_of(data) is serialization.CODECS["binary"]
+    assert serialization.codec_of(serialization.encode(SECTION, "json")) is not serialization.CODECS["binary"]
+
+def test_unknown_codec():
+    with pytest.raises(ValueError):
+        serialization.get_codec("yaml")
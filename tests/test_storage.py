@@ -0,0 +1,87 @@
+import os
+import docx
+import pytest
+from doc_editor import storage, jsoncache, metastore, applyer
+from conftest import upload, body_texts
+
+def _replace(structure, pid, text):
+    sections = [dict(sec, paragraphs=[dict(p, text=text) if p["id"] == pid else p for p in sec["paragraphs"]])
+                for sec in structure["sections"]]
+    return dict(structure, sections=sections)
+
+def test_edit_round_trip(data_dir, chapters_docx):
+    doc_id = storage.create_document(upload(chapters_docx))
+    structure = storage.get_structure(doc_id)
+    assert [sec["title"] for sec in structure["sections"]] == ["Document Start", "Chapter A", "Chapter B"]
+
+    rev_id = storage.save_revision(doc_id, _replace(structure, "s2_p2", "Alpha EDITED"), [], "edit", base_rev="0")
+    assert body_texts(storage.get_revision_path(doc_id, rev_id)) == \
+        ["Intro", "Chapter A", "Alpha EDITED", "Chapter B", "Beta body"]
+
+    # The next save patches the previous revision incrementally
+    rev_id = storage.save_revision(doc_id, _replace(storage.get_structure(doc_id), "s3_p2", "Beta EDITED"), [], "edit")
+    assert body_texts(storage.get_revision_path(doc_id, rev_id)) == \
+        ["Intro", "Chapter A", "Alpha EDITED", "Chapter B", "Beta EDITED"]
+
+def test_stale_base_revision_conflicts(data_dir, chapters_docx):
+    doc_id = storage.create_document(upload(chapters_docx))
+    structure = storage.get_structure(doc_id)
+    storage.save_revision(doc_id, _replace(structure, "s1_p1", "One"), [], "edit", base_rev="0")
+    with pytest.raises(storage.RevisionConflict):
+        storage.save_revision(doc_id, _replace(structure, "s1_p1", "Two"), [], "edit", base_rev="0")
+
+def test_edit_legacy_document(data_dir, chapters_docx, monkeypatch):
+    # A document stored before sections were split at headings: one inline section with
+    # flat ids in structure.json, and only the upload as revision 0 (no layout, no snapshot)
+    monkeypatch.setattr(metastore, "STORAGE_BACKEND", "files")
+    doc_id = storage.create_document(upload(chapters_docx))
+    paragraphs = [p for sec in storage.get_structure(doc_id)["sections"] for p in sec["paragraphs"]]
+    legacy = {
+        "meta": {"paragraph_count": len(paragraphs), "table_count": 0, "created_at": None},
+        "sections": [{"id": "s1", "title": "Document Start", "tables": [],
+                      "paragraphs": [dict(p, id=f"s1_p{i}") for i, p in enumerate(paragraphs, 1)]}],
+    }
+    doc_dir = storage.get_doc_dir(doc_id)
+    jsoncache.write_json(os.path.join(doc_dir, "structure.json"), legacy)
+    os.remove(os.path.join(doc_dir, "revisions", "0.structure.json"))
+
+    rev_id = storage.save_revision(doc_id, _replace(storage.get_structure(doc_id), "s1_p3", "Alpha EDITED"), [], "edit")
+    assert body_texts(storage.get_revision_path(doc_id, rev_id)) == \
+        ["Intro", "Chapter A", "Alpha EDITED", "Chapter B", "Beta body"]
+
+    rev_id = storage.save_revision(doc_id, _replace(storage.get_structure(doc_id), "s1_p5", "Beta EDITED"), [], "edit")
+    assert body_texts(storage.get_revision_path(doc_id, rev_id)) == \
+        ["Intro", "Chapter A", "Alpha EDITED", "Chapter B", "Beta EDITED"]
+
+def _table_texts(path):
+    return [[cell.text for cell in row.cells] for table in docx.Document(path).tables for row in table.rows]
+
+def test_replacements_reach_docx_tables(data_dir, tmp_path, monkeypatch):
+    doc = docx.Document()
+    doc.add_paragraph("Acme intro")
+    table = doc.add_table(rows=2, cols=2)
+    table.cell(0, 0).text = "Acme cell"
+    table.cell(1, 0).merge(table.cell(1, 1)).text = "Merged Acme"
+    doc.add_paragraph("Outro")
+    path = str(tmp_path / "table.docx")
+    doc.save(path)
+    doc_id = storage.create_document(upload(path))
+
+    def replace(old, new):
+        structure, changes = applyer.apply_actions(storage.get_structure(doc_id), [
+            {"action": "replace_text_globally", "old_text": old, "new_text": new}])
+        return storage.save_revision(doc_id, structure, changes, "replace"), changes
+
+    # Patched from the upload, then from the previous revision
+    rev_id, changes = replace("Acme", "Beta")
+    # The merged cell covers two grid positions
+    assert changes == ["Replaced 4 occurrences of 'Acme' with 'Beta'"]
+    assert _table_texts(storage.get_revision_path(doc_id, rev_id)) == [["Beta cell", ""], ["Merged Beta", "Merged Beta"]]
+    rev_id, _ = replace("cell", "box")
+    assert _table_texts(storage.get_revision_path(doc_id, rev_id)) == [["Beta box", ""], ["Merged Beta", "Merged Beta"]]
+    assert body_texts(storage.get_revision_path(doc_id, rev_id)) == ["Beta intro", "Outro"]
+
+    # The full patcher, rebuilding from the upload, writes them too
+    monkeypatch.setattr(storage.parsers, "patch_docx_incremental", lambda *args: None)
+    rev_id, _ = replace("Merged", "Joined")
+    assert _table_texts(storage.get_revision_path(doc_id, rev_id)) == [["Beta box", ""], ["Joined Beta", "Joined Beta"]]
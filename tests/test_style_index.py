@@ -0,0 +1,19 @@
+import docx
+from doc_editor import style_index, parsers
+
+def test_types_resolve_to_style_ids():
+    doc = docx.Document()
+    index = style_index.build_style_index(doc)
+    assert index["types"]["h1"] == "Heading1"
+    assert index["types"]["list_item"] == "ListParagraph"
+    assert style_index.resolve_style_id(index, "heading 2") == "Heading2"
+
+def test_paragraph_type_styles():
+    doc = docx.Document()
+    index = style_index.build_style_index(doc)
+    p = doc.add_paragraph("x")
+    parsers._set_paragraph_style(p, "h2", styles=index)
+    assert p.style.name == "Heading 2"
+    parsers._set_paragraph_style(p, "text", fallback="Normal", styles=index)
+    assert p.style.name == "Normal"
+    assert p._p.pPr is None or p._p.pPr.pStyle is None # default style: no pStyle, as python-docx writes it
@@ -0,0 +1,39 @@
+import copy
+from doc_editor import textreplace, applyer
+
+def _replace(rules, text):
+    counts = [0] * len(rules)
+    return textreplace.replace_all(textreplace.compile_replacements(rules), text, counts), counts
+
+def test_replacements_are_simultaneous():
+    rules = [{"old_text": "cat", "new_text": "dog"}, {"old_text": "dog", "new_text": "cat"}]
+    assert _replace(rules, "cat chases dog, dog chases cat") == ("dog chases cat, cat chases dog", [2, 2])
+
+def test_longest_match_wins():
+    rules = [{"old_text": "New", "new_text": "Old"}, {"old_text": "New York", "new_text": "NYC"}]
+    assert _replace(rules, "New York is New") == ("NYC is Old", [1, 1])
+
+def test_case_and_whole_word():
+    rules = [{"old_text": "acme", "new_text": "AcmeCorp", "case_sensitive": False},
+             {"old_text": "art", "new_text": "ART", "whole_word": True}]
+    assert _replace(rules, "ACME art, Acme's party") == ("AcmeCorp ART, AcmeCorp's party", [2, 1])
+
+def test_nothing_to_match():
+    assert textreplace.compile_replacements([{"old_text": "", "new_text": "x"}]) is None
+
+def test_applyer_replaces_paragraphs_and_cells():
+    structure = {"meta": {}, "sections": [{"id": "s1", "title": "T", "paragraphs": [
+        {"id": "s1_p1", "text": "Acme and Beta", "type": "text"},
+        {"id": "s1_p2", "text": "untouched", "type": "text"},
+    ], "tables": [{"id": "s1_t1", "after_paragraph": "s1_p1", "rows": [["Acme", "Beta"], ["x", "ACME"]]}]}]}
+    before = copy.deepcopy(structure)
+    actions = [{"action": "replace_text_globally", "old_text": "Acme", "new_text": "Beta"},
+               {"action": "replace_text_globally", "old_text": "Beta", "new_text": "Acme"}]
+
+    new_structure, changes = applyer.apply_actions(structure, actions)
+
+    sec = new_structure["sections"][0]
+    assert [p["text"] for p in sec["paragraphs"]] == ["Beta and Acme", "untouched"]
+    assert sec["tables"][0]["rows"] == [["Beta", "Acme"], ["x", "ACME"]]
+    assert changes == ["Replaced 2 occurrences of 'Acme' with 'Beta'", "Replaced 2 occurrences of 'Beta' with 'Acme'"]
+    assert structure == before # copy-on-write: the input is never modified
@@ -0,0 +1,66 @@
+"""
+Multi-pattern text replacement for replace_text_globally.
+
+All replacements of a batch are compiled into one matcher and every text is scanned
+once, whatever the number of patterns. Matching is leftmost-longest and
+non-overlapping, like a single str.replace per text, and replacements are
+simultaneous: the output of one rule is never re-matched by another.
+"""
+import re
+
+def compile_replacements(rules):
+    """
+    rules: list of dicts with old_text, new_text and optional case_sensitive (default True)
+    and whole_word (default False), as they appear in replace_text_globally actions.
+    Returns a matcher for replace_all(), or None if no rule has anything to match.
+    """
+    # Longest first so the alternation prefers the longest pattern at a given position;
+    # on a tie, case-sensitive rules win over case-insensitive ones.
+    order = sorted(
+        (i for i, r in enumerate(rules) if r.get("old_text")),
+        key=lambda i: (-len(rules[i]["old_text"]), not rules[i].get("case_sensitive", True), i)
+    )
+    if not order:
+        return None
+
+    seen = set()
+    pieces = []
+    group_rule = []
+    for i in order:
+        rule = rules[i]
+        case_sensitive = rule.get("case_sensitive", True)
+        whole_word = rule.get("whole_word", False)
+        key = (rule["old_text"] if case_sensitive else rule["old_text"].lower(), case_sensitive, whole_word)
+        if key in seen:
+            # Same pattern twice: the first rule takes every match
+            continue
+        seen.add(key)
+
+        piece = re.escape(rule["old_text"])
+        if whole_word:
+            piece = rf"(?<!\w){piece}(?!\w)"
+        if not case_sensitive:
+            piece = f"(?i:{piece})"
+        pieces.append(f"({piece})")
+        group_rule.append(i)
+
+    return {
+        "regex": re.compile("|".join(pieces)),
+        "group_rule": group_rule,
+        "new_texts": [r["new_text"] for r in rules],
+    }
+
+def replace_all(matcher, text, counts):
+    """
+    Returns `text` with every match replaced, adding the number of occurrences of each
+    rule to counts[rule_index].
+    """
+    group_rule = matcher["group_rule"]
+    new_texts = matcher["new_texts"]
+
+    def substitute(m):
+        rule = group_rule[m.lastindex - 1]
+        counts[rule] += 1
+        return new_texts[rule]
+
+    return matcher["regex"].sub(substitute, text)